@@ -23,7 +23,11 @@ setup(
                       'gensim>=3.4.0',
                       'mistune>=0.8.0',
                       'emot==1.0',
-                      'tqdm'],
+                      'tqdm',
+                      'xxhash'],
+    entry_points={
+        'console_scripts': ['thred-preprocess=thred.models.records:main'],
+    },
     python_requires='>=3.5.0',
     tests_require=['pytest'],
 )
@@ -1,14 +1,22 @@
 import codecs
 import collections
+import itertools
 import logging
+import multiprocessing
 import os
 import random
 from collections import defaultdict
 
+import numpy as np
+
+from thred.corpora.encoded_corpus import EncodedCorpus, encode
 from thred.util import fs
 from thred.util.kv import TinyRedis
+from thred.util.line_index import LineIndex
 from thred.util.misc import Stopwatch
-from thred.util.summary_statistics import SampledSummaryStat
+from thred.util.sketch import CountMinSketch, HyperLogLog, SpaceSaving, hash_token, ngram_hashes
+from thred.util.summary_statistics import HistogramSummaryStat
+from thred.util.term_counter import TermFrequencies
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
 logger = logging.getLogger('corpus_toolkit')
@@ -35,29 +43,58 @@ class DialogueCorpus:
         return lno
 
 
-def __build_vocabulary(dialogue_corpus, steps_per_log=100000):
-    vocabulary = set()
-
-    def consume(lno, _, utterance):
-        if lno % steps_per_log == 0:
-            logger.info('{} lines processed - so far vocab {}'.format(lno, len(vocabulary)))
+def _build_ngram_trie(ngrams):
+    """Builds a token-level trie of the ngrams to find all of them in a single scan of an utterance"""
+    trie = {}
+    for ngram in ngrams:
+        node = trie
+        for token in ngram.split():
+            node = node.setdefault(token, {})
+        node[None] = ngram
+    return trie
 
-        for w in utterance.split():
-            vocabulary.add(w)
 
-    line_number = dialogue_corpus.iterate_over(consume)
-    return vocabulary, line_number
+def _find_ngrams(ngram_trie, tokens):
+    """Yields the ngrams of the trie occurring in the tokens"""
+    for i in range(len(tokens)):
+        node = ngram_trie
+        for j in range(i, len(tokens)):
+            node = node.get(tokens[j])
+            if node is None:
+                break
+            if None in node:
+                yield node[None]
 
 
 def preprocess_for_lda(dialogue_corpus, output_path,
                        n_frequents_to_drop=500, min_utterance_length=3, min_word_length=3,
-                       ngrams_path=None, steps_per_log=100000):
+                       ngrams_path=None, n_workers=1, normalize=False, steps_per_log=100000):
+    """
+    Generates LDA documents out of the dialogues by dropping the frequent words, the short words and
+    the short dialogues along with (a given number of) the dialogues containing the provided ngrams.
+    With `normalize`, words are normalized as in the topic model (see `topic_model.analyzer.Normalizer`).
+    """
     if not os.path.exists(output_path):
         os.mkdir(output_path)
     elif not os.path.isdir(output_path):
         raise ValueError('output must be a directory: ' + output_path)
 
-    tf_dict = defaultdict(int)
+    if normalize:
+        from thred.topic_model.analyzer import Normalizer
+        normalizer = Normalizer()
+    else:
+        normalizer = None
+
+    def normalize_term(term):
+        if normalizer is not None:
+            term = normalizer.normalize(term)
+        return term if term is not None and len(term) >= min_word_length else None
+
+    def filter_words(line):
+        words = line.split()
+        if normalizer is not None:
+            words = normalizer.normalize_sequence(words)
+        return [w.strip() for w in words if len(w) >= min_word_length and w not in frequent_words]
 
     sw = Stopwatch()
 
@@ -65,38 +102,26 @@ def preprocess_for_lda(dialogue_corpus, output_path,
     if ngrams_path:
         with codecs.getreader('utf-8')(open(ngrams_path, 'rb')) as ngrams_file:
             for line in ngrams_file:
-                ngram, count = tuple(line.strip().split('\t'))
-                ngrams_dict[ngram] = (int(count), [])
+                ngram, count = tuple(line.strip().split('\t')[:2])
+                ngrams_dict[ngram] = (int(count), set())
 
         logger.info('{} ngrams provided to drop'.format(len(ngrams_dict)))
 
-    n_utterances = 0
-
     logger.info('[Pass 1] finding frequent words...')
-    with codecs.getreader("utf-8")(open(dialogue_corpus.data_path, mode="rb")) as data_file:
-        lno = 0
-        for line in data_file:
-            lno += 1
-            line = line.strip()
-
-            if lno % steps_per_log == 0:
-                logger.info('{} lines processed - so far vocab {} - time {}'.format(lno, len(tf_dict), sw.elapsed()))
-
-            utterances = line.split(dialogue_corpus.utterance_sep)
-            n_utterances = max(n_utterances, len(utterances))
-            for utter in utterances:
-                tokens = utter.split()
-                for w in tokens:
-                    if len(w) >= min_word_length:
-                        tf_dict[w] += 1
+    # term frequencies are cached next to the data (see `TermFrequencies`) and counted in bounded memory
+    term_frequencies = TermFrequencies.load(dialogue_corpus.data_path, dialogue_corpus.utterance_sep, n_workers)
+    term_frequencies = term_frequencies.normalized(normalize_term)
+    logger.info('[Pass 1] done with vocab {} - time {}'.format(len(term_frequencies), sw.elapsed()))
 
-    sorted_vocab = sorted(tf_dict, key=tf_dict.get, reverse=True)
-    sorted_vocab = set(sorted_vocab[n_frequents_to_drop:])
+    frequent_words = {w for w, _ in term_frequencies.most_common(n_frequents_to_drop)}
 
+    # lines are identified by the 64-bit hash of their text, so identical lines are dropped together
     lines_to_drop = set()
     if ngrams_dict:
         logger.info('[Pass 2] finding dialogues containing ngrams to drop...')
 
+        ngram_trie = _build_ngram_trie(ngrams_dict)
+
         processed_lines, lno = 0, 0
         with codecs.getreader("utf-8")(open(dialogue_corpus.data_path, mode="rb")) as data_file:
             for line in data_file:
@@ -108,24 +133,20 @@ def preprocess_for_lda(dialogue_corpus, output_path,
                         '{} lines processed - {} will be chosen - time {}'.format(
                             lno, processed_lines, sw.elapsed()))
 
-                empty_found = False
-                nontrivial_len = 0
-
-                filtered_words = [w.strip() for w in line.split() if w in sorted_vocab]
-                if len(filtered_words) >= min_utterance_length:
-                    nontrivial_len += len(filtered_words)
-                else:
-                    empty_found = True
+                filtered_words = filter_words(line)
+                if len(filtered_words) < min_utterance_length:
+                    continue
 
-                if not empty_found:
-                    processed_lines += 1
-                    for ngram, container in ngrams_dict.items():
-                        if ngram in line:
-                            container[1].append((line, nontrivial_len))
+                processed_lines += 1
+                line_key = None
+                for utter in line.split(dialogue_corpus.utterance_sep):
+                    for ngram in _find_ngrams(ngram_trie, utter.split()):
+                        if line_key is None:
+                            line_key = hash_token(line)
+                        ngrams_dict[ngram][1].add(line_key)
 
         for ngram, container in ngrams_dict.items():
-            # sorted_ngram_lines = sorted(container[1], key=lambda x: x[1])
-            lines = set(line for line, _ in container[1])
+            lines = container[1]
             already_to_drop = lines_to_drop.intersection(lines)
 
             if already_to_drop:
@@ -135,9 +156,9 @@ def preprocess_for_lda(dialogue_corpus, output_path,
                 selectable_lines = lines
                 n_to_drop = container[0]
 
-            dropped_lines = random.sample(selectable_lines, min(n_to_drop, len(selectable_lines)))
-            for line in dropped_lines:
-                lines_to_drop.add(line)
+            dropped_lines = random.sample(sorted(selectable_lines), min(n_to_drop, len(selectable_lines)))
+            for line_key in dropped_lines:
+                lines_to_drop.add(line_key)
 
         logger.info('[Pass 2] done with {} lines chosen for tossing out'.format(len(lines_to_drop)))
 
@@ -168,10 +189,10 @@ def preprocess_for_lda(dialogue_corpus, output_path,
                 empty_found = False
                 processed_dialog = []
 
-                if line in lines_to_drop:
+                if lines_to_drop and hash_token(line) in lines_to_drop:
                     continue
 
-                filtered_words = [w.strip() for w in line.split() if w in sorted_vocab]
+                filtered_words = filter_words(line)
                 if len(filtered_words) >= min_utterance_length:
                     processed_dialog = [' '.join(filtered_words)]
                 else:
@@ -247,59 +268,336 @@ def rank_ngrams(dialogue_corpus, ngrams, redis_port, steps_per_log=100000):
     next(iter(ngrams_cache.values()))[0].close()
 
 
-def count_ngrams(dialogue_corpus, ngrams, redis_port, steps_per_log=5000):
+def _rank_ngrams_in_range(args):
+    data_path, utterance_sep, ngrams, max_counters, start, end, steps_per_log = args
+
+    heavy_hitters = {ngram: SpaceSaving(max_counters) for ngram in ngrams}
+    count_mins = {ngram: CountMinSketch(width=max_counters) for ngram in ngrams}
+    labels = {ngram: {} for ngram in ngrams}
+    pending_hashes = {ngram: [] for ngram in ngrams}
+
+    def flush():
+        for ngram in ngrams:
+            count_mins[ngram].add_hashes(pending_hashes[ngram])
+            pending_hashes[ngram] = []
+
+    sw = Stopwatch()
+    lno = 0
+    for line in fs.read_lines(data_path, start, end):
+        lno += 1
+
+        if lno % steps_per_log == 0:
+            flush()
+            logger.info('{} lines processed in range [{}, {}) - time {}'.format(lno, start, end, sw.elapsed()))
+
+        for utter in line.decode('utf-8').split(utterance_sep):
+            tokens = utter.split()
+            token_hashes = [hash_token(w) for w in tokens]
+            for ngram in ngrams:
+                ngram_labels = labels[ngram]
+                for i, h in enumerate(ngram_hashes(token_hashes, ngram)):
+                    pending_hashes[ngram].append(h)
+                    evicted = heavy_hitters[ngram].add(h)
+                    if evicted is not None:
+                        del ngram_labels[evicted]
+                    if h not in ngram_labels:
+                        ngram_labels[h] = tuple(tokens[i:i + ngram])
+
+    flush()
+    return heavy_hitters, count_mins, labels
+
+
+def rank_ngrams_topk(dialogue_corpus, ngrams, max_counters=1000000, min_freq=10, n_workers=1, steps_per_log=100000):
+    """
+    Streaming alternative to `rank_ngrams` whose memory is bounded by `max_counters` per ngram (and per worker).
+    Candidates are tracked by Space-Saving and their frequencies are tightened by a Count-Min sketch.
+    Each line of the output files contains the ngram, its estimated frequency and the maximum overestimation
+    of the frequency.
+    """
     if not ngrams:
         raise ValueError('ngrams is required')
 
-    _, fname, _ = fs.split3(dialogue_corpus.data_path)
+    dir, fname, _ = fs.split3(dialogue_corpus.data_path)
 
-    def get_key(n):
-        return '{}__c{}'.format(fname, n)
+    chunks = [(dialogue_corpus.data_path, dialogue_corpus.utterance_sep, ngrams, max_counters, start, end,
+               steps_per_log)
+              for start, end in fs.split_lines(dialogue_corpus.data_path, n_workers)]
 
-    ngrams_cache = {}
-    n_words = 0
-    with TinyRedis(port=redis_port, max_connections=100) as redis:
+    sw = Stopwatch()
+    if len(chunks) > 1:
+        with multiprocessing.Pool(len(chunks)) as pool:
+            partial_results = pool.map(_rank_ngrams_in_range, chunks)
+    else:
+        partial_results = [_rank_ngrams_in_range(chunk) for chunk in chunks]
 
+    heavy_hitters, count_mins, labels = partial_results[0]
+    for partial_heavy_hitters, partial_count_mins, partial_labels in partial_results[1:]:
         for ngram in ngrams:
-            redis.delete(get_key(ngram))
-            ngrams_cache[ngram] = set()
+            heavy_hitters[ngram].merge(partial_heavy_hitters[ngram])
+            count_mins[ngram].merge(partial_count_mins[ngram])
+            labels[ngram].update(partial_labels[ngram])
+    logger.info('{} sketches merged - time {}'.format(len(partial_results), sw.elapsed()))
+
+    for ngram in ngrams:
+        top_ngrams = heavy_hitters[ngram].top()
+        if not top_ngrams:
+            estimates = []
+        else:
+            estimates = count_mins[ngram].estimate_hashes([h for h, _, _ in top_ngrams])
+
+        n_written = 0
+        with codecs.getwriter("utf-8")(open(os.path.join(dir, '{}.{}grams'.format(fname, ngram)), 'wb')) as ngram_file:
+            for (h, count, error), estimate in sorted(zip(top_ngrams, estimates),
+                                                      key=lambda x: min(x[0][1], x[1]), reverse=True):
+                freq = min(count, int(estimate))
+                if freq > min_freq:
+                    n_written += 1
+                    ngram_file.write('{}\t{}\t{}\n'.format(
+                        ' '.join(labels[ngram][h]), freq, freq - max(count - error, 0)))
+
+        logger.info('{}-grams: {} written - Count-Min error bound {} - Space-Saving guarantee > {}'.format(
+            ngram, n_written, count_mins[ngram].error_bound(),
+            heavy_hitters[ngram].total_count // max_counters))
+
+
+def benchmark_rank_ngrams(dialogue_corpus, ngrams, redis_port, max_counters=1000000, min_freq=10,
+                          sample_lines=1000000, n_workers=1):
+    """
+    Compares `rank_ngrams_topk` against the exact `rank_ngrams` on `sample_lines` lines of the corpus
+    drawn uniformly at random
+    """
+    import shutil
+    import tempfile
+
+    def read_ngrams(path):
+        ranked = {}
+        with codecs.getreader('utf-8')(open(path, 'rb')) as ngram_file:
+            for line in ngram_file:
+                ngram, freq = line.rstrip('\n').split('\t')[:2]
+                ranked[ngram] = int(freq)
+        return ranked
+
+    tmp_dir = tempfile.mkdtemp(prefix='ngrams')
+    try:
+        sample_path = fs.replace_dir(dialogue_corpus.data_path, tmp_dir)
+        with LineIndex(dialogue_corpus.data_path) as line_index, open(sample_path, 'wb') as sample_file:
+            for lno in sorted(line_index.sample(sample_lines)):
+                sample_file.write(line_index.raw_line(lno))
+        sample_corpus = DialogueCorpus(sample_path, dialogue_corpus.utterance_sep)
+        _, fname, _ = fs.split3(sample_path)
+
+        def ngram_files():
+            return {ngram: os.path.join(tmp_dir, '{}.{}grams'.format(fname, ngram)) for ngram in ngrams}
 
         sw = Stopwatch()
-        with codecs.getreader("utf-8")(open(dialogue_corpus.data_path, mode="rb")) as data_file:
-            lno = 0
-            for line in data_file:
-                lno += 1
+        rank_ngrams(sample_corpus, ngrams, redis_port)
+        exact_time = sw.elapsed()
+        exact = {ngram: read_ngrams(path) for ngram, path in ngram_files().items()}
+
+        sw.start()
+        rank_ngrams_topk(sample_corpus, ngrams, max_counters, min_freq, n_workers)
+        topk_time = sw.elapsed()
+        approx = {ngram: read_ngrams(path) for ngram, path in ngram_files().items()}
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    print('**** {} ({} sampled lines) ****'.format(os.path.abspath(dialogue_corpus.data_path), sample_lines))
+    print('exact (Redis) {:.1f}s | top-k {:.1f}s w. max_counters {}'.format(exact_time, topk_time, max_counters))
+    for ngram in ngrams:
+        relevant = {g: f for g, f in exact[ngram].items() if f > min_freq}
+        found = [g for g in relevant if g in approx[ngram]]
+        errors = [abs(approx[ngram][g] - relevant[g]) for g in found]
+        print('  {}-grams: recall {}/{} {:.2f}% - false positives {} - max error {} - mean error {:.2f}'.format(
+            ngram, len(found), len(relevant), 100.0 * len(found) / max(len(relevant), 1),
+            len([g for g in approx[ngram] if g not in relevant]),
+            max(errors, default=0), sum(errors) / max(len(errors), 1)))
 
-                if lno % steps_per_log == 0:
-                    if ngrams_cache:
-                        for ngram in ngrams_cache:
-                            logger.info('{}-grams flushing {} keys...'.format(ngram, len(ngrams_cache[ngram])))
-                            redis.pfadd(get_key(ngram), *ngrams_cache[ngram])
-                            ngrams_cache[ngram] = set()
-                        logger.info('ngrams flushed...')
 
-                    logger.info('{} lines processed - time {}'.format(lno, sw.elapsed()))
+def _count_ngrams_in_range(args):
+    data_path, utterance_sep, ngrams, precision, start, end, steps_per_log = args
 
-                for utter in line.split(dialogue_corpus.utterance_sep):
-                    tokens = utter.split()
-                    n_words += len(tokens)
-                    for ngram in ngrams_cache:
-                        for i in range(len(tokens) - ngram):
-                            ngrams_cache[ngram].add(' '.join(tokens[i:i + ngram]))
+    sketches = {ngram: HyperLogLog(precision) for ngram in ngrams}
+    n_words = 0
+
+    sw = Stopwatch()
+    lno = 0
+    for line in fs.read_lines(data_path, start, end):
+        lno += 1
+
+        if lno % steps_per_log == 0:
+            logger.info('{} lines processed in range [{}, {}) - time {}'.format(lno, start, end, sw.elapsed()))
+
+        for utter in line.decode('utf-8').split(utterance_sep):
+            token_hashes = [hash_token(w) for w in utter.split()]
+            n_words += len(token_hashes)
+            for ngram, sketch in sketches.items():
+                for h in ngram_hashes(token_hashes, ngram):
+                    sketch.add_hash(h)
+
+    return sketches, n_words
+
+
+def count_ngrams(dialogue_corpus, ngrams, precision=14, n_workers=1, steps_per_log=100000):
+    if not ngrams:
+        raise ValueError('ngrams is required')
+
+    _, fname, _ = fs.split3(dialogue_corpus.data_path)
 
-        for ngram in ngrams_cache:
-            logger.info('{}-grams flushing {} keys...'.format(ngram, len(ngrams_cache[ngram])))
-            redis.pfadd(get_key(ngram), *ngrams_cache[ngram])
-        logger.info('ngrams flushed...')
+    chunks = [(dialogue_corpus.data_path, dialogue_corpus.utterance_sep, ngrams, precision, start, end, steps_per_log)
+              for start, end in fs.split_lines(dialogue_corpus.data_path, n_workers)]
 
-        logger.info('**** {} ****'.format(fname))
-        logger.info("#words = {}".format(n_words))
+    sw = Stopwatch()
+    if len(chunks) > 1:
+        with multiprocessing.Pool(len(chunks)) as pool:
+            partial_results = pool.map(_count_ngrams_in_range, chunks)
+    else:
+        partial_results = [_count_ngrams_in_range(chunk) for chunk in chunks]
+
+    sketches, n_words = partial_results[0]
+    for partial_sketches, partial_n_words in partial_results[1:]:
+        n_words += partial_n_words
         for ngram in ngrams:
-            ngram_cnt = redis.pfcount(get_key(ngram))
-            logger.info('# {}-grams = {} | distinct-{} = {:.3f}'.format(ngram, ngram_cnt, ngram, ngram_cnt / n_words))
+            sketches[ngram].merge(partial_sketches[ngram])
+    logger.info('{} sketches merged - time {}'.format(len(partial_results), sw.elapsed()))
+
+    logger.info('**** {} ****'.format(fname))
+    logger.info("#words = {}".format(n_words))
+    for ngram in ngrams:
+        ngram_cnt = sketches[ngram].count()
+        logger.info('# {}-grams = {} | distinct-{} = {:.3f}'.format(ngram, ngram_cnt, ngram, ngram_cnt / n_words))
+
+
+def count_ngrams_encoded(dialogue_corpus, ngrams, precision=14, chunk_size=1 << 25):
+    """Same as `count_ngrams` but runs over the integer-encoded corpus (see `encoded_corpus.encode`)"""
+    if not ngrams:
+        raise ValueError('ngrams is required')
+
+    _, fname, _ = fs.split3(dialogue_corpus.data_path)
+    encoded = EncodedCorpus(dialogue_corpus.data_path)
+
+    sw = Stopwatch()
+    logger.info('**** {} ****'.format(fname))
+    logger.info("#words = {}".format(encoded.num_tokens))
+    for ngram in ngrams:
+        ngram_cnt = encoded.count_distinct_ngrams(ngram, precision, chunk_size)
+        logger.info('# {}-grams = {} | distinct-{} = {:.3f} - time {}'.format(
+            ngram, ngram_cnt, ngram, ngram_cnt / encoded.num_tokens, sw.elapsed()))
+
+
+def rank_ngrams_encoded(dialogue_corpus, ngrams, min_freq=10, chunk_size=1 << 25):
+    """
+    Exact alternative to `rank_ngrams` over the integer-encoded corpus (see `encoded_corpus.encode`)
+    which needs neither Redis nor the n-gram strings except for the ones written to the output.
+    """
+    if not ngrams:
+        raise ValueError('ngrams is required')
+
+    dir, fname, _ = fs.split3(dialogue_corpus.data_path)
+    encoded = EncodedCorpus(dialogue_corpus.data_path)
+
+    sw = Stopwatch()
+    for ngram in ngrams:
+        _, counts, positions = encoded.ngram_frequencies(ngram, chunk_size)
+        frequent = np.flatnonzero(counts > min_freq)
+        frequent = frequent[np.argsort(-counts[frequent], kind='stable')]
+
+        with codecs.getwriter("utf-8")(open(os.path.join(dir, '{}.{}grams'.format(fname, ngram)), 'wb')) as ngram_file:
+            for i in frequent:
+                ngram_file.write('{}\t{}\n'.format(encoded.ngram_at(positions[i], ngram), counts[i]))
+
+        logger.info('{}-grams: {} distinct - {} written - time {}'.format(
+            ngram, len(counts), len(frequent), sw.elapsed()))
+
+
+def analyze(dialogue_corpus, analysis_args, n_workers=1):
+    """Analyzes the corpus from its term frequencies, which are cached next to the data (see `TermFrequencies`)"""
+    sw = Stopwatch()
+    term_frequencies = TermFrequencies.load(dialogue_corpus.data_path, dialogue_corpus.utterance_sep, n_workers)
+    logger.info('{} lines analyzed - vocab {} - time {}'.format(
+        term_frequencies.num_lines, len(term_frequencies), sw.elapsed()))
+
+    lengths = np.arange(term_frequencies.length_counts.shape[1])
+    wno_stat = HistogramSummaryStat()
+    wno_stat.accept_many(lengths, term_frequencies.length_counts.sum(axis=0))
+    wno_stat_per_turn = []
+    for turn_length_counts in term_frequencies.length_counts:
+        stat = HistogramSummaryStat()
+        stat.accept_many(lengths, turn_length_counts)
+        wno_stat_per_turn.append(stat)
+
+    report_analysis(dialogue_corpus, analysis_args, term_frequencies.most_common(len(term_frequencies)),
+                    term_frequencies.num_lines, term_frequencies.num_utterances, wno_stat, wno_stat_per_turn)
 
 
-def analyze(dialogue_corpus, analysis_args, steps_per_log=100000):
+def analyze_encoded(dialogue_corpus, analysis_args, chunk_size=1 << 25):
+    """Same as `analyze` but runs over the integer-encoded corpus (see `encoded_corpus.encode`)"""
+    encoded = EncodedCorpus(dialogue_corpus.data_path)
+
+    sw = Stopwatch()
+    tf = encoded.term_frequencies(chunk_size)
+
+    wno_stat_per_turn = []
+    wno_stat = HistogramSummaryStat()
+    for start, end in encoded.iter_chunks(chunk_size):
+        lengths = encoded.utterance_lengths(start, end)
+        turns = encoded.utterance_turns(start, end)
+        wno_stat.accept_many(lengths)
+
+        for t in range(int(turns.max()) + 1 if len(turns) else 0):
+            if t >= len(wno_stat_per_turn):
+                wno_stat_per_turn.append(HistogramSummaryStat())
+            wno_stat_per_turn[t].accept_many(lengths[turns == t])
+    logger.info('{} tokens analyzed - time {}'.format(encoded.num_tokens, sw.elapsed()))
+
+    # stable sort to break ties by the first occurrence, the same as `analyze`
+    sorted_ids = np.argsort(-tf, kind='stable')
+    report_analysis(dialogue_corpus, analysis_args, [(encoded.vocab[i], int(tf[i])) for i in sorted_ids],
+                    encoded.num_lines, encoded.num_utterances, wno_stat, wno_stat_per_turn)
+
+
+def compact_topics(dialogue_corpus, output_path, table_path=None, steps_per_log=100000):
+    """
+    Converts a topical data file, whose last field holds the topic words, to the compact format in which the
+    last field is a topic id (-1 for <NO_TOPIC>) and the words of the topics are stored once in a topic table
+    (one topic per line). An existing table is extended, so that the train, dev and test files share the ids.
+    """
+    if table_path is None:
+        table_path = fs.replace_ext(output_path, 'topics')
+
+    topic_ids = collections.OrderedDict()
+    if os.path.exists(table_path):
+        with codecs.getreader("utf-8")(open(table_path, mode="rb")) as table_file:
+            for line in table_file:
+                topic_ids.setdefault(' '.join(line.split()), len(topic_ids))
+    n_known_topics = len(topic_ids)
+
+    sw = Stopwatch()
+    lno = 0
+    with codecs.getwriter("utf-8")(open(output_path, mode="wb")) as out_file:
+        for line in fs.read_lines(dialogue_corpus.data_path):
+            lno += 1
+            if lno % steps_per_log == 0:
+                logger.info('{} lines processed - so far topics {} - time {}'.format(lno, len(topic_ids), sw.elapsed()))
+
+            fields = line.decode('utf-8').rstrip('\r\n').split(dialogue_corpus.utterance_sep)
+            topic = ' '.join(fields[-1].split())
+            topic_id = -1 if topic == '<NO_TOPIC>' else topic_ids.setdefault(topic, len(topic_ids))
+            out_file.write(dialogue_corpus.utterance_sep.join(fields[:-1] + [str(topic_id)]) + '\n')
+
+    with codecs.getwriter("utf-8")(open(table_path, mode="ab")) as table_file:
+        for topic in itertools.islice(topic_ids, n_known_topics, None):
+            table_file.write(topic + '\n')
+
+    logger.info('{} lines compacted with {} topics ({} new) - time {}'.format(
+        lno, len(topic_ids), len(topic_ids) - n_known_topics, sw.elapsed()))
+
+
+def report_analysis(dialogue_corpus, analysis_args, sorted_tfs, lno, uno, wno_stat, wno_stat_per_turn):
+    """
+    Writes the requested word lists and prints the summary of a corpus analysis.
+    `sorted_tfs` holds (word, term frequency) pairs in the descending order of term frequencies
+    and the stats are `HistogramSummaryStat`s of utterance lengths.
+    """
     dir, fname, _ = fs.split3(dialogue_corpus.data_path)
 
     if analysis_args.n_frequent_words > 0:
@@ -320,38 +618,9 @@ def analyze(dialogue_corpus, analysis_args, steps_per_log=100000):
     else:
         tf_file = None
 
-    tf_dict = defaultdict(int)
-
-    lno, uno = 0, 0
-    wno_stat_per_turn = []
-    wno_stat = SampledSummaryStat()
-    sw = Stopwatch()
-
-    with codecs.getreader("utf-8")(open(dialogue_corpus.data_path, mode="rb")) as data_file:
-        for line in data_file:
-            lno += 1
-
-            if lno % steps_per_log == 0:
-                logger.info('{} lines processed - so far vocab {} - time {}'.format(lno, len(tf_dict), sw.elapsed()))
-
-            for t, utter in enumerate(line.split(dialogue_corpus.utterance_sep)):
-                uno += 1
-                tokens = utter.split()
-                for w in tokens:
-                    tf_dict[w] += 1
-
-                if t >= len(wno_stat_per_turn):
-                    wno_stat_per_turn.append(SampledSummaryStat())
-                wno_stat_per_turn[t].accept(len(tokens))
-                wno_stat.accept(len(tokens))
-
-    sorted_vocab = sorted(tf_dict, key=tf_dict.get, reverse=True)
-
     min_freq_vocab_size, min_freq_vol_size = 0, 0
     vol_size = 0
-    for i, w in enumerate(sorted_vocab):
-        tf = tf_dict[w]
-
+    for i, (w, tf) in enumerate(sorted_tfs):
         if tf >= analysis_args.min_freq:
             min_freq_vocab_size += 1
             min_freq_vol_size += tf
@@ -363,7 +632,7 @@ def analyze(dialogue_corpus, analysis_args, steps_per_log=100000):
             tf_file.write('{}\t{}\n'.format(w, tf))
         if frequent_words_file and i < analysis_args.n_frequent_words:
             frequent_words_file.write('{}\n'.format(w))
-        if rare_words_file and i > len(sorted_vocab) - analysis_args.n_rare_words:
+        if rare_words_file and i > len(sorted_tfs) - analysis_args.n_rare_words:
             rare_words_file.write('{}\n'.format(w))
 
     if frequent_words_file:
@@ -376,33 +645,37 @@ def analyze(dialogue_corpus, analysis_args, steps_per_log=100000):
         tf_file.close()
 
     print('**** {} ****'.format(os.path.abspath(dialogue_corpus.data_path)))
-    print('lines {} | utterances {} | vocab {} tf {}'.format(lno, uno, len(tf_dict), wno_stat.get_sum()))
+    print('lines {} | utterances {} | vocab {} tf {}'.format(lno, uno, len(sorted_tfs), wno_stat.get_sum()))
     print('min_freq {} -> {}/{} {:.1f}% - {}/{} {:.1f}%)'.format(
         analysis_args.min_freq,
-        min_freq_vocab_size, len(tf_dict),
-        100.0 * min_freq_vocab_size / len(tf_dict),
+        min_freq_vocab_size, len(sorted_tfs),
+        100.0 * min_freq_vocab_size / len(sorted_tfs),
         min_freq_vol_size, wno_stat.get_sum(),
         100.0 * min_freq_vol_size / wno_stat.get_sum()))
     print('vocab_size {}/{} {:.1f}% - {}/{} {:.1f}%)'.format(
-        analysis_args.vocab_size, len(tf_dict),
-        100.0 * analysis_args.vocab_size / len(tf_dict),
+        analysis_args.vocab_size, len(sorted_tfs),
+        100.0 * analysis_args.vocab_size / len(sorted_tfs),
         vol_size, wno_stat.get_sum(),
         100.0 * vol_size / wno_stat.get_sum()))
 
     print('utterances per line: {:.1f}'.format(uno / lno))
-    print('utterance_len: avg {:.1f} - stdev {:.1f} - median {} - min {} - max {}'.format(
+    print('utterance_len: avg {:.1f} - stdev {:.1f} - median {} - p90 {} - p99 {} - min {} - max {}'.format(
         wno_stat.get_average(),
         wno_stat.get_stdev(),
         wno_stat.get_median(),
+        wno_stat.get_percentile(90),
+        wno_stat.get_percentile(99),
         wno_stat.get_min(),
         wno_stat.get_max()))
     print('utterance_len per turn')
     for t, stat in enumerate(wno_stat_per_turn):
-        print('  turn {} - avg {:.1f} - stdev {:.1f} - median {} - min {} - max {}'.format(
+        print('  turn {} - avg {:.1f} - stdev {:.1f} - median {} - p90 {} - p99 {} - min {} - max {}'.format(
             t,
             stat.get_average(),
             stat.get_stdev(),
             stat.get_median(),
+            stat.get_percentile(90),
+            stat.get_percentile(99),
             stat.get_min(),
             stat.get_max()))
 
@@ -416,6 +689,8 @@ if __name__ == "__main__":
     r_group = subparsers.add_parser("analyze")
     n_group = subparsers.add_parser("ngrams")
     p_group = subparsers.add_parser("preprocess-lda")
+    e_group = subparsers.add_parser("encode")
+    t_group = subparsers.add_parser("compact-topics")
 
     parser.add_argument('-d', '--data', type=str, required=True,
                         help="data path")
@@ -427,11 +702,24 @@ if __name__ == "__main__":
     r_group.add_argument('--vocab_size', default=0, type=int)
     r_group.add_argument('--min_freq', default=1, type=int)
     r_group.add_argument('--save_tf', action='store_true')
+    r_group.add_argument('--n_workers', default=multiprocessing.cpu_count(), type=int)
+    r_group.add_argument('--encoded', action='store_true',
+                         help="runs over the integer-encoded corpus (see the encode operation)")
     r_group.set_defaults(op=lambda: "analyze")
 
     n_group.add_argument('-n', '--ngrams', nargs='+', type=int)
     n_group.add_argument('--ngram_redis_port', default=6389, type=int)
-    n_group.add_argument('--operation', default='count', choices=("count", "rank"), type=str)
+    n_group.add_argument('--precision', default=14, type=int,
+                         help="HyperLogLog precision used to count distinct ngrams")
+    n_group.add_argument('--n_workers', default=multiprocessing.cpu_count(), type=int)
+    n_group.add_argument('--operation', default='count', choices=("count", "rank", "topk"), type=str)
+    n_group.add_argument('--max_counters', default=1000000, type=int,
+                         help="number of counters per ngram (and per worker) in the topk operation")
+    n_group.add_argument('--min_freq', default=10, type=int)
+    n_group.add_argument('--benchmark_lines', default=0, type=int,
+                         help="if positive, compares topk against the exact (Redis) ranking on this many lines")
+    n_group.add_argument('--encoded', action='store_true',
+                         help="runs count and rank over the integer-encoded corpus (see the encode operation)")
     n_group.set_defaults(op=lambda: "ngrams")
 
     p_group.add_argument('--output', required=True, type=str)
@@ -439,20 +727,48 @@ if __name__ == "__main__":
     p_group.add_argument('--min_utterance_length', default=3, type=int)
     p_group.add_argument('--n_frequents_to_drop', default=400, type=int)
     p_group.add_argument('--ngrams_file', type=str)
+    p_group.add_argument('--n_workers', default=multiprocessing.cpu_count(), type=int)
+    p_group.add_argument('--normalize', action='store_true',
+                         help="normalizes words the same way as the topic model")
     p_group.set_defaults(op=lambda: "preprocess-lda")
 
+    e_group.set_defaults(op=lambda: "encode")
+
+    t_group.add_argument('--output', required=True, type=str)
+    t_group.add_argument('--topic_table', type=str,
+                         help="topic table to create or extend (defaults to the output with the .topics extension)")
+    t_group.set_defaults(op=lambda: "compact-topics")
+
     args = parser.parse_args()
     corpus = DialogueCorpus(args.data, args.separator)
 
     if args.op() == "analyze":
-        analyze(corpus, AnalysisArgs(args.n_frequents, args.n_rares, args.min_freq, args.vocab_size, args.save_tf))
+        analysis_args = AnalysisArgs(args.n_frequents, args.n_rares, args.min_freq, args.vocab_size, args.save_tf)
+        if args.encoded:
+            analyze_encoded(corpus, analysis_args)
+        else:
+            analyze(corpus, analysis_args, args.n_workers)
     elif args.op() == "ngrams":
-        if args.operation == "rank":
+        if args.benchmark_lines > 0:
+            benchmark_rank_ngrams(corpus, args.ngrams, args.ngram_redis_port, args.max_counters, args.min_freq,
+                                  args.benchmark_lines, args.n_workers)
+        elif args.operation == "rank" and args.encoded:
+            rank_ngrams_encoded(corpus, args.ngrams, args.min_freq)
+        elif args.operation == "rank":
             rank_ngrams(corpus, args.ngrams, args.ngram_redis_port)
+        elif args.operation == "topk":
+            rank_ngrams_topk(corpus, args.ngrams, args.max_counters, args.min_freq, args.n_workers)
+        elif args.encoded:
+            count_ngrams_encoded(corpus, args.ngrams, args.precision)
         else:
-            count_ngrams(corpus, args.ngrams, args.ngram_redis_port)
+            count_ngrams(corpus, args.ngrams, args.precision, args.n_workers)
     elif args.op() == "preprocess-lda":
         preprocess_for_lda(corpus, args.output, args.n_frequents_to_drop,
-                           args.min_utterance_length, args.min_word_length, args.ngrams_file)
+                           args.min_utterance_length, args.min_word_length, args.ngrams_file, args.n_workers,
+                           args.normalize)
+    elif args.op() == "encode":
+        encode(corpus)
+    elif args.op() == "compact-topics":
+        compact_topics(corpus, args.output, args.topic_table)
     else:
         raise ValueError('Unknown operation')
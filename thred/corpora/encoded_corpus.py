@@ -0,0 +1,195 @@
+""" Integer-encoded, memory-mapped representation of dialogue corpora.
+    A dialogue file is encoded once (see `encode`) into the following files next to it:
+      - `<name>.ids`: int32 token ids of all the utterances back to back
+      - `<name>.uoff`: int64 offsets of the utterances in the token ids (#utterances + 1 entries)
+      - `<name>.loff`: int64 offsets of the lines in the utterances (#lines + 1 entries)
+      - `<name>.vocab`: the words in the order of their ids (i.e., order of first occurrence)
+    so that corpus analytics run as vectorized NumPy operations over chunks of memory-mapped arrays
+    instead of string operations.
+"""
+import array
+import codecs
+import logging
+import os
+
+import numpy as np
+
+from thred.util import fs
+from thred.util.misc import Stopwatch
+from thred.util.sketch import HyperLogLog, finalize_hashes
+
+logger = logging.getLogger('encoded_corpus')
+
+_GOLDEN_GAMMA = np.uint64(0x9E3779B97F4A7C15)
+
+
+def _encoded_paths(data_path):
+    return tuple(fs.replace_ext(data_path, ext) for ext in ('ids', 'uoff', 'loff', 'vocab'))
+
+
+def _memmap(path, dtype):
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r')
+
+
+def encode(dialogue_corpus, steps_per_log=100000):
+    """Encodes a dialogue corpus in a single streaming pass"""
+    ids_path, uoff_path, loff_path, vocab_path = _encoded_paths(dialogue_corpus.data_path)
+
+    vocab = {}
+    token_ids, utterance_offsets, line_offsets = array.array('i'), array.array('q', [0]), array.array('q', [0])
+    n_tokens, n_utterances = 0, 0
+
+    sw = Stopwatch()
+    with open(ids_path, 'wb') as ids_file, open(uoff_path, 'wb') as uoff_file, open(loff_path, 'wb') as loff_file:
+        def flush():
+            for buffer, buffer_file in ((token_ids, ids_file),
+                                        (utterance_offsets, uoff_file),
+                                        (line_offsets, loff_file)):
+                buffer.tofile(buffer_file)
+                del buffer[:]
+
+        lno = 0
+        for line in fs.read_lines(dialogue_corpus.data_path):
+            lno += 1
+
+            if lno % steps_per_log == 0:
+                flush()
+                logger.info('{} lines encoded - so far vocab {} - time {}'.format(lno, len(vocab), sw.elapsed()))
+
+            for utter in line.decode('utf-8').split(dialogue_corpus.utterance_sep):
+                for w in utter.split():
+                    token_ids.append(vocab.setdefault(w, len(vocab)))
+                    n_tokens += 1
+                utterance_offsets.append(n_tokens)
+                n_utterances += 1
+            line_offsets.append(n_utterances)
+
+        flush()
+
+    with codecs.getwriter("utf-8")(open(vocab_path, mode="wb")) as vocab_file:
+        for w in vocab:
+            vocab_file.write(w + '\n')
+
+    logger.info('{} lines, {} utterances and {} tokens encoded with vocab {} - time {}'.format(
+        lno, n_utterances, n_tokens, len(vocab), sw.elapsed()))
+
+
+class EncodedCorpus:
+
+    def __init__(self, data_path):
+        ids_path, uoff_path, loff_path, vocab_path = _encoded_paths(data_path)
+        if not os.path.exists(ids_path):
+            raise ValueError('The encoded corpus does not exist (encode it first): {}'.format(ids_path))
+
+        self.data_path = data_path
+        self.token_ids = _memmap(ids_path, np.int32)
+        self.utterance_offsets = _memmap(uoff_path, np.int64)
+        self.line_offsets = _memmap(loff_path, np.int64)
+
+        with codecs.getreader("utf-8")(open(vocab_path, mode="rb")) as vocab_file:
+            self.vocab = [w.rstrip('\n') for w in vocab_file]
+
+    @property
+    def num_lines(self):
+        return len(self.line_offsets) - 1
+
+    @property
+    def num_utterances(self):
+        return len(self.utterance_offsets) - 1
+
+    @property
+    def num_tokens(self):
+        return len(self.token_ids)
+
+    def iter_chunks(self, chunk_size=1 << 25):
+        """Yields [start, end) ranges of utterances spanning roughly `chunk_size` tokens each"""
+        targets = np.arange(chunk_size, self.num_tokens, chunk_size)
+        boundaries = np.unique(np.concatenate((
+            [0], np.searchsorted(self.utterance_offsets, targets), [self.num_utterances])))
+        for start, end in zip(boundaries[:-1], boundaries[1:]):
+            yield int(start), int(end)
+
+    def utterance_lengths(self, start, end):
+        return np.diff(self.utterance_offsets[start:end + 1])
+
+    def utterance_turns(self, start, end):
+        """The position of each utterance in [start, end) within its line"""
+        utterances = np.arange(start, end)
+        lines = np.searchsorted(self.line_offsets, utterances, side='right') - 1
+        return utterances - self.line_offsets[lines]
+
+    def term_frequencies(self, chunk_size=1 << 25):
+        tf = np.zeros(len(self.vocab), dtype=np.int64)
+        for start, end in self.iter_chunks(chunk_size):
+            tf += np.bincount(self.token_ids[self.utterance_offsets[start]:self.utterance_offsets[end]],
+                              minlength=len(self.vocab))
+        return tf
+
+    def ngram_keys(self, n, start, end):
+        """
+        Computes a 64-bit key for every n-gram (not crossing utterance boundaries) in the utterances [start, end)
+        via rolling-window arithmetic over the token ids. The keys are exact (packed token ids)
+        whenever vocab_size ** n fits in 64 bits, and hashes otherwise.
+        :return: the keys and the token offsets at which the n-grams start
+        """
+        first_token = int(self.utterance_offsets[start])
+        ids = np.asarray(self.token_ids[first_token:self.utterance_offsets[end]], dtype=np.uint64)
+        n_windows = len(ids) - n + 1
+        if n_windows <= 0:
+            return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64)
+
+        utterance_starts = np.zeros(len(ids) + 1, dtype=np.int64)
+        utterance_starts[self.utterance_offsets[start:end] - first_token] = 1
+        boundaries = np.cumsum(utterance_starts[:len(ids)])
+        valid = boundaries[n - 1:] == boundaries[:n_windows]
+
+        if len(self.vocab) ** n <= 1 << 64:
+            multiplier = np.uint64(len(self.vocab))
+        else:
+            multiplier = _GOLDEN_GAMMA
+
+        keys = ids[:n_windows].copy()
+        for k in range(1, n):
+            keys = keys * multiplier + ids[k:k + n_windows]
+
+        return keys[valid], np.flatnonzero(valid) + first_token
+
+    def count_distinct_ngrams(self, n, precision=14, chunk_size=1 << 25):
+        sketch = HyperLogLog(precision)
+        for start, end in self.iter_chunks(chunk_size):
+            keys, _ = self.ngram_keys(n, start, end)
+            sketch.add_hashes(finalize_hashes(keys))
+        return sketch.count()
+
+    def ngram_frequencies(self, n, chunk_size=1 << 25):
+        """
+        Exact n-gram frequencies
+        :return: sorted distinct keys, their frequencies and the token offset of the first occurrence of each key
+        """
+        keys = np.zeros(0, dtype=np.uint64)
+        counts = np.zeros(0, dtype=np.int64)
+        positions = np.zeros(0, dtype=np.int64)
+
+        for start, end in self.iter_chunks(chunk_size):
+            chunk_keys, chunk_positions = self.ngram_keys(n, start, end)
+            chunk_keys, first_indices, chunk_counts = np.unique(chunk_keys, return_index=True, return_counts=True)
+
+            keys = np.concatenate((keys, chunk_keys))
+            counts = np.concatenate((counts, chunk_counts))
+            positions = np.concatenate((positions, chunk_positions[first_indices]))
+
+            order = np.argsort(keys, kind='stable')
+            keys, counts, positions = keys[order], counts[order], positions[order]
+            group_starts = np.concatenate(([0], np.flatnonzero(keys[1:] != keys[:-1]) + 1)) \
+                if len(keys) else np.zeros(0, dtype=np.int64)
+            keys = keys[group_starts]
+            counts = np.add.reduceat(counts, group_starts) if len(group_starts) else counts
+            positions = np.minimum.reduceat(positions, group_starts) if len(group_starts) else positions
+
+        return keys, counts, positions
+
+    def ngram_at(self, position, n):
+        return ' '.join(self.vocab[i] for i in self.token_ids[position:position + n])
+
@@ -19,10 +19,16 @@ def main(_):
     parser.add_argument('--config', type=str, help='config file containing parameters to configure the model')
 
     parser.add_argument('--train_data', type=str, help='training dataset')
+    parser.add_argument('--train_records', type=str,
+                        help='prefix of the TFRecord files of the training dataset (written by thred-preprocess)')
     parser.add_argument('--dev_data', type=str, help='development dataset')
     parser.add_argument('--test_data', type=str, help='tests dataset')
 
     parser.add_argument('--embed_conf', type=str, default="conf/word_embeddings.yml", help='embedding config file')
+    parser.add_argument('--embed_cache_dir', type=str,
+                        help='directory of the embedding files shared by model directories (default: .embeddings)')
+    parser.add_argument('--embed_cache_size', type=float, default=20,
+                        help='size limit of the shared embedding cache in GB (0 disables the cache)')
     parser.add_argument('--restart_training', action='store_true', help='remove saved models and logs in the model directory to start training from scratch')
     parser.add_argument('--eval_best_model', action='store_true', help='whether to evaluate the best model after training finished')
 
@@ -33,6 +39,9 @@ def main(_):
                         help='length penalty to override the value in config file')
     parser.add_argument('--sampling_temperature', type=float,
                         help='sampling temperature to override the value in config file')
+    parser.add_argument('--topic_table', type=str,
+                        help='topic table of topical data files in which topic ids replace topic words '
+                             '(written by the LDA inference with --topic_ids)')
     parser.add_argument('--lda_model_dir', type=str, help='required only for testing with topical models (THRED and TA-Seq2Seq)')
 
     args = vars(parser.parse_args())
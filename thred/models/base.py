@@ -7,9 +7,10 @@ from abc import abstractmethod
 import numpy as np
 import tensorflow as tf
 
-from . import ncm_utils, model_helper
+from . import ncm_utils, model_helper, topical_base
 from ..util import fs, misc, log, vocab
 from ..util.embed import EmbeddingUtil
+from ..util.line_index import LineIndex, LoadedLines, is_indexable
 
 
 class AbstractModel(object):
@@ -18,7 +19,13 @@ class AbstractModel(object):
         reserved_vecs, trainable_vecs, frozen_vecs = EmbeddingUtil.load_vectors(vocab_h5, vocab_file)
 
         with tf.variable_scope(scope or "embeddings", dtype=dtype):
-            const_embedding_matrix = tf.constant(frozen_vecs, dtype=dtype)
+            # The frozen vectors are fed when initializing the variable (see model_helper.init_frozen_embeddings)
+            # to keep them out of the GraphDef. As a local variable, it is neither checkpointed nor restored.
+            frozen_placeholder = tf.placeholder(dtype, shape=frozen_vecs.shape, name="frozen_emb_placeholder")
+            const_embedding_matrix = tf.Variable(frozen_placeholder, trainable=False, name="frozen_emb_matrix",
+                                                 collections=[tf.GraphKeys.LOCAL_VARIABLES])
+            self.frozen_embeddings_initializer = const_embedding_matrix.initializer
+            self.frozen_embeddings_feed = {frozen_placeholder: frozen_vecs}
 
             with tf.variable_scope(scope or "trainable_embeddings", dtype=dtype):
                 reserved_token_embeddings = tf.get_variable("reserved_emb_matrix",
@@ -155,9 +162,10 @@ class NMTEncoderDecoderWrapper(AbstractEncoderDecoderWrapper):
         self.config['checkpoint_file'] = os.path.join(self.config.model_dir,
                                                       '{}.ckpt'.format(self._get_checkpoint_name()))
 
+        # with `batch_tokens`, it is re-estimated from the bucketed lengths (see bucketing.train_buckets)
         if self.config.mode == 'train':
             self.config['num_train_steps'] = int(self.config.num_train_epochs * math.ceil(
-                fs.count_lines(self.config.train_data) / self.config.batch_size))
+                len(self._index_data(self.config.train_data)) / self.config.batch_size))
 
         self.config.vocab_file = os.path.join(self.config.model_dir,
                                               'vocab{}.in'.format(self.config.original_vocab_size
@@ -189,7 +197,8 @@ class NMTEncoderDecoderWrapper(AbstractEncoderDecoderWrapper):
 
     def _pre_model_creation(self):
         vocab.create_vocabulary(self.config.vocab_file, self.config.train_data, self.config.vocab_size)
-        EmbeddingUtil(self.config.embed_conf).build_if_not_exists(
+        EmbeddingUtil(self.config.embed_conf, self.config.get('embed_cache_dir'),
+                      self.config.get('embed_cache_size', 20)).build_if_not_exists(
             self.config.embedding_type, self.config.vocab_h5, self.config.vocab_file)
 
         self._vocab_table = vocab.create_vocab_dict(self.config.vocab_file)
@@ -225,12 +234,17 @@ class NMTEncoderDecoderWrapper(AbstractEncoderDecoderWrapper):
         """Initialize statistics that we want to keep."""
 
         return {"step_time": 0.0, "loss": 0.0, "predict_count": 0.0,
-                "total_count": 0.0, "grad_norm": 0.0}
+                "total_count": 0.0, "padded_count": 0.0, "grad_norm": 0.0}
 
-    def update_stats(self, stats, summary_writer, start_time, step_result):
+    def init_epoch_stats(self):
+        """Initialize statistics that are kept over an epoch."""
+
+        return {"total_count": 0.0, "padded_count": 0.0}
+
+    def update_stats(self, stats, summary_writer, start_time, step_result, epoch_stats=None):
         """Update stats: write summary and accumulate statistics."""
         (_, step_loss, step_predict_count, step_summary, global_step,
-         step_word_count, batch_size, grad_norm, learning_rate) = step_result
+         step_word_count, batch_size, grad_norm, learning_rate, step_padded_count) = step_result
 
         # Write step summary.
         summary_writer.add_summary(step_summary, global_step)
@@ -240,9 +254,14 @@ class NMTEncoderDecoderWrapper(AbstractEncoderDecoderWrapper):
         stats["loss"] += (step_loss * batch_size)
         stats["predict_count"] += step_predict_count
         stats["total_count"] += float(step_word_count)
+        stats["padded_count"] += float(step_padded_count)
         stats["grad_norm"] += grad_norm
         stats["learning_rate"] = learning_rate
 
+        if epoch_stats is not None:
+            epoch_stats["total_count"] += float(step_word_count)
+            epoch_stats["padded_count"] += float(step_padded_count)
+
         return global_step
 
     def check_stats(self, stats, global_step, steps_per_stats, log_f, pbar=None):
@@ -253,6 +272,7 @@ class NMTEncoderDecoderWrapper(AbstractEncoderDecoderWrapper):
         train_ppl = misc.safe_exp(
             stats["loss"] / stats["predict_count"])
         speed = stats["total_count"] / (1000 * stats["step_time"])
+        padding = 1.0 - stats["total_count"] / max(stats["padded_count"], 1.0)
 
         if pbar:
             pbar.set_postfix(lr=stats["learning_rate"],
@@ -263,9 +283,9 @@ class NMTEncoderDecoderWrapper(AbstractEncoderDecoderWrapper):
 
         log.print_out(
             "  global step %d lr %g "
-            "step-time %.2fs wps %.2fK ppl %.2f gN %.2f" %
+            "step-time %.2fs wps %.2fK pad %.1f%% ppl %.2f gN %.2f" %
             (global_step, stats["learning_rate"],
-             avg_step_time, speed, train_ppl, avg_grad_norm),
+             avg_step_time, speed, 100 * padding, train_ppl, avg_grad_norm),
             log_f, skip_stdout=True)
 
         # Check for overflow
@@ -276,6 +296,15 @@ class NMTEncoderDecoderWrapper(AbstractEncoderDecoderWrapper):
 
         return train_ppl, speed, is_overflow
 
+    def log_epoch_stats(self, epoch_stats, log_f):
+        """Print the padding ratio of the batches of the epoch (padding tokens over all the tokens)."""
+        if epoch_stats["padded_count"] > 0:
+            log.print_out(
+                "  epoch %d padding ratio %.2f%% (%d tokens, %d with padding)" %
+                (self.config.epoch, 100 * (1.0 - epoch_stats["total_count"] / epoch_stats["padded_count"]),
+                 epoch_stats["total_count"], epoch_stats["padded_count"]),
+                log_f)
+
     def _load_data(self, input_file):
         """Load inference data."""
         with codecs.getreader("utf-8")(
@@ -284,6 +313,15 @@ class NMTEncoderDecoderWrapper(AbstractEncoderDecoderWrapper):
 
         return inference_data
 
+    def _index_data(self, input_file):
+        """
+        Random access to the (stripped) lines of a data file without loading it into memory, unless the file
+        cannot be indexed (i.e., it is on a remote file system or its directory is read-only)
+        """
+        if not is_indexable(input_file):
+            return LoadedLines(self._load_data(input_file))
+        return LineIndex(input_file)
+
     def _decode_and_evaluate(self,
                              model, infer_sess, iterator_feed_dict,
                              num_responses_per_input=1, label="tests"):
@@ -400,6 +438,12 @@ class NMTEncoderDecoderWrapper(AbstractEncoderDecoderWrapper):
         else:
             topic_inferer = None
 
+        words_per_topic = self.config.get('topic_words_per_utterance')
+        if self.config.get('topic_table'):
+            topic_ids = topical_base.topic_ids_by_words(self.config.topic_table, words_per_topic)
+        else:
+            topic_ids = None
+
         infer_model = self._get_model_helper().create_infer_model(self.config, scope)
 
         with tf.Session(
@@ -432,10 +476,15 @@ class NMTEncoderDecoderWrapper(AbstractEncoderDecoderWrapper):
                     _, topic_words = topic_inferer.from_collection(
                         [feedable_context],
                         dialogue_as_doc=True,
-                        words_per_topic=self.config.topic_words_per_utterance)[0]
+                        words_per_topic=words_per_topic)[0]
+                    if topic_ids is None:
+                        topical = " ".join(topic_words)
+                    else:
+                        # with a topic table, the model reads the id of the topic in the table (-1 if unknown)
+                        topical = str(topic_ids.get(tuple(topic_words), -1))
                     iterator_feed_dict = {
                         infer_model.src_placeholder:
-                            [feedable_context + "\t" + " ".join(topic_words)],
+                            [feedable_context + "\t" + topical],
                         infer_model.batch_size_placeholder: 1,
                     }
 
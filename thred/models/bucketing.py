@@ -0,0 +1,131 @@
+""" Token-budget batching of the training data: the bucket boundaries are taken from the quantiles of the example
+    lengths in (a uniform sample of) the training data, so that each bucket holds about the same number of examples,
+    and each bucket is batched by a maximum number of tokens (`batch_tokens`) instead of a fixed number of examples,
+    so that the batches of short examples are larger than the ones of long examples.
+    The length of an example is the length of its longest sequence once padded, i.e., the bucketing key of
+    the iterators.
+"""
+import math
+import random
+
+import numpy as np
+
+from .records import load_metadata
+from ..util import log
+from ..util.line_index import LineIndex
+from ..util.summary_statistics import HistogramSummaryStat
+
+DEFAULT_SAMPLE_SIZE = 100000
+
+
+def example_length(line, num_inputs=None, topical=False, src_max_len=None, tgt_max_len=None):
+    """
+    The length of the example of a line of a data file, split and truncated the same way as the text iterators do.
+    The source utterances are either separate sequences (`num_inputs` of them, as in HRED and THRED) or
+    concatenated with separators into one sequence (num_inputs=None, as in Seq2Seq and TA-Seq2Seq).
+    :return: the length, or None if the line has too few utterances to make an example
+    """
+    fields = [f for f in line.rstrip(b'\r\n').split(b'\t') if f]
+    if topical:
+        fields = fields[:-1]
+    lengths = [len([w for w in field.split(b' ') if w]) for field in fields]
+
+    if num_inputs is None:
+        if len(lengths) < 2:
+            return None
+
+        srcs, tgt = lengths[:-1], lengths[-1]
+        if src_max_len:
+            srcs = [min(l, src_max_len - 1) for l in srcs[:-1]] + [min(srcs[-1], src_max_len)]
+        src_lengths = [sum(srcs) + len(srcs) - 1]
+    else:
+        if len(lengths) <= num_inputs:
+            return None
+
+        src_lengths, tgt = lengths[:num_inputs], lengths[num_inputs]
+
+    if src_max_len:
+        src_lengths = [min(l, src_max_len) for l in src_lengths]
+    if tgt_max_len:
+        tgt = min(tgt, tgt_max_len)
+
+    # the target is padded along with either <sos> or <eos>
+    return max(src_lengths + [tgt + 1])
+
+
+def length_histogram(data_path, sample_size=DEFAULT_SAMPLE_SIZE, random_seed=None, **length_args):
+    """HistogramSummaryStat of the example lengths (see example_length) of a uniform sample of the lines"""
+    with LineIndex(data_path) as line_index:
+        sampled_lines = sorted(line_index.sample(sample_size, random.Random(random_seed)))
+        lengths = [example_length(line_index.raw_line(lno), **length_args) for lno in sampled_lines]
+
+    stat = HistogramSummaryStat()
+    stat.accept_many(np.array([l for l in lengths if l is not None], dtype=np.int64))
+    return stat
+
+
+def bucket_boundaries(length_stat, num_buckets):
+    """
+    Boundaries at the quantiles of the lengths (a bucket holds the lengths in [previous boundary, boundary)),
+    so that the buckets get about the same number of examples. Repeated quantiles are merged.
+    """
+    boundaries = {length_stat.get_percentile(100 * b / num_buckets) + 1 for b in range(1, num_buckets)}
+    return sorted(b for b in boundaries if b <= length_stat.get_max())
+
+
+def bucket_batch_sizes(boundaries, max_length, batch_tokens):
+    """The number of examples per batch of each bucket, so that the longest example of the bucket
+    makes a batch of at most `batch_tokens` tokens per sequence (padding included)"""
+    bucket_max_lengths = [b - 1 for b in boundaries] + [max_length]
+    return [max(1, batch_tokens // max(1, length)) for length in bucket_max_lengths]
+
+
+def steps_per_epoch(length_stat, boundaries, batch_sizes, num_lines, num_sampled_lines):
+    """
+    The estimated number of batches of an epoch over `num_lines` lines, where each bucket gets its share of
+    the examples of `num_sampled_lines` sampled lines (see length_histogram)
+    """
+    bucket_ends = [length_stat.get_count_below(b) for b in boundaries] + [length_stat.get_count()]
+    bucket_counts = np.diff([0] + bucket_ends)
+    return sum(int(math.ceil(count * num_lines / num_sampled_lines / batch_size))
+               for count, batch_size in zip(bucket_counts, batch_sizes))
+
+
+def train_buckets(hparams, num_inputs=None, topical=False):
+    """
+    The bucket boundaries and batch sizes of the training iterators when `hparams.batch_tokens` is set,
+    and (None, None) otherwise (i.e., fixed-width buckets of `hparams.batch_size` examples).
+    With `batch_tokens`, `hparams.num_train_steps` is also set from the estimated number of batches per epoch,
+    since an epoch is no longer `batch_size` examples per step.
+    """
+    if not hparams.get('batch_tokens'):
+        return None, None
+
+    data_path = hparams.get('train_data')
+    if not data_path and hparams.get('train_records'):
+        data_path = load_metadata(hparams.train_records)['data']
+
+    with LineIndex(data_path) as line_index:
+        num_lines = len(line_index)
+
+    sample_size = min(DEFAULT_SAMPLE_SIZE, num_lines)
+    length_stat = length_histogram(data_path, sample_size, num_inputs=num_inputs, topical=topical,
+                                   src_max_len=hparams.src_max_len, tgt_max_len=hparams.tgt_max_len)
+    if not length_stat.get_count():
+        raise ValueError('No examples found in the training data: {}'.format(data_path))
+
+    if hparams.src_max_len and hparams.tgt_max_len:
+        max_length = max(hparams.src_max_len, hparams.tgt_max_len + 1)
+    else:
+        max_length = length_stat.get_max()
+
+    boundaries = bucket_boundaries(length_stat, hparams.num_buckets)
+    batch_sizes = bucket_batch_sizes(boundaries, max_length, hparams.batch_tokens)
+    epoch_steps = steps_per_epoch(length_stat, boundaries, batch_sizes, num_lines, sample_size)
+    hparams['num_train_steps'] = int(hparams.num_train_epochs * epoch_steps)
+    log.print_out("  bucketing %d sampled examples (length median %g, p90 %d, max %d): "
+                  "boundaries %s, batch sizes %s, ~%d steps per epoch" %
+                  (length_stat.get_count(), length_stat.get_median(), length_stat.get_percentile(90),
+                   length_stat.get_max(), boundaries, batch_sizes, epoch_steps))
+
+    return boundaries, batch_sizes
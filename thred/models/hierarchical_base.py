@@ -2,7 +2,6 @@ import os
 import time
 
 import math
-import numpy as np
 import tensorflow as tf
 from tqdm import trange
 
@@ -32,14 +31,17 @@ class BaseHierarchicalEncoderDecoder(NMTEncoderDecoderWrapper):
 
         self._pre_model_creation()
 
+        graph_sw = Stopwatch()
         train_model = _helper.create_train_model(self.config, scope)
         eval_model = _helper.create_eval_model(self.config, scope)
         infer_model = _helper.create_infer_model(self.config, scope)
+        model_helper.log_graph_stats(graph_sw.elapsed(), train=train_model.graph, eval=eval_model.graph,
+                                     infer=infer_model.graph)
 
         self._post_model_creation(train_model, eval_model, infer_model)
 
         # Preload data for sample decoding.
-        eval_data = self._load_data(self.config.dev_data)
+        eval_data = self._index_data(self.config.dev_data)
         self.config.dev_size = math.ceil(len(eval_data) / self.config.batch_size)
 
         summary_name = "train_log"
@@ -76,11 +78,12 @@ class BaseHierarchicalEncoderDecoder(NMTEncoderDecoderWrapper):
         patience = self.config.patience
 
         stats = self.init_stats()
+        epoch_stats = self.init_epoch_stats()
         speed, train_ppl = 0.0, 0.0
         start_train_time = time.time()
 
-        # Initialize all of the iterators
-        skip_count = self.config.batch_size * self.config.epoch_step
+        # Initialize all of the iterators, unless the position of the training iterator is restored from the checkpoint
+        skip_count = 0 if loaded_train_model.iterator_restored else self.config.batch_size * self.config.epoch_step
         lr = loaded_train_model.learning_rate.eval(session=train_sess)
         log.print_out(
             "# Starting step {}/{} (skipping {} elements), epoch {}/{}, lr {:f}, {}".format(
@@ -88,9 +91,10 @@ class BaseHierarchicalEncoderDecoder(NMTEncoderDecoderWrapper):
                 self.config.epoch, self.config.num_train_epochs, lr, time.ctime()),
             log_f)
 
-        train_sess.run(
-            train_model.iterator.initializer,
-            feed_dict={train_model.skip_count_placeholder: skip_count})
+        if not loaded_train_model.iterator_restored:
+            train_sess.run(
+                train_model.iterator.initializer,
+                feed_dict={train_model.skip_count_placeholder: skip_count})
 
         pbar = trange(self.config.num_train_steps, initial=global_step)
         pbar.set_postfix(lr=lr, wps='0K', ppl='inf', gN='inf', best_dev_ppl=self.config.best_dev_ppl)
@@ -113,6 +117,9 @@ class BaseHierarchicalEncoderDecoder(NMTEncoderDecoderWrapper):
                     "## Done epoch {} in {} steps. step {} @ eval time: {}s".format(
                         self.config.epoch, self.config.epoch_step, global_step, sw.elapsed()))
 
+                self.log_epoch_stats(epoch_stats, log_f)
+                epoch_stats = self.init_epoch_stats()
+
                 self.config.epoch += 1
                 self.config.epoch_step = 0
                 self.config.save()
@@ -124,7 +131,7 @@ class BaseHierarchicalEncoderDecoder(NMTEncoderDecoderWrapper):
                 continue
 
             # Write step summary and accumulate statistics
-            global_step = self.update_stats(stats, summary_writer, start_time, step_result)
+            global_step = self.update_stats(stats, summary_writer, start_time, step_result, epoch_stats)
 
             # Once in a while, we print statistics.
             if global_step - last_stats_step >= steps_per_stats:
@@ -229,7 +236,7 @@ class BaseHierarchicalEncoderDecoder(NMTEncoderDecoderWrapper):
     def _sample_decode(self,
                        model, global_step, sess, src_placeholder, batch_size_placeholder, eval_data, summary_writer):
         """Pick a sentence and decode."""
-        decode_ids = np.random.randint(low=0, high=len(eval_data) - 1, size=1)
+        decode_ids = eval_data.sample(1)
 
         sample_data = []
         for decode_id in decode_ids:
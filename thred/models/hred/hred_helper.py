@@ -1,5 +1,6 @@
 import tensorflow as tf
 
+from thred.models import bucketing, records
 from thred.models.model_helper import TrainModel, EvalModel, InferModel
 from thred.models.hred import hred_iterators
 from thred.models.hred.hred_model import HierarchichalSeq2SeqModel
@@ -16,8 +17,9 @@ def create_train_model(hparams, scope=None, num_workers=1, jobid=0):
     with graph.as_default(), tf.container(scope or "train"):
         vocab_table = vocab.create_vocab_table(hparams.vocab_file)
 
-        dataset = tf.data.TextLineDataset(hparams.train_data)
+        dataset, from_records, buffer_size = records.create_train_dataset(hparams)
         skip_count_placeholder = tf.placeholder(shape=(), dtype=tf.int64)
+        bucket_boundaries, bucket_batch_sizes = bucketing.train_buckets(hparams, hparams.num_turns - 1)
 
         iterator = hred_iterators.get_iterator(
             dataset,
@@ -29,7 +31,12 @@ def create_train_model(hparams, scope=None, num_workers=1, jobid=0):
             hparams.tgt_max_len,
             skip_count=skip_count_placeholder,
             num_shards=num_workers,
-            shard_index=jobid)
+            shard_index=jobid,
+            output_buffer_size=buffer_size,
+            from_records=from_records,
+            saveable=from_records,
+            bucket_boundaries=bucket_boundaries,
+            bucket_batch_sizes=bucket_batch_sizes)
 
         # Note: One can set model_device_fn to
         # `tf.train.replica_device_setter(ps_tasks)` for distributed training.
@@ -98,7 +105,8 @@ def create_eval_model(hparams, scope=None):
             hparams.num_turns,
             hparams.num_buckets,
             hparams.src_max_len,
-            hparams.tgt_max_len)
+            hparams.tgt_max_len,
+            output_buffer_size=hparams.batch_size * records.SHUFFLED_BUFFER_BATCHES)
 
         model = HierarchichalSeq2SeqModel(mode=tf.contrib.learn.ModeKeys.EVAL,
                                           iterator=iterator,
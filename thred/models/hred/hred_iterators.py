@@ -1,6 +1,7 @@
 import tensorflow as tf
 
-from thred.models.model_helper import BatchedInput
+from thred.models import records
+from thred.models.model_helper import BatchedInput, save_iterator_state
 from thred.util import vocab
 
 
@@ -16,7 +17,18 @@ def get_iterator(dataset,
                  output_buffer_size=None,
                  skip_count=None,
                  num_shards=1,
-                 shard_index=0):
+                 shard_index=0,
+                 from_records=False,
+                 saveable=False,
+                 bucket_boundaries=None,
+                 bucket_batch_sizes=None):
+    """With `from_records`, the dataset holds serialized Examples of pre-tokenized data (see records.create_dataset).
+    With `saveable`, the position of the iterator is saved in the checkpoints (the dataset has to be serializable,
+    so it does not work with the vocab table lookups of text data).
+    With `bucket_batch_sizes` (see bucketing.train_buckets), the examples are bucketed by their length at
+    `bucket_boundaries` (possibly none, i.e., a single bucket) and the batches of each bucket hold
+    `bucket_batch_sizes[bucket]` examples instead of `batch_size`.
+    """
     num_inputs = num_turns - 1
 
     if not output_buffer_size:
@@ -31,6 +43,20 @@ def get_iterator(dataset,
 
     src_tgt_dataset = src_tgt_dataset.shuffle(output_buffer_size, random_seed)
 
+    def _to_mapped_data(srcs, tgt):
+        tgt_out = tf.concat((tgt, [eos_id]), 0)
+        mapped_data = {
+            'tgt_in': tf.concat(([sos_id], tgt), 0),
+            'tgt_out': tgt_out,
+            'tgt_len': tf.size(tgt_out)
+        }
+
+        for t in range(num_inputs):
+            mapped_data['src_%d' % t] = srcs[t]
+            mapped_data['src_len_%d' % t] = tf.size(srcs[t])
+
+        return mapped_data
+
     def _tokenize_lambda(line):
         utterances = tf.string_split([line], delimiter="\t").values
 
@@ -46,29 +72,31 @@ def get_iterator(dataset,
 
         return tokenized_data
 
-    src_tgt_dataset = src_tgt_dataset.map(
-        _tokenize_lambda,
-        num_parallel_calls=num_parallel_calls).prefetch(output_buffer_size)
-
     def _lookup_lambda(data):
         tgt = tf.cast(vocab_table.lookup(data['tgt']), tf.int32)
-        tgt_out = tf.concat((tgt, [eos_id]), 0)
-        mapped_data = {
-            'tgt_in': tf.concat(([sos_id], tgt), 0),
-            'tgt_out': tgt_out,
-            'tgt_len': tf.size(tgt_out)
-        }
+        srcs = [tf.cast(vocab_table.lookup(data['src_%d' % t]), tf.int32) for t in range(num_inputs)]
+        return _to_mapped_data(srcs, tgt)
 
-        for t in range(num_inputs):
-            src = tf.cast(vocab_table.lookup(data['src_%d' % t]), tf.int32)
-            mapped_data['src_%d' % t] = src
-            mapped_data['src_len_%d' % t] = tf.size(src)
+    def _parse_lambda(serialized):
+        example = records.parse_example(serialized)
+        srcs = [records.utterance(example, t) for t in range(num_inputs)]
+        tgt = records.utterance(example, num_inputs)
 
-        return mapped_data
+        return _to_mapped_data([src[:src_max_len] if src_max_len else src for src in srcs],
+                               tgt[:tgt_max_len] if tgt_max_len else tgt)
 
-    src_tgt_dataset = src_tgt_dataset.map(
-        _lookup_lambda,
-        num_parallel_calls=num_parallel_calls).prefetch(output_buffer_size)
+    if from_records:
+        src_tgt_dataset = src_tgt_dataset.map(
+            _parse_lambda,
+            num_parallel_calls=num_parallel_calls).prefetch(output_buffer_size)
+    else:
+        src_tgt_dataset = src_tgt_dataset.map(
+            _tokenize_lambda,
+            num_parallel_calls=num_parallel_calls).prefetch(output_buffer_size)
+
+        src_tgt_dataset = src_tgt_dataset.map(
+            _lookup_lambda,
+            num_parallel_calls=num_parallel_calls).prefetch(output_buffer_size)
     # Create a tgt_input prefixed with <sos> and a tgt_output suffixed with <eos>.
 
     # Add in sequence lengths.
@@ -104,7 +132,19 @@ def get_iterator(dataset,
             # later on we will be masking out calculations past the true sequence.
             padding_values=padded_values)
 
-    if num_buckets > 1:
+    if bucket_batch_sizes is not None:
+        def length_func(data):
+            length = data['tgt_len']
+            for t in range(num_inputs):
+                length = tf.maximum(data['src_len_%d' % t], length)
+            return length
+
+        batched_dataset = src_tgt_dataset.apply(
+            tf.contrib.data.bucket_by_sequence_length(
+                length_func, bucket_boundaries, bucket_batch_sizes,
+                padded_shapes=padded_shapes, padding_values=padded_values))
+
+    elif num_buckets > 1:
         def key_func(data):
             # Calculate bucket_width by maximum source sequence length.
             # Pairs with length [0, bucket_width) go to bucket 0, length
@@ -136,6 +176,8 @@ def get_iterator(dataset,
         batched_dataset = _batching_lambda(src_tgt_dataset)
 
     batched_iter = batched_dataset.make_initializable_iterator()
+    if saveable:
+        save_iterator_state(batched_iter)
     batched_data = batched_iter.get_next()
 
     return BatchedInput(
@@ -1,4 +1,5 @@
 import collections
+import resource
 import time
 
 from tqdm import tqdm, trange
@@ -52,10 +53,48 @@ def get_config_proto(log_device_placement):
         gpu_options=tf.GPUOptions(allow_growth=True))
 
 
+def init_frozen_embeddings(model, session):
+    if getattr(model, 'frozen_embeddings_initializer', None) is not None:
+        session.run(model.frozen_embeddings_initializer, feed_dict=model.frozen_embeddings_feed)
+
+
+def log_graph_stats(build_time, **graphs):
+    """Logs the build time and the GraphDef sizes of the graphs along with the peak RSS of the process"""
+    graph_sizes = ", ".join("%s %.1fMB" % (name, graph.as_graph_def().ByteSize() / (1 << 20))
+                            for name, graph in graphs.items())
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1 << 10)
+    log.print_out("  graphs built in %.2fs, GraphDef %s, peak RSS %.0fMB" % (build_time, graph_sizes, peak_rss))
+
+
+def save_iterator_state(iterator):
+    """
+    Makes the savers of the models built in the same graph checkpoint the position of `iterator`,
+    so training resumes where it stopped instead of skipping the consumed elements.
+    The dataset must be serializable (e.g., it cannot capture lookup tables).
+    """
+    tf.add_to_collection(tf.GraphKeys.SAVEABLE_OBJECTS, tf.contrib.data.make_saveable_from_iterator(iterator))
+
+
+def saveable_objects():
+    """The variables and the iterator states (see save_iterator_state) of the default graph"""
+    return tf.global_variables() + tf.get_collection(tf.GraphKeys.SAVEABLE_OBJECTS)
+
+
 def load_model(model, ckpt, session, name):
     start_time = time.time()
-    model.saver.restore(session, ckpt)
+    try:
+        model.saver.restore(session, ckpt)
+        model.iterator_restored = bool(session.graph.get_collection(tf.GraphKeys.SAVEABLE_OBJECTS))
+    except tf.errors.NotFoundError:
+        if not session.graph.get_collection(tf.GraphKeys.SAVEABLE_OBJECTS):
+            raise
+        # checkpoints written before the iterator state was saved only hold the variables
+        log.print_out("  no iterator state in %s, the iterator has to skip the consumed elements" % ckpt)
+        with session.graph.as_default():
+            tf.train.Saver(tf.global_variables()).restore(session, ckpt)
+        model.iterator_restored = False
     session.run(tf.tables_initializer())
+    init_frozen_embeddings(model, session)
     log.print_out(
         "  loaded %s model parameters from %s, time %.2fs" %
         (name, ckpt, time.time() - start_time))
@@ -72,6 +111,8 @@ def create_or_load_model(model, model_dir, session, name):
         start_time = time.time()
         session.run(tf.global_variables_initializer())
         session.run(tf.tables_initializer())
+        init_frozen_embeddings(model, session)
+        model.iterator_restored = False
         log.print_out("  created %s model with fresh parameters, time %.2fs" %
                       (name, time.time() - start_time))
 
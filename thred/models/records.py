@@ -0,0 +1,356 @@
+""" Pre-tokenized training data: the lines of a data file are encoded once as vocab ids into sharded TFRecord files
+    (`<prefix>-<shard>-of-<#shards>.tfrecord`), so that the training iterators skip splitting and looking up
+    the words in every epoch. Each record is an Example holding the ids of all the utterances back to back (`ids`),
+    the length of each utterance (`lengths`) and, for topical data, the ids of the topic words (`topic`).
+    Truncation (e.g., src_max_len) is left to the iterators, so the records do not depend on the model config.
+    The metadata of the shards, including a digest of the vocab file they are encoded with, is kept in
+    `<prefix>.meta.yml`.
+    The lines are globally shuffled across the shards by default, so that the iterators only need to shuffle the order
+    of the shards and a small window of examples instead of holding a large buffer of lines.
+"""
+import hashlib
+import logging
+import multiprocessing
+import os
+
+import numpy as np
+import tensorflow as tf
+import yaml
+
+from .topical_base import load_topic_table
+from ..util import fs, vocab
+from ..util.line_index import LineIndex
+from ..util.misc import Stopwatch
+
+logger = logging.getLogger('records')
+
+# size of the buffers (in batches) of the iterators over data that needs no further shuffling
+# (i.e., pre-shuffled shards, or evaluation data)
+SHUFFLED_BUFFER_BATCHES = 16
+
+# size of the buffer (in examples) of each shard read in parallel, which reshuffles the examples within the shards
+# every epoch
+SHARD_BUFFER_SIZE = 1024
+
+# number of lines of a shuffled shard read at a time in the order of the data file
+READ_BLOCK_LINES = 100000
+
+
+def shard_path(prefix, shard, num_shards):
+    return '{}-{:05d}-of-{:05d}.tfrecord'.format(prefix, shard, num_shards)
+
+
+def meta_path(prefix):
+    return prefix + '.meta.yml'
+
+
+def _vocab_digest(vocab_file):
+    with open(vocab_file, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def _int64_feature(values):
+    return tf.train.Feature(int64_list=tf.train.Int64List(value=values))
+
+
+def encode_line(line, vocab_ids, topical=False, topics=None):
+    """
+    Encodes a line of a data file as an Example, splitting it exactly the same way as the text iterators do
+    (i.e., empty fields and words are skipped)
+    """
+    fields = [f for f in line.rstrip(b'\r\n').split(b'\t') if f]
+
+    topic_ids = None
+    if topical:
+        if topics is None:
+            topic_ids = [vocab_ids.get(w, vocab.UNK_ID) for w in fields[-1].split(b' ') if w]
+        else:
+            topic_ids = topics[int(fields[-1])]
+        fields = fields[:-1]
+
+    ids, lengths = [], []
+    for utterance in fields:
+        utterance_ids = [vocab_ids.get(w, vocab.UNK_ID) for w in utterance.split(b' ') if w]
+        ids.extend(utterance_ids)
+        lengths.append(len(utterance_ids))
+
+    features = {'ids': _int64_feature(ids), 'lengths': _int64_feature(lengths)}
+    if topical:
+        features['topic'] = _int64_feature(topic_ids)
+
+    return tf.train.Example(features=tf.train.Features(feature=features))
+
+
+_vocab_ids, _topics = None, None
+
+
+def _init_worker(vocab_file, topic_table_path):
+    global _vocab_ids, _topics
+
+    vocab_list, _ = vocab.load_vocab(vocab_file)
+    _vocab_ids = {w.encode('utf-8'): i for i, w in enumerate(vocab_list)}
+
+    _topics = None
+    if topic_table_path:
+        _topics = [[_vocab_ids.get(w.encode('utf-8'), vocab.UNK_ID) for w in topic_words]
+                   for topic_words in load_topic_table(topic_table_path)]
+
+
+def _read_shard_lines(data_path, lines):
+    if isinstance(lines, tuple):
+        yield from fs.read_lines(data_path, *lines)
+    else:
+        # the lines are read block by block in the order of the file, so that the pages of the data file are read
+        # sequentially, and each block is yielded in its shuffled order (the shard is not stored in the file order)
+        with LineIndex(data_path) as line_index:
+            for start in range(0, len(lines), READ_BLOCK_LINES):
+                block = lines[start:start + READ_BLOCK_LINES]
+                block_lines = [None] * len(block)
+                for i in np.argsort(block, kind='stable'):
+                    block_lines[i] = line_index.raw_line(int(block[i]))
+                yield from block_lines
+
+
+def _write_shard(args):
+    data_path, output_path, lines, topical, steps_per_log = args
+
+    lno = 0
+    with tf.python_io.TFRecordWriter(output_path + '.tmp') as writer:
+        for line in _read_shard_lines(data_path, lines):
+            lno += 1
+            if lno % steps_per_log == 0:
+                print("  {} lines encoded into {}".format(lno, output_path))
+
+            writer.write(encode_line(line, _vocab_ids, topical, _topics).SerializeToString())
+
+    os.replace(output_path + '.tmp', output_path)
+    return lno
+
+
+def write_records(data_path, vocab_file, output_prefix, num_shards=16, topical=False, topic_table_path=None,
+                  shuffle=True, random_seed=None, n_workers=None, steps_per_log=1000000):
+    """
+    Encodes the lines of a data file into (at most) `num_shards` TFRecord files
+    :param topical: whether the last field of each line holds the topic words (or a topic id, see topic_table_path)
+    :param topic_table_path: topic table of compact topical data files (see topical_base.load_topic_table)
+    :param shuffle: whether the lines are globally shuffled across the shards (read via random access,
+        see LineIndex); otherwise each shard holds a contiguous byte range of the data file
+    """
+    sw = Stopwatch()
+
+    if shuffle:
+        with LineIndex(data_path) as line_index:
+            permutation = np.random.RandomState(random_seed).permutation(len(line_index))
+        shard_lines = [lines for lines in np.array_split(permutation, min(num_shards, len(permutation))) if len(lines)]
+    else:
+        shard_lines = fs.split_lines(data_path, num_shards)
+
+    paths = [shard_path(output_prefix, shard, len(shard_lines)) for shard in range(len(shard_lines))]
+    jobs = [(data_path, path, lines, topical, steps_per_log) for path, lines in zip(paths, shard_lines)]
+
+    with multiprocessing.Pool(n_workers, initializer=_init_worker,
+                              initargs=(vocab_file, topic_table_path)) as pool:
+        shard_sizes = pool.map(_write_shard, jobs)
+
+    metadata = {
+        'data': os.path.abspath(data_path),
+        'vocab_digest': _vocab_digest(vocab_file),
+        'topical': topical,
+        'shuffled': shuffle,
+        'shards': [os.path.basename(path) for path in paths],
+        'shard_sizes': shard_sizes,
+        'num_examples': sum(shard_sizes),
+    }
+    with open(meta_path(output_prefix), 'w') as meta_file:
+        yaml.safe_dump(metadata, meta_file, default_flow_style=False)
+
+    logger.info('{} examples encoded into {} shards ({}) - time {}'.format(
+        sum(shard_sizes), len(paths), output_prefix, sw.elapsed()))
+
+
+def load_metadata(prefix, vocab_file=None):
+    """Reads the metadata of the shards and verifies they are encoded with `vocab_file` (if given)"""
+    if not os.path.exists(meta_path(prefix)):
+        raise ValueError('TFRecord files not found (run thred-preprocess first): {}'.format(meta_path(prefix)))
+
+    with open(meta_path(prefix), 'r') as meta_file:
+        metadata = yaml.safe_load(meta_file)
+
+    if vocab_file is not None and metadata['vocab_digest'] != _vocab_digest(vocab_file):
+        raise ValueError('The TFRecord files ({}) are encoded with a vocab other than {}'.format(prefix, vocab_file))
+
+    return metadata
+
+
+def create_dataset(prefix, vocab_file=None, num_parallel_reads=16, shard_buffer_size=SHARD_BUFFER_SIZE,
+                   random_seed=None):
+    """
+    Reads the serialized Examples of the shards with parallel interleave (an example of each shard in turn), where
+    the order of the shards is reshuffled whenever the iterator is (re)initialized (i.e., every epoch) and so are
+    the examples of each shard within a window of `shard_buffer_size` examples (0 keeps the order of the shards)
+    """
+    metadata = load_metadata(prefix, vocab_file)
+    shard_dir = os.path.dirname(os.path.abspath(meta_path(prefix)))
+    paths = [os.path.join(shard_dir, shard) for shard in metadata['shards']]
+
+    def read_shard(path):
+        records = tf.data.TFRecordDataset(path)
+        return records.shuffle(shard_buffer_size, random_seed) if shard_buffer_size else records
+
+    return tf.data.Dataset.from_tensor_slices(tf.constant(paths)).shuffle(len(paths), random_seed).apply(
+        tf.contrib.data.parallel_interleave(read_shard, cycle_length=min(num_parallel_reads, len(paths)),
+                                            block_length=1))
+
+
+def create_train_dataset(hparams):
+    """
+    The training data as serialized Examples if the TFRecord files are given (`train_records`), and as lines otherwise
+    :return: the dataset, whether it holds Examples and the size of the shuffle buffer
+        (None for the default of the iterators)
+    """
+    if hparams.get('train_records'):
+        metadata = load_metadata(hparams.train_records)
+        buffer_size = hparams.batch_size * SHUFFLED_BUFFER_BATCHES if metadata.get('shuffled') else None
+        return create_dataset(hparams.train_records, hparams.vocab_file), True, buffer_size
+
+    return tf.data.TextLineDataset(hparams.train_data), False, None
+
+
+def parse_example(serialized, topical=False):
+    features = {
+        'ids': tf.FixedLenSequenceFeature([], tf.int64, allow_missing=True),
+        'lengths': tf.FixedLenSequenceFeature([], tf.int64, allow_missing=True),
+    }
+    if topical:
+        features['topic'] = tf.FixedLenSequenceFeature([], tf.int64, allow_missing=True)
+
+    parsed = tf.parse_single_example(serialized, features)
+    example = {
+        'ids': tf.to_int32(parsed['ids']),
+        'lengths': tf.to_int32(parsed['lengths']),
+    }
+    example['offsets'] = tf.cumsum(example['lengths'], exclusive=True)
+    if topical:
+        example['topic'] = tf.to_int32(parsed['topic'])
+
+    return example
+
+
+def num_utterances(example):
+    return tf.size(example['lengths'])
+
+
+def utterance(example, t):
+    """Ids of the t-th utterance of a parsed example (t may be a tensor)"""
+    start = example['offsets'][t]
+    return example['ids'][start:start + example['lengths'][t]]
+
+
+def concat_sources(example, num_sources, src_max_len=None):
+    """
+    Ids of the first `num_sources` utterances joined by <SEP>, where each utterance but the last one is truncated to
+    src_max_len - 1 words and the last one to src_max_len words (the same as the text iterators of the flat models)
+    """
+    def loop_body(i, src):
+        words = utterance(example, i)
+        is_last = tf.equal(i, num_sources - 1)
+        if src_max_len:
+            words = tf.cond(is_last, lambda: words[:src_max_len], lambda: words[:src_max_len - 1])
+
+        words = tf.cond(is_last, lambda: words, lambda: tf.concat([words, [vocab.SEP_ID]], axis=0))
+        return tf.add(i, 1), tf.concat([src, words], axis=0)
+
+    _, src = tf.while_loop(lambda i, _: tf.less(i, num_sources), loop_body,
+                           [tf.constant(0), tf.zeros([0], dtype=tf.int32)],
+                           shape_invariants=[tf.TensorShape([]), tf.TensorShape([None])])
+    return src
+
+
+def benchmark(data_path, prefix, vocab_file, num_turns, topical=False, topic_table_path=None, batch_size=128,
+              num_batches=1000):
+    """Compares the examples/sec of the training input pipeline over the lines of a data file and its TFRecord files"""
+    from .hred import hred_iterators
+    from .thred import thred_iterators
+    from .topical_base import create_topic_table
+
+    def examples_per_sec(from_records):
+        with tf.Graph().as_default():
+            vocab_table = vocab.create_vocab_table(vocab_file)
+            buffer_size = None
+            if from_records:
+                dataset = create_dataset(prefix, vocab_file)
+                if load_metadata(prefix).get('shuffled'):
+                    buffer_size = batch_size * SHUFFLED_BUFFER_BATCHES
+            else:
+                dataset = tf.data.TextLineDataset(data_path)
+
+            if topical:
+                iterator = thred_iterators.get_iterator(dataset, vocab_table, batch_size, num_turns, num_buckets=1,
+                                                        output_buffer_size=buffer_size,
+                                                        topic_table=create_topic_table(topic_table_path, vocab_table),
+                                                        from_records=from_records)
+            else:
+                iterator = hred_iterators.get_iterator(dataset, vocab_table, batch_size, num_turns, num_buckets=1,
+                                                       output_buffer_size=buffer_size, from_records=from_records)
+
+            with tf.Session() as sess:
+                sess.run(tf.tables_initializer())
+                sess.run(iterator.initializer)
+                # the first batch fills the shuffle buffer
+                sess.run(iterator.target_sequence_length)
+
+                sw = Stopwatch()
+                n_examples = 0
+                for _ in range(num_batches):
+                    try:
+                        n_examples += len(sess.run(iterator.target_sequence_length))
+                    except tf.errors.OutOfRangeError:
+                        break
+
+                return n_examples / max(sw.elapsed(), 1e-9)
+
+    text_rate = examples_per_sec(from_records=False)
+    records_rate = examples_per_sec(from_records=True)
+    print('{} batches of {} - text {:.0f} examples/sec | TFRecord {:.0f} examples/sec | speedup {:.1f}x'.format(
+        num_batches, batch_size, text_rate, records_rate, records_rate / max(text_rate, 1e-9)))
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='encodes a data file into sharded TFRecord files of vocab ids')
+    parser.add_argument('-d', '--data', type=str, required=True, help='data file (e.g., the training data)')
+    parser.add_argument('-v', '--vocab', type=str, required=True,
+                        help='vocab file of the model (i.e., vocab*.in in the model directory)')
+    parser.add_argument('-o', '--output', type=str,
+                        help='prefix of the TFRecord files (default: the data file without extension)')
+    parser.add_argument('--num_shards', type=int, default=16, help='number of TFRecord files')
+    parser.add_argument('--topical', action='store_true',
+                        help='whether the last field of each line holds the topic words (THRED and TA-Seq2Seq)')
+    parser.add_argument('--topic_table', type=str, help='topic table of compact topical data files')
+    parser.add_argument('--keep_order', action='store_true',
+                        help='write contiguous ranges of lines into the shards instead of globally shuffled lines')
+    parser.add_argument('--seed', type=int, help='random seed of the shuffle')
+    parser.add_argument('--n_workers', type=int, help='number of processes (default: number of CPUs)')
+    parser.add_argument('--benchmark_batches', type=int, default=0,
+                        help='instead of encoding, compares the input pipelines over the data file and '
+                             'the TFRecord files on the given number of batches')
+    parser.add_argument('--num_turns', type=int, default=3, help='number of turns (for the benchmark)')
+    parser.add_argument('--batch_size', type=int, default=128, help='batch size (for the benchmark)')
+    args = parser.parse_args()
+
+    output_prefix = args.output or os.path.splitext(args.data)[0]
+    topical = args.topical or args.topic_table is not None
+    if args.benchmark_batches > 0:
+        benchmark(args.data, output_prefix, args.vocab, args.num_turns, topical, args.topic_table, args.batch_size,
+                  args.benchmark_batches)
+    else:
+        write_records(args.data, args.vocab, output_prefix, args.num_shards, topical, args.topic_table,
+                      not args.keep_order, args.seed, args.n_workers)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                        datefmt='%m/%d/%Y %H:%M:%S',
+                        level=logging.INFO)
+    main()
@@ -1,6 +1,8 @@
 import tensorflow as tf
 
+from .. import bucketing, records
 from ..model_helper import TrainModel, EvalModel, InferModel
+from ..topical_base import create_topic_table
 from .thred_iterators import get_iterator, get_infer_iterator
 from .thred_model import TopicAwareHierarchicalSeq2SeqModel
 from thred.util import vocab
@@ -15,9 +17,11 @@ def create_train_model(hparams, scope=None, num_workers=1, jobid=0):
 
     with graph.as_default(), tf.container(scope or "train"):
         vocab_table = vocab.create_vocab_table(hparams.vocab_file)
+        topic_table = create_topic_table(hparams.get('topic_table'), vocab_table, hparams.topic_words_per_utterance)
 
-        dataset = tf.data.TextLineDataset(hparams.train_data)
+        dataset, from_records, buffer_size = records.create_train_dataset(hparams)
         skip_count_placeholder = tf.placeholder(shape=(), dtype=tf.int64)
+        bucket_boundaries, bucket_batch_sizes = bucketing.train_buckets(hparams, hparams.num_turns - 1, topical=True)
 
         iterator = get_iterator(
             dataset,
@@ -30,7 +34,13 @@ def create_train_model(hparams, scope=None, num_workers=1, jobid=0):
             hparams.tgt_max_len,
             skip_count=skip_count_placeholder,
             num_shards=num_workers,
-            shard_index=jobid)
+            shard_index=jobid,
+            topic_table=topic_table,
+            output_buffer_size=buffer_size,
+            from_records=from_records,
+            saveable=from_records,
+            bucket_boundaries=bucket_boundaries,
+            bucket_batch_sizes=bucket_batch_sizes)
 
         # Note: One can set model_device_fn to
         # `tf.train.replica_device_setter(ps_tasks)` for distributed training.
@@ -56,6 +66,7 @@ def create_pretrain_model(hparams, scope=None, num_workers=1, jobid=0):
 
     with graph.as_default(), tf.container(scope or "pretrain"):
         vocab_table = vocab.create_vocab_table(hparams.vocab_file)
+        topic_table = create_topic_table(hparams.get('topic_table'), vocab_table, hparams.topic_words_per_utterance)
 
         iterator = get_iterator(
             hparams.pretrain_data,
@@ -67,7 +78,8 @@ def create_pretrain_model(hparams, scope=None, num_workers=1, jobid=0):
             hparams.src_max_len,
             hparams.tgt_max_len,
             num_shards=num_workers,
-            shard_index=jobid)
+            shard_index=jobid,
+            topic_table=topic_table)
 
         model = TopicAwareHierarchicalSeq2SeqModel(
             mode=tf.contrib.learn.ModeKeys.TRAIN,
@@ -91,6 +103,7 @@ def create_eval_model(hparams, scope=None):
 
     with graph.as_default(), tf.container(scope or "eval"):
         vocab_table = vocab.create_vocab_table(hparams.vocab_file)
+        topic_table = create_topic_table(hparams.get('topic_table'), vocab_table, hparams.topic_words_per_utterance)
         eval_file_placeholder = tf.placeholder(shape=(), dtype=tf.string)
 
         eval_dataset = tf.data.TextLineDataset(eval_file_placeholder)
@@ -102,7 +115,9 @@ def create_eval_model(hparams, scope=None):
             hparams.num_buckets,
             hparams.topic_words_per_utterance,
             hparams.src_max_len,
-            hparams.tgt_max_len)
+            hparams.tgt_max_len,
+            topic_table=topic_table,
+            output_buffer_size=hparams.batch_size * records.SHUFFLED_BUFFER_BATCHES)
 
         model = TopicAwareHierarchicalSeq2SeqModel(
             mode=tf.contrib.learn.ModeKeys.EVAL,
@@ -125,6 +140,7 @@ def create_infer_model(hparams, scope=None):
 
     with graph.as_default(), tf.container(scope or "infer"):
         vocab_table = vocab.create_vocab_table(hparams.vocab_file)
+        topic_table = create_topic_table(hparams.get('topic_table'), vocab_table, hparams.topic_words_per_utterance)
         reverse_vocab_table = vocab.create_rev_vocab_table(hparams.vocab_file)
 
         src_placeholder = tf.placeholder(shape=[None], dtype=tf.string)
@@ -138,7 +154,8 @@ def create_infer_model(hparams, scope=None):
             batch_size=batch_size_placeholder,
             num_turns=hparams.num_turns,
             topic_words_per_utterance=hparams.topic_words_per_utterance,
-            src_max_len=hparams.src_max_len)
+            src_max_len=hparams.src_max_len,
+            topic_table=topic_table)
 
         model = TopicAwareHierarchicalSeq2SeqModel(
             mode=tf.contrib.learn.ModeKeys.INFER,
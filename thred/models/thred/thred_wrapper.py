@@ -1,7 +1,5 @@
 from os import path
 
-import numpy as np
-
 from thred.util import fs, log
 from thred.util.embed import EmbeddingUtil
 from . import thred_helper
@@ -23,7 +21,8 @@ class TopicalHierarchicalEncoderDecoder(BaseHierarchicalEncoderDecoder):
         self.config['topic_vocab_file'] = path.join(fs.get_current_dir(self.config.vocab_file), 'topic_vocab.in')
         self._vocab_table, self.__topic_vocab_table = topical_base.initialize_vocabulary(self.config)
 
-        EmbeddingUtil(self.config.embed_conf).build_if_not_exists(
+        EmbeddingUtil(self.config.embed_conf, self.config.get('embed_cache_dir'),
+                      self.config.get('embed_cache_size', 20)).build_if_not_exists(
             self.config.embedding_type, self.config.vocab_h5, self.config.vocab_file)
 
         if 'original_vocab_size' not in self.config:
@@ -38,7 +37,7 @@ class TopicalHierarchicalEncoderDecoder(BaseHierarchicalEncoderDecoder):
     def _sample_decode(self,
                        model, global_step, sess, src_placeholder, batch_size_placeholder, eval_data, summary_writer):
         """Pick a sentence and decode."""
-        decode_ids = np.random.randint(low=0, high=len(eval_data) - 1, size=1)
+        decode_ids = eval_data.sample(1)
 
         sample_data = []
         for decode_id in decode_ids:
@@ -1,6 +1,8 @@
 import tensorflow as tf
 
+from .. import bucketing, records
 from ..model_helper import TrainModel, EvalModel, InferModel
+from ..topical_base import create_topic_table
 from . import taware_iterators
 from .taware_model import TopicAwareSeq2SeqModel
 from thred.util import vocab
@@ -8,15 +10,15 @@ from thred.util import vocab
 
 def create_train_model(hparams, scope=None, num_workers=1, jobid=0, extra_args=None):
     """Create train graph, model, and iterator."""
-    train_file = hparams.train_data
-
     graph = tf.Graph()
 
     with graph.as_default(), tf.container(scope or "train"):
         vocab_table = vocab.create_vocab_table(hparams.vocab_file)
+        topic_table = create_topic_table(hparams.get('topic_table'), vocab_table, hparams.topic_words_per_utterance)
 
-        dataset = tf.data.TextLineDataset(train_file)
+        dataset, from_records, buffer_size = records.create_train_dataset(hparams)
         skip_count_placeholder = tf.placeholder(shape=(), dtype=tf.int64)
+        bucket_boundaries, bucket_batch_sizes = bucketing.train_buckets(hparams, topical=True)
 
         iterator = taware_iterators.get_iterator(
             dataset,
@@ -28,7 +30,13 @@ def create_train_model(hparams, scope=None, num_workers=1, jobid=0, extra_args=N
             tgt_max_len=hparams.tgt_max_len,
             skip_count=skip_count_placeholder,
             num_shards=num_workers,
-            shard_index=jobid)
+            shard_index=jobid,
+            topic_table=topic_table,
+            output_buffer_size=buffer_size,
+            from_records=from_records,
+            saveable=from_records,
+            bucket_boundaries=bucket_boundaries,
+            bucket_batch_sizes=bucket_batch_sizes)
 
         # Note: One can set model_device_fn to
         # `tf.train.replica_device_setter(ps_tasks)` for distributed training.
@@ -55,6 +63,7 @@ def create_eval_model(hparams, scope=None):
 
     with graph.as_default(), tf.container(scope or "eval"):
         vocab_table = vocab.create_vocab_table(vocab_file)
+        topic_table = create_topic_table(hparams.get('topic_table'), vocab_table, hparams.topic_words_per_utterance)
         eval_file_placeholder = tf.placeholder(shape=(), dtype=tf.string)
 
         eval_dataset = tf.data.TextLineDataset(eval_file_placeholder)
@@ -65,7 +74,9 @@ def create_eval_model(hparams, scope=None):
             num_buckets=hparams.num_buckets,
             topic_words_per_utterance=hparams.topic_words_per_utterance,
             src_max_len=hparams.src_max_len,
-            tgt_max_len=hparams.tgt_max_len)
+            tgt_max_len=hparams.tgt_max_len,
+            topic_table=topic_table,
+            output_buffer_size=hparams.batch_size * records.SHUFFLED_BUFFER_BATCHES)
         model = TopicAwareSeq2SeqModel(
             mode=tf.contrib.learn.ModeKeys.EVAL,
             iterator=iterator,
@@ -86,6 +97,7 @@ def create_infer_model(hparams, scope=None):
 
     with graph.as_default(), tf.container(scope or "infer"):
         vocab_table = vocab.create_vocab_table(vocab_file)
+        topic_table = create_topic_table(hparams.get('topic_table'), vocab_table, hparams.topic_words_per_utterance)
         reverse_vocab_table = vocab.create_rev_vocab_table(vocab_file)
 
         src_placeholder = tf.placeholder(shape=[None], dtype=tf.string)
@@ -98,7 +110,8 @@ def create_infer_model(hparams, scope=None):
             vocab_table,
             batch_size=batch_size_placeholder,
             topic_words_per_utterance=hparams.topic_words_per_utterance,
-            src_max_len=hparams.src_max_len)
+            src_max_len=hparams.src_max_len,
+            topic_table=topic_table)
         model = TopicAwareSeq2SeqModel(
             mode=tf.contrib.learn.ModeKeys.INFER,
             iterator=iterator,
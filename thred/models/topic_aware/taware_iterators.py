@@ -1,6 +1,8 @@
 import tensorflow as tf
 
-from thred.models.model_helper import TopicalBatchedInput as BatchedInput
+from thred.models import records
+from thred.models.model_helper import TopicalBatchedInput as BatchedInput, save_iterator_state
+from thred.models.topical_base import gather_topic
 from thred.util import vocab
 
 
@@ -16,7 +18,22 @@ def get_iterator(dataset,
                  output_buffer_size=None,
                  skip_count=None,
                  num_shards=1,
-                 shard_index=0):
+                 shard_index=0,
+                 topic_table=None,
+                 from_records=False,
+                 saveable=False,
+                 bucket_boundaries=None,
+                 bucket_batch_sizes=None):
+    """
+    `topic_table` (see topical_base.create_topic_table) is required for compact topical data files
+    in which the last field of each line is a topic id.
+    With `from_records`, the dataset holds serialized Examples of pre-tokenized data (see records.create_dataset).
+    With `saveable`, the position of the iterator is saved in the checkpoints (the dataset has to be serializable,
+    so it does not work with the vocab table lookups of text data).
+    With `bucket_batch_sizes` (see bucketing.train_buckets), the examples are bucketed by their length at
+    `bucket_boundaries` (possibly none, i.e., a single bucket) and the batches of each bucket hold
+    `bucket_batch_sizes[bucket]` examples instead of `batch_size`.
+    """
     if not output_buffer_size:
         output_buffer_size = batch_size * 1000
 
@@ -37,7 +54,7 @@ def get_iterator(dataset,
         #                          delimiter="\t").values
         topics = tf.string_split([delimited_line[-1]]).values
 
-        i, sp = tf.constant(0), tf.Variable([], dtype=tf.string)
+        i, sp = tf.constant(0), tf.constant([], dtype=tf.string)
         cond = lambda i, sp: tf.less(i, tf.size(delimited_line) - 2)
 
         def loop_body(i, sp):
@@ -59,11 +76,24 @@ def get_iterator(dataset,
         tgt = tf.string_split([delimited_line[tf.size(delimited_line) - 2]]).values
         aggregated_src = tf.reduce_join([srcs], axis=0, separator=" ")
 
+        if topic_table is None:
+            topic = topics
+        else:
+            topic = gather_topic(topic_table, delimited_line[-1])
+
         return aggregated_src, \
                tgt[:tgt_max_len] if tgt_max_len else tgt, \
-               tf.string_split([topics[0]]).values
+               topic
+
+    def parse(serialized):
+        example = records.parse_example(serialized, topical=True)
+        tgt = records.utterance(example, records.num_utterances(example) - 1)
+
+        return records.concat_sources(example, records.num_utterances(example) - 1, src_max_len), \
+               tgt[:tgt_max_len] if tgt_max_len else tgt, \
+               example['topic']
 
-    src_tgt_dataset = src_tgt_dataset.map(tokenize,
+    src_tgt_dataset = src_tgt_dataset.map(parse if from_records else tokenize,
                                           num_parallel_calls=num_parallel_calls).prefetch(output_buffer_size)
 
     # Filter zero length input sequences.
@@ -85,11 +115,12 @@ def get_iterator(dataset,
 
     # Convert the word strings to ids.  Word strings that are not in the
     # vocab get the lookup table's default_value integer.
-    src_tgt_dataset = src_tgt_dataset.map(
-        lambda src, tgt, topic: (tf.cast(vocab_table.lookup(src), tf.int32),
-                                 tf.cast(vocab_table.lookup(tgt), tf.int32),
-                                 tf.cast(vocab_table.lookup(topic), tf.int32)),
-        num_parallel_calls=num_parallel_calls).prefetch(output_buffer_size)
+    if not from_records:
+        src_tgt_dataset = src_tgt_dataset.map(
+            lambda src, tgt, topic: (tf.cast(vocab_table.lookup(src), tf.int32),
+                                     tf.cast(vocab_table.lookup(tgt), tf.int32),
+                                     tf.cast(vocab_table.lookup(topic), tf.int32) if topic_table is None else topic),
+            num_parallel_calls=num_parallel_calls).prefetch(output_buffer_size)
     # Create a tgt_input prefixed with <sos> and a tgt_output suffixed with <eos>.
     src_tgt_dataset = src_tgt_dataset.map(
         lambda src, tgt, topic: (src,
@@ -103,34 +134,44 @@ def get_iterator(dataset,
             src, tgt_in, tgt_out, topic, tf.size(src), tf.size(tgt_in), tf.size(topic)),
         num_parallel_calls=num_parallel_calls).prefetch(output_buffer_size)
 
+    # The first four entries are the source, target and topic rows;
+    # these have unknown-length vectors.  The last three entries are
+    # the row sizes; these are scalars.
+    padded_shapes = (
+        tf.TensorShape([None]),  # src
+        tf.TensorShape([None]),  # tgt_input
+        tf.TensorShape([None]),  # tgt_output
+        tf.TensorShape([None]),  # topic
+        tf.TensorShape([]),  # src_len
+        tf.TensorShape([]),  # tgt_len
+        tf.TensorShape([]))  # topic_len
+    # Pad the source and target sequences with eos tokens.
+    # (Though notice we don't generally need to do this since
+    # later on we will be masking out calculations past the true sequence.
+    padding_values = (
+        eos_id,  # src
+        eos_id,  # tgt_input
+        eos_id,  # tgt_output
+        eos_id,  # topic
+        0,  # src_len -- unused
+        0,  # tgt_len -- unused
+        0)  # topic_len -- unused
+
     # Bucket by source sequence length (buckets for lengths 0-9, 10-19, ...)
     def batching_func(x):
-        return x.padded_batch(
-            batch_size,
-            # The first three entries are the source and target line rows;
-            # these have unknown-length vectors.  The last two entries are
-            # the source and target row sizes; these are scalars.
-            padded_shapes=(
-                tf.TensorShape([None]),  # src
-                tf.TensorShape([None]),  # tgt_input
-                tf.TensorShape([None]),  # tgt_output
-                tf.TensorShape([None]),  # topic
-                tf.TensorShape([]),  # src_len
-                tf.TensorShape([]),  # tgt_len
-                tf.TensorShape([])),  # topic_len
-            # Pad the source and target sequences with eos tokens.
-            # (Though notice we don't generally need to do this since
-            # later on we will be masking out calculations past the true sequence.
-            padding_values=(
-                eos_id,  # src
-                eos_id,  # tgt_input
-                eos_id,  # tgt_output
-                eos_id,  # topic
-                0,  # src_len -- unused
-                0,  # tgt_len -- unused
-                0))  # topic_len -- unused
+        return x.padded_batch(batch_size, padded_shapes=padded_shapes, padding_values=padding_values)
 
-    if num_buckets > 1:
+    if bucket_batch_sizes is not None:
+
+        def length_func(src_unused, tgt_in_unused, tgt_out_unused, topic_unused, src_len, tgt_len, topic_len_unused):
+            return tf.maximum(src_len, tgt_len)
+
+        batched_dataset = src_tgt_dataset.apply(
+            tf.contrib.data.bucket_by_sequence_length(
+                length_func, bucket_boundaries, bucket_batch_sizes,
+                padded_shapes=padded_shapes, padding_values=padding_values))
+
+    elif num_buckets > 1:
 
         def key_func(src_unused, tgt_in_unused, tgt_out_unused, topic_unused, src_len, tgt_len, topic_len_unused):
             # Calculate bucket_width by maximum source sequence length.
@@ -157,6 +198,8 @@ def get_iterator(dataset,
     else:
         batched_dataset = batching_func(src_tgt_dataset)
     batched_iter = batched_dataset.make_initializable_iterator()
+    if saveable:
+        save_iterator_state(batched_iter)
     (src_ids, tgt_input_ids, tgt_output_ids, topic_ids,
      src_seq_len, tgt_seq_len, topic_seq_len) = (batched_iter.get_next())
     return BatchedInput(
@@ -174,7 +217,8 @@ def get_infer_iterator(test_dataset,
                        vocab_table,
                        batch_size,
                        topic_words_per_utterance=None,
-                       src_max_len=None):
+                       src_max_len=None,
+                       topic_table=None):
     eos_id = tf.constant(vocab.EOS_ID, dtype=tf.int32)
 
     def tokenize(line):
@@ -185,7 +229,7 @@ def get_infer_iterator(test_dataset,
         #                          delimiter="\t").values
         topics = tf.string_split([delimited_line[-1]]).values
 
-        i, sp = tf.constant(0), tf.Variable([], dtype=tf.string)
+        i, sp = tf.constant(0), tf.constant([], dtype=tf.string)
         cond = lambda i, sp: tf.less(i, tf.size(delimited_line) - 2)
 
         def loop_body(i, sp):
@@ -205,7 +249,12 @@ def get_infer_iterator(test_dataset,
         _, srcs = tf.while_loop(cond, loop_body, [i, sp], shape_invariants=[i.get_shape(), tf.TensorShape([None])])
         aggregated_src = tf.reduce_join([srcs], axis=0, separator=" ")
 
-        return aggregated_src, tf.string_split([topics[0]]).values
+        if topic_table is None:
+            topic = topics
+        else:
+            topic = gather_topic(topic_table, delimited_line[-1])
+
+        return aggregated_src, topic
 
     test_dataset = test_dataset.map(tokenize)
 
@@ -216,8 +265,9 @@ def get_infer_iterator(test_dataset,
         test_dataset = test_dataset.map(
             lambda src, topic: (src, topic[:topic_words_per_utterance]))
     # Convert the word strings to ids
-    test_dataset = test_dataset.map(lambda src, topic: (tf.cast(vocab_table.lookup(src), tf.int32),
-                                                        tf.cast(vocab_table.lookup(topic), tf.int32)))
+    test_dataset = test_dataset.map(
+        lambda src, topic: (tf.cast(vocab_table.lookup(src), tf.int32),
+                            tf.cast(vocab_table.lookup(topic), tf.int32) if topic_table is None else topic))
 
     # Add in the word counts.
     test_dataset = test_dataset.map(lambda src, topic: (src, topic, tf.size(src), tf.size(topic)))
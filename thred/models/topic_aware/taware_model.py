@@ -8,7 +8,7 @@ import tensorflow as tf
 from tensorflow.python.layers import core as layers_core
 from tensorflow.python.ops import variable_scope
 
-from .. import attention_helper
+from .. import attention_helper, model_helper
 from ..base import AbstractModel
 from . import taware_layer, taware_decoder
 from thred.util import log, vocab, rnn_factory
@@ -87,6 +87,8 @@ class TopicAwareSeq2SeqModel(AbstractModel):
                 self.train_loss = loss
                 self.word_count = tf.reduce_sum(self.iterator.source_sequence_lengths) + \
                                   tf.reduce_sum(self.iterator.target_sequence_length)
+                # the number of tokens including padding, to compute the padding ratio of the batches
+                self.padded_count = tf.size(self.iterator.sources) + tf.size(self.iterator.target_input)
             elif mode == tf.contrib.learn.ModeKeys.EVAL:
                 self.eval_loss = loss
             elif mode == tf.contrib.learn.ModeKeys.INFER:
@@ -142,7 +144,7 @@ class TopicAwareSeq2SeqModel(AbstractModel):
                 self.infer_summary = tf.no_op()
 
             # Saver
-            self.saver = tf.train.Saver(tf.global_variables(), max_to_keep=3)
+            self.saver = tf.train.Saver(model_helper.saveable_objects(), max_to_keep=3)
 
             # Print trainable variables
             if log_trainables:
@@ -388,7 +390,8 @@ class TopicAwareSeq2SeqModel(AbstractModel):
                          self.word_count,
                          self.batch_size,
                          self.grad_norm,
-                         self.learning_rate])
+                         self.learning_rate,
+                         self.padded_count])
 
     def eval(self, sess):
         assert self.mode == tf.contrib.learn.ModeKeys.EVAL
@@ -1,5 +1,4 @@
 import os
-import random
 import time
 
 import math
@@ -32,7 +31,8 @@ class TopicAwareNMTEncoderDecoder(NMTEncoderDecoderWrapper):
         self.config['topic_vocab_file'] = os.path.join(fs.split3(self.config.vocab_file)[0], 'topic_vocab.in')
         self._vocab_table, self.__topic_vocab_table = topical_base.initialize_vocabulary(self.config)
 
-        EmbeddingUtil(self.config.embed_conf).build_if_not_exists(
+        EmbeddingUtil(self.config.embed_conf, self.config.get('embed_cache_dir'),
+                      self.config.get('embed_cache_size', 20)).build_if_not_exists(
             self.config.embedding_type, self.config.vocab_h5, self.config.vocab_file)
 
         if 'original_vocab_size' not in self.config:
@@ -52,12 +52,15 @@ class TopicAwareNMTEncoderDecoder(NMTEncoderDecoderWrapper):
 
         self._pre_model_creation()
 
+        graph_sw = Stopwatch()
         train_model = taware_helper.create_train_model(self.config, scope)
         eval_model = taware_helper.create_eval_model(self.config, scope)
         infer_model = taware_helper.create_infer_model(self.config, scope)
+        model_helper.log_graph_stats(graph_sw.elapsed(), train=train_model.graph, eval=eval_model.graph,
+                                     infer=infer_model.graph)
 
         # Preload data for sample decoding.
-        eval_data = self._load_data(self.config.dev_data)
+        eval_data = self._index_data(self.config.dev_data)
         self.config.dev_size = math.ceil(len(eval_data) / self.config.batch_size)
 
         summary_name = "train_log"
@@ -94,13 +97,14 @@ class TopicAwareNMTEncoderDecoder(NMTEncoderDecoderWrapper):
 
         # This is the training loop.
         stats = self.init_stats()
+        epoch_stats = self.init_epoch_stats()
         speed, train_ppl = 0.0, 0.0
         start_train_time = time.time()
 
         self.config.save()
 
-        # Initialize all of the iterators
-        skip_count = self.config.batch_size * self.config.epoch_step
+        # Initialize all of the iterators, unless the position of the training iterator is restored from the checkpoint
+        skip_count = 0 if loaded_train_model.iterator_restored else self.config.batch_size * self.config.epoch_step
         lr = loaded_train_model.learning_rate.eval(session=train_sess)
         log.print_out(
             "# Starting step {}/{} (skipping {} elements), epoch {}/{}, lr {:f}, {}".format(
@@ -108,9 +112,10 @@ class TopicAwareNMTEncoderDecoder(NMTEncoderDecoderWrapper):
                 self.config.epoch, self.config.num_train_epochs, lr, time.ctime()),
             log_f)
 
-        train_sess.run(
-            train_model.iterator.initializer,
-            feed_dict={train_model.skip_count_placeholder: skip_count})
+        if not loaded_train_model.iterator_restored:
+            train_sess.run(
+                train_model.iterator.initializer,
+                feed_dict={train_model.skip_count_placeholder: skip_count})
 
         pbar = trange(self.config.num_train_steps, initial=global_step)
         pbar.set_postfix(lr=lr, wps='0K', ppl='inf', gN='inf', best_dev_ppl=self.config.best_dev_ppl)
@@ -132,6 +137,9 @@ class TopicAwareNMTEncoderDecoder(NMTEncoderDecoderWrapper):
                     "## Done epoch {} in {} steps. step {} @ eval time: {}s".format(
                         self.config.epoch, self.config.epoch_step, global_step, sw.elapsed()))
 
+                self.log_epoch_stats(epoch_stats, log_f)
+                epoch_stats = self.init_epoch_stats()
+
                 self.config.epoch += 1
                 self.config.epoch_step = 0
                 self.config.save()
@@ -143,7 +151,7 @@ class TopicAwareNMTEncoderDecoder(NMTEncoderDecoderWrapper):
                 continue
 
             # Write step summary and accumulate statistics
-            global_step = self.update_stats(stats, summary_writer, start_time, step_result)
+            global_step = self.update_stats(stats, summary_writer, start_time, step_result, epoch_stats)
 
             # Once in a while, we print statistics.
             if global_step - last_stats_step >= steps_per_stats:
@@ -237,7 +245,7 @@ class TopicAwareNMTEncoderDecoder(NMTEncoderDecoderWrapper):
                        iterator_src_placeholder, iterator_batch_size_placeholder,
                        eval_data, summary_writer):
         """Pick a sentence and decode."""
-        decode_id = random.randint(0, len(eval_data) - 1)
+        decode_id = eval_data.sample()[0]
         log.print_out("  # {}".format(decode_id))
 
         sample_data = eval_data[decode_id]
@@ -1,13 +1,19 @@
 import codecs
+import functools
 import re
+from collections import Counter
 
+import numpy as np
 import tensorflow as tf
 
 from ..util import vocab
 
+NO_TOPIC = '<NO_TOPIC>'
+
 
 def initialize_vocabulary(hparams):
-    _create_vocabulary(hparams.vocab_file, hparams.topic_vocab_file, hparams.train_data, hparams.vocab_size)
+    _create_vocabulary(hparams.vocab_file, hparams.topic_vocab_file, hparams.train_data, hparams.vocab_size,
+                       topic_table_path=hparams.get('topic_table'))
 
     vocab_table = vocab.create_vocab_dict(hparams.vocab_file)
     topic_vocab_table = vocab.create_vocab_dict(hparams.topic_vocab_file)
@@ -18,54 +24,94 @@ def initialize_vocabulary(hparams):
     return vocab_table, topic_vocab_table
 
 
-def _create_vocabulary(vocab_path, topic_vocab_path, data_path, max_vocabulary_size, normalize_digits=False):
-    """A modified version of vocab.create_vocabulary
+def load_topic_table(topic_table_path):
+    """
+    Reads the words of the topics from a topic table file (the i-th line holds the words of topic i),
+    followed by a last row for the lines without a topic (i.e., topic id -1)
     """
+    with codecs.getreader('utf-8')(tf.gfile.GFile(topic_table_path, mode="rb")) as f:
+        topics = [line.split() for line in f]
 
-    if tf.gfile.Exists(vocab_path) and tf.gfile.Exists(topic_vocab_path):
-        return
+    return topics + [[NO_TOPIC]]
 
-    print("Creating vocabulary files from data %s" % data_path)
-    dialog_vocab, topic_vocab = {}, {}
 
-    def normalize(word):
-        if normalize_digits:
-            if re.match(r'[\-+]?\d+(\.\d+)?', word):
-                return '<number>'
+def topic_ids_by_words(topic_table_path, words_per_topic=None):
+    """
+    Maps the (first `words_per_topic`) words of each topic of a topic table to its id. The ids of a table need not
+    follow the topic order of the LDA model (e.g., corpus_toolkit.compact_topics numbers topics by their first
+    appearance), so the topics inferred at serving time are looked up by their words.
+    """
+    topic_ids = {}
+    for t_id, topic_words in enumerate(load_topic_table(topic_table_path)[:-1]):
+        topic_ids.setdefault(tuple(topic_words[:words_per_topic] if words_per_topic else topic_words), t_id)
+    return topic_ids
+
+
+def create_topic_table(topic_table_path, vocab_table, topic_words_per_utterance=None):
+    """
+    Creates the in-graph topic table of compact topical data files, where the last field of each line is
+    a topic id instead of the topic words. The word ids of all the topics are looked up once and laid out
+    in a flat vector along with the offsets of the topics in it.
+    :return: None if no topic table is given (i.e., the topic words are written in the data files)
+    """
+    if not topic_table_path:
+        return None
+
+    topics = load_topic_table(topic_table_path)
+    if topic_words_per_utterance:
+        topics = [topic_words[:topic_words_per_utterance] for topic_words in topics]
+
+    offsets = np.cumsum([0] + [len(topic_words) for topic_words in topics])
+    topic_word_ids = tf.cast(
+        vocab_table.lookup(tf.constant([w for topic_words in topics for w in topic_words], dtype=tf.string)),
+        tf.int32)
+
+    return topic_word_ids, tf.constant(offsets, dtype=tf.int32)
 
-        return word
 
-    with codecs.getreader('utf-8')(
-            tf.gfile.GFile(data_path, mode="rb")) as f:
-        counter = 0
-        for line in f:
-            counter += 1
-            if counter % 100000 == 0:
-                print("  processing line %d" % counter)
+def gather_topic(topic_table, topic_field):
+    """Maps the topic id in the last field of a compact topical line to the word ids of the topic"""
+    topic_word_ids, offsets = topic_table
+    # topic id -1 wraps around to the last row (i.e., no topic)
+    topic_id = tf.floormod(tf.string_to_number(topic_field, out_type=tf.int32), tf.size(offsets) - 1)
+    return topic_word_ids[offsets[topic_id]:offsets[topic_id + 1]]
 
-            delimited_line = line.split("\t")
-            topic_tokens = delimited_line[-1].strip().split()
-            dialog_tokens = " ".join([delimited_line[i].strip() for i in range(len(delimited_line) - 1)]).split()
 
-            for word in dialog_tokens:
-                word = normalize(word)
+def _normalize(word, normalize_digits):
+    if normalize_digits:
+        if re.match(r'[\-+]?\d+(\.\d+)?', word):
+            return '<number>'
 
-                if word in dialog_vocab:
-                    dialog_vocab[word] += 1
-                else:
-                    dialog_vocab[word] = 1
+    return word
+
+
+def _create_vocabulary(vocab_path, topic_vocab_path, data_path, max_vocabulary_size, normalize_digits=False,
+                       topic_table_path=None, n_workers=None):
+    """A modified version of vocab.create_vocabulary
+    """
 
-            for word in topic_tokens:
-                word = normalize(word)
+    if tf.gfile.Exists(vocab_path) and tf.gfile.Exists(topic_vocab_path):
+        return
 
-                if word in topic_vocab:
-                    topic_vocab[word] += 1
-                else:
-                    topic_vocab[word] = 1
+    print("Creating vocabulary files from data %s" % data_path)
+    normalize = functools.partial(_normalize, normalize_digits=normalize_digits)
+
+    # term frequencies are cached next to the data file and shared with vocab.create_vocabulary
+    raw_term_frequencies = vocab.load_term_frequencies(data_path, n_workers=n_workers)
+    term_frequencies = raw_term_frequencies.normalized(normalize) if normalize_digits else raw_term_frequencies
+
+    if topic_table_path:
+        # the last field holds topic ids, whose words are counted once per topic
+        topics = load_topic_table(topic_table_path)
+        topic_vocab = Counter()
+        for topic_id, count in raw_term_frequencies.in_order('last_field'):
+            for word in topics[int(topic_id)]:
+                topic_vocab[normalize(word)] += count
+    else:
+        topic_vocab = Counter(dict(term_frequencies.in_order('last_field')))
 
     for word in topic_vocab:
-        if word in dialog_vocab:
-            topic_vocab[word] += dialog_vocab[word]
+        topic_vocab[word] += term_frequencies.count_of(word, 'dialogue')
 
     topic_vocab_list = sorted(topic_vocab, key=topic_vocab.get, reverse=True)
     with codecs.getwriter('utf-8')(
@@ -73,18 +119,15 @@ def _create_vocabulary(vocab_path, topic_vocab_path, data_path, max_vocabulary_s
         for w in topic_vocab_list:
             topic_vocab_file.write(w + "\n")
 
-    for reserved_word in vocab.RESERVED_WORDS:
-        if reserved_word in dialog_vocab:
-            dialog_vocab.pop(reserved_word)
-
-    dialog_vocab_list = vocab.RESERVED_WORDS + sorted(dialog_vocab, key=dialog_vocab.get, reverse=True)
+    most_common = term_frequencies.most_common(max_vocabulary_size - len(vocab.RESERVED_WORDS), 'dialogue',
+                                               exclude=vocab.RESERVED_WORDS)
+    dialog_vocab_list = vocab.RESERVED_WORDS + [w for w, _ in most_common]
 
     if len(dialog_vocab_list) > max_vocabulary_size:
         dialog_vocab_list = dialog_vocab_list[:max_vocabulary_size]
 
-    for word in topic_vocab:
-        if word in dialog_vocab_list and word not in vocab.RESERVED_WORDS:
-            dialog_vocab_list.remove(word)
+    topic_words = set(topic_vocab).difference(vocab.RESERVED_WORDS)
+    dialog_vocab_list = [word for word in dialog_vocab_list if word not in topic_words]
 
     with codecs.getwriter('utf-8')(
             tf.gfile.GFile(vocab_path, mode="wb")) as vocab_file:
@@ -98,4 +141,3 @@ def _create_vocabulary(vocab_path, topic_vocab_path, data_path, max_vocabulary_s
     print("Vocabulary with {} words created".format(len(topic_vocab_list)))
 
     del topic_vocab
-    del dialog_vocab
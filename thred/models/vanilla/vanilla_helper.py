@@ -1,5 +1,6 @@
 import tensorflow as tf
 
+from .. import bucketing, records
 from ..model_helper import TrainModel, EvalModel, InferModel
 from . import vanilla_iterators
 from .vanilla_model import VanillaSeq2SeqModel
@@ -8,15 +9,14 @@ from thred.util import vocab
 
 def create_train_model(hparams, scope=None, num_workers=1, jobid=0, extra_args=None):
     """Create train graph, model, and iterator."""
-    train_file = hparams.train_data
-
     graph = tf.Graph()
 
     with graph.as_default(), tf.container(scope or "train"):
         vocab_table = vocab.create_vocab_table(hparams.vocab_file)
 
-        dataset = tf.data.TextLineDataset(train_file)
+        dataset, from_records, buffer_size = records.create_train_dataset(hparams)
         skip_count_placeholder = tf.placeholder(shape=(), dtype=tf.int64)
+        bucket_boundaries, bucket_batch_sizes = bucketing.train_buckets(hparams)
 
         iterator = vanilla_iterators.get_iterator(
             dataset,
@@ -27,7 +27,12 @@ def create_train_model(hparams, scope=None, num_workers=1, jobid=0, extra_args=N
             tgt_max_len=hparams.tgt_max_len,
             skip_count=skip_count_placeholder,
             num_shards=num_workers,
-            shard_index=jobid)
+            shard_index=jobid,
+            output_buffer_size=buffer_size,
+            from_records=from_records,
+            saveable=from_records,
+            bucket_boundaries=bucket_boundaries,
+            bucket_batch_sizes=bucket_batch_sizes)
 
         # Note: One can set model_device_fn to
         # `tf.train.replica_device_setter(ps_tasks)` for distributed training.
@@ -63,7 +68,8 @@ def create_eval_model(hparams, scope=None):
             hparams.batch_size,
             num_buckets=hparams.num_buckets,
             src_max_len=hparams.src_max_len,
-            tgt_max_len=hparams.tgt_max_len)
+            tgt_max_len=hparams.tgt_max_len,
+            output_buffer_size=hparams.batch_size * records.SHUFFLED_BUFFER_BATCHES)
         model = VanillaSeq2SeqModel(
             mode=tf.contrib.learn.ModeKeys.EVAL,
             iterator=iterator,
@@ -1,6 +1,7 @@
 import tensorflow as tf
 
-from ..model_helper import BatchedInput
+from .. import records
+from ..model_helper import BatchedInput, save_iterator_state
 from thred.util import vocab
 
 
@@ -15,7 +16,18 @@ def get_iterator(dataset,
                  output_buffer_size=None,
                  skip_count=None,
                  num_shards=1,
-                 shard_index=0):
+                 shard_index=0,
+                 from_records=False,
+                 saveable=False,
+                 bucket_boundaries=None,
+                 bucket_batch_sizes=None):
+    """With `from_records`, the dataset holds serialized Examples of pre-tokenized data (see records.create_dataset).
+    With `saveable`, the position of the iterator is saved in the checkpoints (the dataset has to be serializable,
+    so it does not work with the vocab table lookups of text data).
+    With `bucket_batch_sizes` (see bucketing.train_buckets), the examples are bucketed by their length at
+    `bucket_boundaries` (possibly none, i.e., a single bucket) and the batches of each bucket hold
+    `bucket_batch_sizes[bucket]` examples instead of `batch_size`.
+    """
     if not output_buffer_size:
         output_buffer_size = batch_size * 1000
 
@@ -30,7 +42,7 @@ def get_iterator(dataset,
 
     def tokenize(line):
         utterances = tf.string_split([line], delimiter="\t").values
-        i, sp = tf.constant(0), tf.Variable([], dtype=tf.string)
+        i, sp = tf.constant(0), tf.constant([], dtype=tf.string)
         cond = lambda i, sp: tf.less(i, tf.size(utterances)-1)
 
         def loop_body(i, sp):
@@ -55,7 +67,14 @@ def get_iterator(dataset,
 
         return aggregated_src, tgt[:tgt_max_len] if tgt_max_len else tgt
 
-    src_tgt_dataset = src_tgt_dataset.map(tokenize,
+    def parse(serialized):
+        example = records.parse_example(serialized)
+        tgt = records.utterance(example, records.num_utterances(example) - 1)
+
+        return records.concat_sources(example, records.num_utterances(example) - 1, src_max_len), \
+               tgt[:tgt_max_len] if tgt_max_len else tgt
+
+    src_tgt_dataset = src_tgt_dataset.map(parse if from_records else tokenize,
                                           num_parallel_calls=num_parallel_calls).prefetch(output_buffer_size)
 
     # Filter zero length input sequences.
@@ -73,10 +92,11 @@ def get_iterator(dataset,
 
     # Convert the word strings to ids.  Word strings that are not in the
     # vocab get the lookup table's default_value integer.
-    src_tgt_dataset = src_tgt_dataset.map(
-        lambda src, tgt: (tf.cast(vocab_table.lookup(src), tf.int32),
-                          tf.cast(vocab_table.lookup(tgt), tf.int32)),
-        num_parallel_calls=num_parallel_calls).prefetch(output_buffer_size)
+    if not from_records:
+        src_tgt_dataset = src_tgt_dataset.map(
+            lambda src, tgt: (tf.cast(vocab_table.lookup(src), tf.int32),
+                              tf.cast(vocab_table.lookup(tgt), tf.int32)),
+            num_parallel_calls=num_parallel_calls).prefetch(output_buffer_size)
     # Create a tgt_input prefixed with <sos> and a tgt_output suffixed with <eos>.
     src_tgt_dataset = src_tgt_dataset.map(
         lambda src, tgt: (src,
@@ -89,30 +109,40 @@ def get_iterator(dataset,
             src, tgt_in, tgt_out, tf.size(src), tf.size(tgt_in)),
         num_parallel_calls=num_parallel_calls).prefetch(output_buffer_size)
 
+    # The first three entries are the source and target line rows;
+    # these have unknown-length vectors.  The last two entries are
+    # the source and target row sizes; these are scalars.
+    padded_shapes = (
+        tf.TensorShape([None]),  # src
+        tf.TensorShape([None]),  # tgt_input
+        tf.TensorShape([None]),  # tgt_output
+        tf.TensorShape([]),  # src_len
+        tf.TensorShape([]))  # tgt_len
+    # Pad the source and target sequences with eos tokens.
+    # (Though notice we don't generally need to do this since
+    # later on we will be masking out calculations past the true sequence.
+    padding_values = (
+        eos_id,  # src
+        eos_id,  # tgt_input
+        eos_id,  # tgt_output
+        0,  # src_len -- unused
+        0)  # tgt_len -- unused
+
     # Bucket by source sequence length (buckets for lengths 0-9, 10-19, ...)
     def batching_func(x):
-        return x.padded_batch(
-            batch_size,
-            # The first three entries are the source and target line rows;
-            # these have unknown-length vectors.  The last two entries are
-            # the source and target row sizes; these are scalars.
-            padded_shapes=(
-                tf.TensorShape([None]),  # src
-                tf.TensorShape([None]),  # tgt_input
-                tf.TensorShape([None]),  # tgt_output
-                tf.TensorShape([]),  # src_len
-                tf.TensorShape([])),  # tgt_len
-            # Pad the source and target sequences with eos tokens.
-            # (Though notice we don't generally need to do this since
-            # later on we will be masking out calculations past the true sequence.
-            padding_values=(
-                eos_id,  # src
-                eos_id,  # tgt_input
-                eos_id,  # tgt_output
-                0,  # src_len -- unused
-                0))  # tgt_len -- unused
+        return x.padded_batch(batch_size, padded_shapes=padded_shapes, padding_values=padding_values)
+
+    if bucket_batch_sizes is not None:
+
+        def length_func(unused_1, unused_2, unused_3, src_len, tgt_len):
+            return tf.maximum(src_len, tgt_len)
+
+        batched_dataset = src_tgt_dataset.apply(
+            tf.contrib.data.bucket_by_sequence_length(
+                length_func, bucket_boundaries, bucket_batch_sizes,
+                padded_shapes=padded_shapes, padding_values=padding_values))
 
-    if num_buckets > 1:
+    elif num_buckets > 1:
 
         def key_func(unused_1, unused_2, unused_3, src_len, tgt_len):
             # Calculate bucket_width by maximum source sequence length.
@@ -139,6 +169,8 @@ def get_iterator(dataset,
     else:
         batched_dataset = batching_func(src_tgt_dataset)
     batched_iter = batched_dataset.make_initializable_iterator()
+    if saveable:
+        save_iterator_state(batched_iter)
     (src_ids, tgt_input_ids, tgt_output_ids, src_seq_len,
      tgt_seq_len) = (batched_iter.get_next())
     return BatchedInput(
@@ -158,7 +190,7 @@ def get_infer_iterator(test_dataset,
 
     def tokenize(line):
         utterances = tf.string_split([line], delimiter="\t").values
-        i, sp = tf.constant(0), tf.Variable([], dtype=tf.string)
+        i, sp = tf.constant(0), tf.constant([], dtype=tf.string)
         cond = lambda i, sp: tf.less(i, tf.size(utterances) - 1)
 
         def loop_body(i, sp):
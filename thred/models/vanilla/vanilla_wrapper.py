@@ -1,5 +1,4 @@
 import os
-import random
 import time
 
 import math
@@ -32,12 +31,15 @@ class VanillaNMTEncoderDecoder(NMTEncoderDecoderWrapper):
 
         self._pre_model_creation()
 
+        graph_sw = Stopwatch()
         train_model = vanilla_helper.create_train_model(self.config, scope)
         eval_model = vanilla_helper.create_eval_model(self.config, scope)
         infer_model = vanilla_helper.create_infer_model(self.config, scope)
+        model_helper.log_graph_stats(graph_sw.elapsed(), train=train_model.graph, eval=eval_model.graph,
+                                     infer=infer_model.graph)
 
         # Preload data for sample decoding.
-        eval_data = self._load_data(self.config.dev_data)
+        eval_data = self._index_data(self.config.dev_data)
         self.config.dev_size = math.ceil(len(eval_data) / self.config.batch_size)
 
         summary_name = "train_log"
@@ -79,13 +81,14 @@ class VanillaNMTEncoderDecoder(NMTEncoderDecoderWrapper):
 
         # This is the training loop.
         stats = self.init_stats()
+        epoch_stats = self.init_epoch_stats()
         speed, train_ppl = 0.0, 0.0
         start_train_time = time.time()
 
         self.config.save()
 
-        # Initialize all of the iterators
-        skip_count = self.config.batch_size * self.config.epoch_step
+        # Initialize all of the iterators, unless the position of the training iterator is restored from the checkpoint
+        skip_count = 0 if loaded_train_model.iterator_restored else self.config.batch_size * self.config.epoch_step
         lr = loaded_train_model.learning_rate.eval(session=train_sess)
         log.print_out(
             "# Starting step {}/{} (skipping {} elements), epoch {}/{}, lr {:f}, {}".format(
@@ -93,9 +96,10 @@ class VanillaNMTEncoderDecoder(NMTEncoderDecoderWrapper):
                 self.config.epoch, self.config.num_train_epochs, lr, time.ctime()),
             log_f)
 
-        train_sess.run(
-            train_model.iterator.initializer,
-            feed_dict={train_model.skip_count_placeholder: skip_count})
+        if not loaded_train_model.iterator_restored:
+            train_sess.run(
+                train_model.iterator.initializer,
+                feed_dict={train_model.skip_count_placeholder: skip_count})
 
         pbar = trange(self.config.num_train_steps, initial=global_step)
         pbar.set_postfix(lr=lr, wps='0K', ppl='inf', gN='inf', best_dev_ppl=self.config.best_dev_ppl)
@@ -117,6 +121,9 @@ class VanillaNMTEncoderDecoder(NMTEncoderDecoderWrapper):
                     "## Done epoch {} in {} steps. step {} @ eval time: {}s".format(
                         self.config.epoch, self.config.epoch_step, global_step, sw.elapsed()))
 
+                self.log_epoch_stats(epoch_stats, log_f)
+                epoch_stats = self.init_epoch_stats()
+
                 self.config.epoch += 1
                 self.config.epoch_step = 0
                 self.config.save()
@@ -129,7 +136,7 @@ class VanillaNMTEncoderDecoder(NMTEncoderDecoderWrapper):
                 continue
 
             # Write step summary and accumulate statistics
-            global_step = self.update_stats(stats, summary_writer, start_time, step_result)
+            global_step = self.update_stats(stats, summary_writer, start_time, step_result, epoch_stats)
 
             # Once in a while, we print statistics.
             if global_step - last_stats_step >= steps_per_stats:
@@ -222,7 +229,7 @@ class VanillaNMTEncoderDecoder(NMTEncoderDecoderWrapper):
                        iterator_src_placeholder, iterator_batch_size_placeholder,
                        eval_data, summary_writer):
         """Pick a sentence and decode."""
-        decode_id = random.randint(0, len(eval_data) - 1)
+        decode_id = eval_data.sample()[0]
         log.print_out("  # {}".format(decode_id))
 
         iterator_feed_dict = {
@@ -1,3 +1,4 @@
+import codecs
 import string
 
 from ..util.nlp import NLPToolkit
@@ -10,35 +11,120 @@ translate_table = dict((ord(char), u'') for char in enhanced_punctuation)
 contractions = {"'ll", "'ve", "'re", "n't", "doesn't", "don't", "i'm"}
 
 
+def _normalize(word, min_length=None):
+    """The normalized term of a word or None if the word is rejected"""
+    term = word.lower()
+
+    if NLPToolkit.is_stopword(term) or term in contractions:
+        return None
+
+    if min_length is not None and len(word) < min_length:
+        return None
+
+    return term.translate(translate_table) or None
+
+
 def normalize(word, min_length=None):
     """
     converts terms in lower case, drops stop words and applies stemming using
     the PorterStemmer algorithm
     """
 
-    term = word.lower()
+    term = _normalize(word, min_length)
 
-    if NLPToolkit.is_stopword(term) or term in contractions:
-        raise Warning("stopwords are not normalized here")
+    if term is None:
+        raise Warning("word is a stopword, too short or empty after normalization: {}".format(word))
 
-    if min_length is not None and len(word) < min_length:
-        raise Warning("word is too short")
+    return term
 
-    term = term.translate(translate_table)
 
-    if not term:
-        raise Warning("after normalization word became empty")
+class Normalizer:
+    """
+    Memoized counterpart of `normalize` which returns None for rejected words instead of raising `Warning`.
+    Token frequencies are heavily skewed, so most of the words are served from the memo table, which is
+    cleared whenever it reaches `max_memo_size` entries to keep memory bounded.
+    """
 
-    return term
+    def __init__(self, min_length=None, max_memo_size=1000000):
+        self.min_length = min_length
+        self.max_memo_size = max_memo_size
+        self._memo = {}
+
+    def normalize(self, word):
+        try:
+            return self._memo[word]
+        except KeyError:
+            pass
+
+        if len(self._memo) >= self.max_memo_size:
+            self._memo.clear()
+
+        term = self._memo[word] = _normalize(word, self.min_length)
+        return term
+
+    def normalize_sequence(self, words):
+        memo = self._memo
+        normalized = []
+        for word in words:
+            term = memo[word] if word in memo else self.normalize(word)
+            if term is not None:
+                normalized.append(term)
+
+        return normalized
+
+    def normalize_batch(self, token_lists):
+        return [self.normalize_sequence(tokens) for tokens in token_lists]
+
+
+_normalizers = {}
 
 
 def normalize_sequence(words, min_length=None):
-    normalized = []
-    for word in words:
-        try:
-            term = normalize(word, min_length)
-            normalized.append(term)
-        except Warning:
-            continue
+    if min_length not in _normalizers:
+        _normalizers[min_length] = Normalizer(min_length)
+
+    return _normalizers[min_length].normalize_sequence(words)
+
+
+def benchmark(data_path, n_lines=100000):
+    """Compares the exception-based normalization against `Normalizer` on the first lines of a corpus"""
+    import itertools
+    import time
+
+    with codecs.getreader("utf-8")(open(data_path, mode="rb")) as data_file:
+        token_lists = [line.split() for line in itertools.islice(data_file, n_lines)]
+    n_tokens = sum(len(tokens) for tokens in token_lists)
+
+    start_time = time.time()
+    expected = []
+    for tokens in token_lists:
+        normalized = []
+        for word in tokens:
+            try:
+                normalized.append(normalize(word))
+            except Warning:
+                continue
+        expected.append(normalized)
+    exception_time = time.time() - start_time
+
+    start_time = time.time()
+    actual = Normalizer().normalize_batch(token_lists)
+    memoized_time = time.time() - start_time
+
+    if actual != expected:
+        raise AssertionError('Normalizer output differs from normalize')
+
+    print('{} lines - {} tokens'.format(len(token_lists), n_tokens))
+    print('normalize {:.2f}s | Normalizer {:.2f}s | speedup {:.1f}x'.format(
+        exception_time, memoized_time, exception_time / max(memoized_time, 1e-9)))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='benchmarks term normalization')
+    parser.add_argument('-d', '--data', type=str, required=True, help='data path (e.g., Reddit dialogues)')
+    parser.add_argument('-n', '--n_lines', type=int, default=100000, help='number of lines to normalize')
+    args = parser.parse_args()
 
-    return normalized
+    benchmark(args.data, args.n_lines)
@@ -1,9 +1,14 @@
+import array
 import codecs
+import functools
 import logging
+import multiprocessing
+import os
 from os import listdir, mkdir
 from os.path import isdir, exists, join, abspath
 
 import gensim
+import numpy as np
 import yaml
 from gensim import corpora
 
@@ -34,11 +39,12 @@ class LDAArgs(dict):
 
 
 def iter_corpus(documents, min_length=None):
+    """Yields the normalized documents one at a time"""
     if not exists(documents):
         raise ValueError('The documents data does not exist: {}'.format(documents))
 
-    all_docs = []
     sw = Stopwatch()
+    normalizer = analyzer.Normalizer(min_length)
 
     if isdir(documents):
         print('Documents stored as files in directory "{}"'.format(documents))
@@ -54,56 +60,167 @@ def iter_corpus(documents, min_length=None):
             doc = []
             with codecs.getreader("utf-8")(open(file_path, 'rb')) as f:
                 for line in f:
-                    words = line.split()
-                    for word in words:
-                        try:
-                            term = analyzer.normalize(word, min_length)
-                            doc.append(term)
-                        except Warning:
-                            continue
-
-            all_docs.append(doc)
+                    doc.extend(normalizer.normalize_sequence(line.split()))
+
+            yield doc
             if i % 1000 == 0:
                 sw.print('  {} of {} iterated'.format(i, len(files)))
     else:
         print('Documents stored in each line in file "{}"'.format(documents))
         with codecs.getreader("utf-8")(open(documents, 'rb')) as f:
             for i, line in enumerate(f):
-                doc = analyzer.normalize_sequence(line.split(), min_length)
+                doc = normalizer.normalize_sequence(line.split())
 
                 if doc:
-                    all_docs.append(doc)
+                    yield doc
 
                 if i % 100000 == 0:
                     sw.print('  {} lines iterated'.format(i))
 
-    sw.print('corpus built')
-    return all_docs
+    sw.print('corpus iterated')
+
+
+def documents_signature(documents, min_length=None):
+    """Identifies the documents (a file or a directory of .txt files) and the normalization the corpus is built with"""
+    if isdir(documents):
+        stats = [os.stat(join(documents, f)) for f in sorted(listdir(documents)) if f.endswith('.txt')]
+    else:
+        stats = [os.stat(documents)]
+
+    return {
+        'documents': abspath(documents),
+        'num_files': len(stats),
+        'size': sum(stat.st_size for stat in stats),
+        'mtime_ns': max((stat.st_mtime_ns for stat in stats), default=0),
+        'min_length': min_length,
+    }
+
+
+class DocumentCorpus:
+    """
+    Restartable streaming corpus of bag-of-words documents.
+    The documents are normalized only once, while the dictionary is built, and their token ids are cached
+    in the model directory. Every iteration reads the ids back through memory-mapped arrays,
+    so memory does not grow with the size of the corpus.
+    The cache is reused only for the documents and min_length it was built with (see documents_signature).
+    """
+
+    def __init__(self, cache_dir):
+        self._ids_path = join(cache_dir, 'corpus.ids')
+        self._offsets_path = join(cache_dir, 'corpus.offsets')
+        self._dictionary_path = join(cache_dir, 'corpus.dict')
+        self._signature_path = join(cache_dir, 'corpus.signature.yml')
+        self.dictionary = None
+        self._id_map = None
+
+    def is_cached(self, documents, min_length=None):
+        paths = (self._ids_path, self._offsets_path, self._dictionary_path, self._signature_path)
+        if not all(exists(path) for path in paths) or not exists(documents):
+            return False
+
+        with codecs.getreader("utf-8")(open(self._signature_path, 'rb')) as f:
+            return yaml.safe_load(f) == documents_signature(documents, min_length)
+
+    def build(self, documents, min_length=None, batch_size=10000):
+        if exists(self._signature_path):
+            os.remove(self._signature_path)
+        # no pruning while building the dictionary, as it would change the ids already cached
+        dictionary = corpora.Dictionary(prune_at=None)
+
+        with open(self._ids_path, 'wb') as ids_file, open(self._offsets_path, 'wb') as offsets_file:
+            n_tokens = 0
+            array.array('q', [n_tokens]).tofile(offsets_file)
+
+            def flush(batch):
+                nonlocal n_tokens
+                dictionary.add_documents(batch, prune_at=None)
+
+                offsets = array.array('q')
+                for doc in batch:
+                    array.array('i', dictionary.doc2idx(doc)).tofile(ids_file)
+                    n_tokens += len(doc)
+                    offsets.append(n_tokens)
+                offsets.tofile(offsets_file)
+
+            batch = []
+            for doc in iter_corpus(documents, min_length):
+                batch.append(doc)
+                if len(batch) == batch_size:
+                    flush(batch)
+                    batch = []
+            flush(batch)
+
+        # the signature and the dictionary are saved last as they mark the cache complete
+        with codecs.getwriter("utf-8")(open(self._signature_path, 'wb')) as f:
+            yaml.safe_dump(documents_signature(documents, min_length), f, default_flow_style=False)
+        dictionary.save(self._dictionary_path)
+        self.dictionary = dictionary
+        self._id_map = None
+
+    def load(self):
+        self.dictionary = corpora.Dictionary.load(self._dictionary_path)
+        self._id_map = None
+
+    def filter_extremes(self, **kwargs):
+        """Filters the dictionary and maps the cached ids to the new ids (or -1 for the dropped terms)"""
+        token2id = dict(self.dictionary.token2id)
+        self.dictionary.filter_extremes(**kwargs)
+        self._map_ids(token2id, self.dictionary)
+
+    def map_to(self, dictionary):
+        """Maps the cached ids to the ids of another dictionary (or -1 for the missing terms)"""
+        self._map_ids(self.dictionary.token2id, dictionary)
+        self.dictionary = dictionary
+
+    def _map_ids(self, token2id, dictionary):
+        self._id_map = np.full(len(token2id), -1, dtype=np.int64)
+        for token, old_id in token2id.items():
+            self._id_map[old_id] = dictionary.token2id.get(token, -1)
+
+    def _load_arrays(self):
+        offsets = np.fromfile(self._offsets_path, dtype=np.int64)
+        if offsets[-1] > 0:
+            ids = np.memmap(self._ids_path, dtype=np.int32, mode='r')
+        else:
+            ids = np.zeros(0, dtype=np.int32)
+        return ids, offsets
+
+    def __iter__(self):
+        ids, offsets = self._load_arrays()
+        for start, end in zip(offsets[:-1], offsets[1:]):
+            doc = ids[start:end]
+            if self._id_map is not None:
+                doc = self._id_map[doc]
+                doc = doc[doc >= 0]
+
+            term_ids, counts = np.unique(doc, return_counts=True)
+            yield list(zip(term_ids.tolist(), counts.tolist()))
+
+    def __len__(self):
+        return len(np.fromfile(self._offsets_path, dtype=np.int64)) - 1
 
 
 def train(model_dir, args):
     if not exists(model_dir):
         mkdir(model_dir)
 
-    corpus = iter_corpus(args.documents, args.min_length)
-    dictionary = corpora.Dictionary(corpus)
-    dictionary.filter_extremes(no_below=args.no_below)
-
     mm_corpus_file = join(model_dir, 'corpus.mm')
 
+    corpus = DocumentCorpus(model_dir)
+    if corpus.is_cached(args.documents, args.min_length):
+        print("cached corpus found in {}".format(model_dir))
+        corpus.load()
+    else:
+        corpus.build(args.documents, args.min_length)
+        # the serialized corpus of other documents is stale
+        if exists(mm_corpus_file):
+            os.remove(mm_corpus_file)
+    corpus.filter_extremes(no_below=args.no_below)
+    dictionary = corpus.dictionary
+
     if not exists(mm_corpus_file):
         print("corpus not found. Starting to build it...")
-
-        class CorpusWrapper:
-
-            def __init__(self, dictionary):
-                self._dictionary = dictionary
-
-            def __iter__(self):
-                for tokens in corpus:
-                    yield self._dictionary.doc2bow(tokens)
-
-        gensim.corpora.MmCorpus.serialize(mm_corpus_file, CorpusWrapper(dictionary))
+        gensim.corpora.MmCorpus.serialize(mm_corpus_file, corpus)
 
     mm_corpus = gensim.corpora.MmCorpus(mm_corpus_file)
 
@@ -121,6 +238,12 @@ def train(model_dir, args):
     print("Saving LDA model...")
     ldamodel.save(join(model_dir, 'LDA.model'))
 
+    _save_topic_words(model_dir, ldamodel, dictionary, args)
+
+    args.save(join(model_dir, 'config.yml'))
+
+
+def _save_topic_words(model_dir, ldamodel, dictionary, args):
     print("Saving words for topics...")
     with open(join(model_dir, 'TopicWords.txt'), 'w') as topic_file:
         for i in range(args.num_topics):
@@ -128,29 +251,184 @@ def train(model_dir, args):
             topic_words_ids = [x[0] for x in ldamodel.get_topic_terms(i, topn=args.words_per_topic)]
             topic_file.write('\n\t'.join([dictionary[x] for x in topic_words_ids]) + '\n')
 
-    args.save(join(model_dir, 'config.yml'))
+
+def _extend_vocabulary(ldamodel, new_dictionary, no_below, max_new_terms):
+    """
+    Adds the (at most `max_new_terms`) most frequent terms of the new documents appearing in at least
+    `no_below` of them to the dictionary of the model, and grows the topic-term statistics accordingly.
+    The new terms start with no statistics, i.e., their topic-term weights come from the prior only.
+    The document and term counts of the dictionary are updated with the new documents as well.
+    """
+    dictionary = ldamodel.id2word
+    candidates = [(df, term_id) for term_id, df in new_dictionary.dfs.items()
+                  if df >= no_below and new_dictionary[term_id] not in dictionary.token2id]
+    new_terms = [new_dictionary[term_id] for _, term_id in sorted(candidates, reverse=True)[:max_new_terms]]
+
+    for term in new_terms:
+        dictionary.token2id[term] = len(dictionary.token2id)
+    # the reverse mapping is rebuilt lazily
+    dictionary.id2token = {}
+
+    for new_term_id, term in new_dictionary.items():
+        term_id = dictionary.token2id.get(term)
+        if term_id is not None:
+            dictionary.dfs[term_id] = dictionary.dfs.get(term_id, 0) + new_dictionary.dfs.get(new_term_id, 0)
+            dictionary.cfs[term_id] = dictionary.cfs.get(term_id, 0) + new_dictionary.cfs.get(new_term_id, 0)
+    dictionary.num_docs += new_dictionary.num_docs
+    dictionary.num_pos += new_dictionary.num_pos
+    dictionary.num_nnz += new_dictionary.num_nnz
+
+    if not new_terms:
+        return 0
+
+    n_new = len(new_terms)
+    eta = np.asarray(ldamodel.eta)
+    ldamodel.eta = np.concatenate((eta, np.full(n_new, eta.mean(), dtype=eta.dtype)))
+    ldamodel.state.eta = ldamodel.eta
+    ldamodel.state.sstats = np.hstack((ldamodel.state.sstats,
+                                       np.zeros((ldamodel.num_topics, n_new), dtype=ldamodel.state.sstats.dtype)))
+    ldamodel.num_terms = len(dictionary.token2id)
+    ldamodel.expElogbeta = np.exp(ldamodel.state.get_Elogbeta())
+
+    return n_new
+
+
+class _CorpusSubset:
+    """Documents of a corpus (except for the ones at the excluded positions)"""
+
+    def __init__(self, corpus, excluded):
+        self._corpus = corpus
+        self._excluded = excluded
+
+    def __iter__(self):
+        for i, doc in enumerate(self._corpus):
+            if i not in self._excluded:
+                yield doc
+
+    def __len__(self):
+        return len(self._corpus) - len(self._excluded)
+
+
+def update(model_dir, output_model_dir, args):
+    """
+    Refreshes an existing model with new documents (`args.documents`) via online variational Bayes
+    (Hoffman et al., 2010): the k-th chunk of new documents is blended into the topics with a step size of
+    (`args.offset` + k) ** -`args.decay`, counting k from zero regardless of the updates of the original training.
+    The dictionary is extended with at most `args.max_new_terms` new terms, and the updated model is saved
+    as a new version in `output_model_dir`, leaving the existing one intact.
+    Perplexity is reported on the held-out new documents before and after the update.
+    """
+    if exists(output_model_dir):
+        raise ValueError('The output model directory already exists: {}'.format(output_model_dir))
+    mkdir(output_model_dir)
+
+    ldamodel = gensim.models.LdaMulticore.load(join(model_dir, 'LDA.model'))
+    params = LDAArgs.load(join(model_dir, 'config.yml'))
+    n_old_terms = ldamodel.num_terms
+
+    corpus = DocumentCorpus(output_model_dir)
+    corpus.build(args.documents, params.get('min_length'))
+
+    n_new_terms = _extend_vocabulary(ldamodel, corpus.dictionary, args.no_below, args.max_new_terms)
+    print('{} new terms added to the dictionary of {} terms'.format(n_new_terms, n_old_terms))
+    corpus.map_to(ldamodel.id2word)
+
+    # every `holdout_every`-th new document is held out to compare perplexities
+    holdout_ids = set(range(0, min(len(corpus), args.holdout_every * args.max_holdout), args.holdout_every))
+    holdout = [doc for i, doc in enumerate(corpus) if i in holdout_ids]
+    # the old model knows nothing about the new terms, so they are excluded from the common comparison
+    holdout_old_terms = [[(term_id, cnt) for term_id, cnt in doc if term_id < n_old_terms] for doc in holdout]
+
+    def perplexity(docs):
+        return float(np.exp2(-ldamodel.log_perplexity(docs))) if docs else float('nan')
+
+    perplexity_before = perplexity(holdout_old_terms)
+
+    ldamodel.batch = False
+    ldamodel.decay = args.decay
+    ldamodel.offset = args.offset
+    # the step size restarts for the new documents, otherwise the updates of the original training would make
+    # it so small that the new documents barely move the topics
+    ldamodel.num_updates = 0
+    ldamodel.passes = args.passes
+    ldamodel.iterations = args.iterations
+    ldamodel.chunksize = args.chunksize
+    ldamodel.eval_every = 0
+    ldamodel.update(_CorpusSubset(corpus, holdout_ids))
+
+    perplexity_after = perplexity(holdout_old_terms)
+    print('held-out perplexity on {} documents: before {:.1f} -> after {:.1f} ({:.1f} with the new terms)'.format(
+        len(holdout), perplexity_before, perplexity_after, perplexity(holdout)))
+
+    print("Saving LDA model...")
+    ldamodel.save(join(output_model_dir, 'LDA.model'))
+
+    _save_topic_words(output_model_dir, ldamodel, ldamodel.id2word, params)
+
+    params.updates = params.get('updates', []) + [{
+        'documents': abspath(args.documents),
+        'base_model_dir': abspath(model_dir),
+        'decay': args.decay,
+        'offset': args.offset,
+        'new_terms': n_new_terms,
+        'perplexity_before': perplexity_before,
+        'perplexity_after': perplexity_after,
+    }]
+    params.save(join(output_model_dir, 'config.yml'))
 
 
 class TopicInferer:
 
-    def __init__(self, model_dir, verbose=True):
+    def __init__(self, model_dir, verbose=True, cache_size=10000):
         self._model_dir = model_dir
         self._verbose = verbose
         if self._verbose:
             logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=logging.INFO)
         self._params = LDAArgs.load(join(model_dir, 'config.yml'))
         self._ldamodel = gensim.models.LdaMulticore.load(join(model_dir, 'LDA.model'))
+        self._topic_word_dicts = {}
+        self._normalizer = analyzer.Normalizer()
+        # inferred topics keyed by the bag-of-words (i.e., the multiset of normalized terms) of documents
+        self._cached_topic = functools.lru_cache(maxsize=cache_size)(self._infer_topic)
+
+    def _topic_words_table(self, words_per_topic):
+        """
+        Top term ids of every topic as a (num_topics, words_per_topic) array, which is stored in the model
+        directory so that it is computed only once per model (unless the directory is read-only)
+        """
+        table_file = join(self._model_dir, 'topic_words_{}.npy'.format(words_per_topic))
+        if exists(table_file) and \
+                os.path.getmtime(table_file) >= os.path.getmtime(join(self._model_dir, 'LDA.model')):
+            return np.load(table_file)
+
+        topics = self._ldamodel.get_topics()
+        table = np.array([gensim.matutils.argsort(topic, words_per_topic, reverse=True) for topic in topics],
+                         dtype=np.int64)
+        try:
+            with open(table_file + '.tmp', 'wb') as f:
+                np.save(f, table)
+            os.replace(table_file + '.tmp', table_file)
+        except OSError as e:
+            print('topic words table kept in memory only (cannot write "{}": {})'.format(table_file, e))
+        return table
 
     def _init_words_per_topics(self, words_per_topic):
-        topic_word_dict = {}
-        for t_id in range(self._params.num_topics):
-            topic_words_ids = [x[0] for x in
-                               self._ldamodel.get_topic_terms(
-                                   t_id,
-                                   topn=(words_per_topic or self._params.words_per_topic))]
-            topic_word_dict[t_id] = [self._ldamodel.id2word[x] for x in topic_words_ids]
+        words_per_topic = words_per_topic or self._params.words_per_topic
+
+        if words_per_topic not in self._topic_word_dicts:
+            table = self._topic_words_table(words_per_topic)
+            self._topic_word_dicts[words_per_topic] = {
+                t_id: [self._ldamodel.id2word[x] for x in topic_words_ids.tolist()]
+                for t_id, topic_words_ids in enumerate(table)}
+
+        return self._topic_word_dicts[words_per_topic]
+
+    def _infer_topic(self, bow):
+        return self._infer_topics([list(bow)])[0]
 
-        return topic_word_dict
+    def infer_topic(self, terms):
+        """The most probable topic of the normalized terms of a document (or -1), served from the cache if possible"""
+        return self._cached_topic(tuple(self._ldamodel.id2word.doc2bow(terms)))
 
     def from_collection(self, test_collection, dialogue_as_doc=False, words_per_topic=None):
         topic_word_dict = self._init_words_per_topics(words_per_topic)
@@ -160,85 +438,166 @@ class TopicInferer:
 
             if dialogue_as_doc:
                 words = ' '.join(utterances).split()
-                dialogue_terms = analyzer.normalize_sequence(words)
-
-                doc = self._ldamodel.id2word.doc2bow(dialogue_terms)
-                topic_ids = self._ldamodel.get_document_topics(doc)
-                if len(topic_ids) > 0:
-                    t_id = sorted(topic_ids, key=lambda x: x[1], reverse=True)[0][0]
-                    output.append((t_id, topic_word_dict[t_id]))
-                else:
-                    output.append((-1, []))
+                t_id = self.infer_topic(self._normalizer.normalize_sequence(words))
+                output.append((t_id, topic_word_dict[t_id] if t_id >= 0 else []))
             else:
                 t_ids, t_words = [], []
                 for i, utterance in enumerate(utterances):
-                    utterance_terms = analyzer.normalize_sequence(utterance.split())
-
-                    doc = self._ldamodel.id2word.doc2bow(utterance_terms)
-                    topic_ids = self._ldamodel.get_document_topics(doc)
-                    if len(topic_ids) > 0:
-                        t_id = sorted(topic_ids, key=lambda x: x[1], reverse=True)[0][0]
-                        t_ids.append(t_id)
-                        t_words.append(topic_word_dict[t_id])
-                    else:
-                        t_ids.append(-1)
-                        t_words.append([])
+                    t_id = self.infer_topic(self._normalizer.normalize_sequence(utterance.split()))
+                    t_ids.append(t_id)
+                    t_words.append(topic_word_dict[t_id] if t_id >= 0 else [])
 
                 output.append((t_ids, t_words))
 
         return output
 
-    def from_file(self, test_data, output_file, dialogue_as_doc=False, words_per_topic=None):
+    def _infer_topics(self, docs):
+        """
+        Batched counterpart of `get_document_topics` which runs the variational inference once for all the
+        documents (bag-of-words) and returns the most probable topic of each (or -1 if no topic is probable enough)
+        """
+        if not docs:
+            return []
+
+        gamma, _ = self._ldamodel.inference(docs)
+        topic_dist = gamma / gamma.sum(axis=1, keepdims=True)
+        t_ids = topic_dist.argmax(axis=1)
+        minimum_probability = max(self._ldamodel.minimum_probability, 1e-8)
+
+        return [int(t_id) if topic_dist[i, t_id] >= minimum_probability else -1 for i, t_id in enumerate(t_ids)]
+
+    def _infer_lines(self, lines, dialogue_as_doc, topic_word_dict):
+        """
+        Infers the topics of a chunk of lines and returns the corresponding (topical) output lines,
+        which carry topic ids instead of topic words if no `topic_word_dict` is given
+        """
+        line_utterances = [line.strip().split('\t') for line in lines]
+
+        if dialogue_as_doc:
+            token_lists = [' '.join(utterances[:-1]).split() for utterances in line_utterances]
+        else:
+            token_lists = [utterance.split() for utterances in line_utterances for utterance in utterances]
+        docs = [self._ldamodel.id2word.doc2bow(terms) for terms in self._normalizer.normalize_batch(token_lists)]
+
+        t_ids = iter(self._infer_topics(docs))
+
+        def topic_words(t_id):
+            if topic_word_dict is None:
+                return str(t_id)
+            return ' '.join(topic_word_dict[t_id]) if t_id >= 0 else '<NO_TOPIC>'
+
+        output = []
+        for utterances in line_utterances:
+            if dialogue_as_doc:
+                topical = topic_words(next(t_ids))
+            else:
+                topical = '\t'.join(topic_words(next(t_ids)) for _ in utterances)
+            output.append('\t'.join(utterances) + '\t' + topical + '\n')
+
+        return output
+
+    def write_topic_table(self, table_file, words_per_topic=None):
+        """Writes the words of every topic, the words of topic i in the i-th line"""
+        topic_word_dict = self._init_words_per_topics(words_per_topic)
+        with codecs.getwriter('utf-8')(open(table_file, 'wb')) as f:
+            for t_id in range(len(topic_word_dict)):
+                f.write(' '.join(topic_word_dict[t_id]) + '\n')
+
+    def from_file(self, test_data, output_file, dialogue_as_doc=False, words_per_topic=None,
+                  n_workers=1, batch_size=1000, resume=False, topic_ids=False):
+        """
+        Writes the input lines along with the words of their inferred topics. Lines are inferred in chunks of
+        `batch_size` lines, fanned out across `n_workers` processes that share the model, and written in order.
+        With `resume`, the lines already in the output file are skipped.
+        With `topic_ids`, the lines carry the ids of their topics (-1 for no topic) and the words of the topics
+        are written once to a topic table file next to the output file (see `write_topic_table`).
+        """
+        global _shared_inference
+
         topic_word_dict = self._init_words_per_topics(words_per_topic)
 
         if output_file is None:
             output_file = fs.replace_ext(test_data, 'topical.txt')
 
-        sw = Stopwatch()
+        if topic_ids:
+            self.write_topic_table(fs.replace_ext(output_file, 'topics'), words_per_topic)
+            topic_word_dict = None
+
+        n_done = _truncate_partial_line(output_file) if resume and exists(output_file) else 0
+        if n_done > 0:
+            print('Resuming after {} lines already inferred in "{}"'.format(n_done, output_file))
+
+        def iter_chunks(test_file):
+            chunk = []
+            for lno, line in enumerate(test_file):
+                if lno < n_done:
+                    continue
+
+                chunk.append(line)
+                if len(chunk) == batch_size:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
 
-        with codecs.getreader('utf-8')(open(test_data, 'rb')) as test_file:
-            with codecs.getwriter('utf-8')(open(output_file, 'wb')) as out_file:
-                for lno, line in enumerate(test_file):
-                    utterances = line.strip().split('\t')
-                    out_file.write(line.strip() + "\t")
-
-                    if lno % 100000 == 0:
-                        sw.print('  {} lines inferred'.format(lno))
-
-                    if dialogue_as_doc:
-                        words = ' '.join(utterances[:-1]).split()
-                        dialogue_terms = analyzer.normalize_sequence(words)
-
-                        doc = self._ldamodel.id2word.doc2bow(dialogue_terms)
-                        topic_ids = self._ldamodel.get_document_topics(doc)
-                        if len(topic_ids) > 0:
-                            t_id = sorted(topic_ids, key=lambda x: x[1], reverse=True)[0][0]
-                            out_file.write(' '.join(topic_word_dict[t_id]))
-                        else:
-                            out_file.write('<NO_TOPIC>')
+        sw = Stopwatch()
+        n_lines = n_done
+
+        # workers are forked after this is set, so that they share the model with the parent (copy-on-write)
+        _shared_inference = (self, dialogue_as_doc, topic_word_dict)
+        pool = multiprocessing.get_context('fork').Pool(n_workers) if n_workers > 1 else None
+        try:
+            with codecs.getreader('utf-8')(open(test_data, 'rb')) as test_file:
+                with codecs.getwriter('utf-8')(open(output_file, 'ab' if n_done > 0 else 'wb')) as out_file:
+                    if pool is None:
+                        results = map(_infer_lines_in_worker, iter_chunks(test_file))
                     else:
-                        for i, utterance in enumerate(utterances):
-                            utterance_terms = analyzer.normalize_sequence(utterance.split())
+                        results = pool.imap(_infer_lines_in_worker, iter_chunks(test_file))
 
-                            doc = self._ldamodel.id2word.doc2bow(utterance_terms)
-                            topic_ids = self._ldamodel.get_document_topics(doc)
-                            if len(topic_ids) > 0:
-                                t_id = sorted(topic_ids, key=lambda x: x[1], reverse=True)[0][0]
-                                out_file.write(
-                                    ' '.join(topic_word_dict[t_id]) + ('\t' if i < len(utterances) - 1 else ''))
-                            else:
-                                out_file.write('<NO_TOPIC>')
+                    for output in results:
+                        out_file.write(''.join(output))
 
-                    out_file.write('\n')
+                        if (n_lines + len(output)) // 100000 > n_lines // 100000:
+                            sw.print('  {} lines inferred'.format(n_lines + len(output)))
+                        n_lines += len(output)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            _shared_inference = None
 
         sw.print('Done!!!')
 
 
+_shared_inference = None
+
+
+def _infer_lines_in_worker(lines):
+    inferer, dialogue_as_doc, topic_word_dict = _shared_inference
+    return inferer._infer_lines(lines, dialogue_as_doc, topic_word_dict)
+
+
+def _truncate_partial_line(file_path):
+    """Drops the trailing incomplete line (if any) of a file and returns the number of complete lines"""
+    n_lines, end_of_last_line = 0, 0
+    with open(file_path, 'rb') as f:
+        for line in f:
+            if line.endswith(b'\n'):
+                n_lines += 1
+                end_of_last_line += len(line)
+
+    if end_of_last_line < os.path.getsize(file_path):
+        with open(file_path, 'rb+') as f:
+            f.truncate(end_of_last_line)
+
+    return n_lines
+
+
 def main():
     import argparse
 
     parser = argparse.ArgumentParser()
-    parser.add_argument('--mode', type=str, required=True, choices=("train", "infer"), help='mode')
+    parser.add_argument('--mode', type=str, required=True, choices=("train", "infer", "update"), help='mode')
     parser.add_argument('--model_dir', type=str, required=True, help='model directory')
     parser.add_argument('--data', type=str,
                         help='data (if directory, each document is a file, or else each document is a line)')
@@ -249,6 +608,23 @@ def main():
     parser.add_argument('--test_data', type=str, help='test data')
     parser.add_argument('--dialogue_as_doc', action='store_true', help='treats whole dialogue as document')
     parser.add_argument('--output', type=str, help='output file')
+    parser.add_argument('--n_workers', type=int, default=multiprocessing.cpu_count(),
+                        help='number of inference processes')
+    parser.add_argument('--batch_size', type=int, default=1000, help='number of lines inferred at once')
+    parser.add_argument('--resume', action='store_true', help='skips the lines already written to the output')
+    parser.add_argument('--topic_ids', action='store_true',
+                        help='writes topic ids instead of topic words along with a topic table (compact format)')
+    parser.add_argument('--output_model_dir', type=str,
+                        help='directory of the updated model (in update mode, defaults to model_dir.v<N>)')
+    parser.add_argument('--decay', type=float, default=0.7,
+                        help='in update mode, how fast the step size decreases over the chunks of new documents '
+                             '(in (0.5, 1])')
+    parser.add_argument('--offset', type=float, default=64.0,
+                        help='in update mode, the k-th chunk of new documents is blended into the topics with '
+                             'a step size of (offset + k) ** -decay, so larger offsets keep more of the old topics')
+    parser.add_argument('--passes', type=int, default=1, help='in update mode, passes over the new documents')
+    parser.add_argument('--max_new_terms', type=int, default=10000,
+                        help='in update mode, max number of new terms added to the dictionary')
 
     args = parser.parse_args()
     if args.mode == 'train':
@@ -267,7 +643,32 @@ def main():
         print("Training starts with arguments: {}".format(_params))
         train(args.model_dir, LDAArgs(_params))
     elif args.mode == 'infer':
-        TopicInferer(args.model_dir).from_file(args.test_data, args.output, args.dialogue_as_doc)
+        TopicInferer(args.model_dir).from_file(args.test_data, args.output, args.dialogue_as_doc,
+                                               n_workers=args.n_workers, batch_size=args.batch_size,
+                                               resume=args.resume, topic_ids=args.topic_ids)
+    elif args.mode == 'update':
+        output_model_dir = args.output_model_dir
+        if output_model_dir is None:
+            version = 1
+            while exists('{}.v{}'.format(args.model_dir.rstrip('/'), version)):
+                version += 1
+            output_model_dir = '{}.v{}'.format(args.model_dir.rstrip('/'), version)
+
+        _params = {
+            "documents": args.data,
+            "no_below": args.no_below,
+            "max_new_terms": args.max_new_terms,
+            "decay": args.decay,
+            "offset": args.offset,
+            "passes": args.passes,
+            "chunksize": 10000,
+            "iterations": 100,
+            "holdout_every": 20,
+            "max_holdout": 10000
+        }
+
+        print("Update starts with arguments: {}".format(_params))
+        update(args.model_dir, output_model_dir, LDAArgs(_params))
 
 
 if __name__ == "__main__":
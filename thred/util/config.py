@@ -95,6 +95,10 @@ class Config(dict):
             to_dump_dict['dev_data'] = os.path.abspath(to_dump_dict['dev_data'])
         if to_dump_dict['vocab_file']:
             to_dump_dict['vocab_file'] = os.path.abspath(to_dump_dict['vocab_file'])
+        if to_dump_dict.get('topic_table'):
+            to_dump_dict['topic_table'] = os.path.abspath(to_dump_dict['topic_table'])
+        if to_dump_dict.get('train_records'):
+            to_dump_dict['train_records'] = os.path.abspath(to_dump_dict['train_records'])
 
         with codecs.getwriter("utf-8")(open(hparams_file, "wb")) as f:
             yaml.dump(to_dump_dict, f, default_flow_style=False)
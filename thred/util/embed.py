@@ -1,9 +1,15 @@
 import collections
+import hashlib
 import logging
 import codecs
+import os
+import shutil
+import socket
+import time
+from abc import ABCMeta, abstractmethod
 from pathlib import Path
-from typing import Type, TypeVar, List
-from os import environ, rename
+from typing import Type, TypeVar, List, Callable
+from os import environ, rename, replace
 
 import h5py
 import numpy as np
@@ -18,6 +24,8 @@ from .misc import Stopwatch
 T = TypeVar('T')
 logger = logging.getLogger(__name__)
 
+_loaded_vectors = {}
+
 
 class EmbeddingType(
     collections.namedtuple("EmbeddingType", ("name", "url", "dim", "src_type"))):
@@ -28,12 +36,12 @@ class EmbeddingFactory:
     def __init__(self, embedding_type: EmbeddingType):
         self._embedding_type = embedding_type
 
-    def build(self, vocab_list: List[str], h5_file: str, **kwargs) -> (List[str], List[str]):
+    def build(self, vocab_list: List[str], **kwargs) -> (np.ndarray, np.ndarray):
         """
         :param vocab_list: The vocabulary list built upon the dataset
-        :param h5_file: The output h5 file where the embedding vectors will be saved into
         :param kwargs: Additional parameters based on the factory type
-        :return A tuple containing the Out-Of-Vocabulary words and In-Vocabulary words
+        :return A tuple containing the embedding matrix (a float32 row per word in the order of vocab_list)
+            and the boolean mask of trainable (i.e., Out-Of-Vocabulary) words
         """
         pass
 
@@ -42,16 +50,12 @@ class RandomFactory(EmbeddingFactory):
     def __init__(self, embedding_type: EmbeddingType):
         super().__init__(embedding_type)
 
-    def build(self, vocab_list: List[str], h5_file: str, **kwargs) -> (List[str], List[str]):
+    def build(self, vocab_list: List[str], **kwargs) -> (np.ndarray, np.ndarray):
         init_weight = kwargs.get('init_weight', 0.1)
 
-        with h5py.File(h5_file, mode="w") as vec_h5:
-            for w in vocab_list:
-                vec = np.random.uniform(-init_weight, init_weight, size=self._embedding_type.dim)
-                vec_h5.create_dataset("{key}/vec".format(key=w), data=vec)
-                vec_h5.create_dataset("{key}/trainable".format(key=w), data=1)
-
-        return vocab_list, []
+        vectors = np.random.uniform(-init_weight, init_weight,
+                                    size=(len(vocab_list), self._embedding_type.dim)).astype(np.float32)
+        return vectors, np.ones(len(vocab_list), dtype=bool)
 
 
 class MagnitudeFactory(EmbeddingFactory):
@@ -70,21 +74,16 @@ class MagnitudeFactory(EmbeddingFactory):
         logger.info('  Loading Magnitude module...')
         self._magnitude_vecs = Magnitude(self._embed_file)
 
-    def build(self, vocab_list: List[str], h5_file: Path, **kwargs) -> (List[str], List[str]):
-        oov, iov = [], []
-        with h5py.File(h5_file, mode="w") as vec_h5:
-            for w in vocab_list:
-                is_oov = w not in self._magnitude_vecs
-                vec = self._magnitude_vecs.query(w)
-                vec_h5.create_dataset("{key}/vec".format(key=w), data=vec)
-                vec_h5.create_dataset("{key}/trainable".format(key=w), data=1 if is_oov else 0)
-
-                if is_oov:
-                    oov.append(w)
-                else:
-                    iov.append(w)
+    def build(self, vocab_list: List[str], **kwargs) -> (np.ndarray, np.ndarray):
+        page_size = kwargs.get('page_size', 15000)
+
+        vectors = np.zeros((len(vocab_list), self._embedding_type.dim), dtype=np.float32)
+        for lb in range(0, len(vocab_list), page_size):
+            page = vocab_list[lb:lb + page_size]
+            vectors[lb:lb + len(page)] = self._magnitude_vecs.query(page)
 
-        return oov, iov
+        trainable = np.fromiter((w not in self._magnitude_vecs for w in vocab_list), dtype=bool, count=len(vocab_list))
+        return vectors, trainable
 
 
 class TfHubFactory(EmbeddingFactory):
@@ -93,7 +92,7 @@ class TfHubFactory(EmbeddingFactory):
     def __init__(self, embedding_type: EmbeddingType):
         super(TfHubFactory, self).__init__(embedding_type)
 
-    def build(self, vocab_list: List[str], h5_file: Path, **kwargs) -> (List[str], List[str]):
+    def build(self, vocab_list: List[str], **kwargs) -> (np.ndarray, np.ndarray):
         page_size = kwargs.get('page_size', 15000)
         init_weight = kwargs.get('init_weight', 0.1)
 
@@ -101,42 +100,284 @@ class TfHubFactory(EmbeddingFactory):
         environ["TFHUB_CACHE_DIR"] = ".tfhub_modules"
         embedder = hub.Module(self._embedding_type.url)
 
-        num_pages = len(vocab_list) // page_size
-        oov, iov = [], []
-        with h5py.File(h5_file, mode='w') as vec_h5:
-            with tf.Session() as sess:
-                sess.run([tf.global_variables_initializer(), tf.tables_initializer()])
+        words = tf.placeholder(tf.string, shape=[None])
+        embedded_words = embedder(words)
 
-                for i in range(num_pages + 1):
-                    lb = i * page_size
-                    ub = min((i + 1) * page_size, len(vocab_list))
+        vectors = np.zeros((len(vocab_list), self._embedding_type.dim), dtype=np.float32)
+        with tf.Session() as sess:
+            sess.run([tf.global_variables_initializer(), tf.tables_initializer()])
 
-                    page = vocab_list[lb:ub]
-                    embedding_vectors = sess.run(embedder(page))
+            for lb in range(0, len(vocab_list), page_size):
+                page = vocab_list[lb:lb + page_size]
+                vectors[lb:lb + len(page)] = sess.run(embedded_words, feed_dict={words: page})
 
-                    for i, word in enumerate(page):
-                        is_oov = sum(embedding_vectors[i]) == 0
-                        if is_oov:
-                            vec = np.random.uniform(-init_weight, init_weight, self._embedding_type.dim)
-                        else:
-                            vec = embedding_vectors[i]
+        # the OOV words are embedded as all-zero vectors
+        trainable = ~vectors.any(axis=1)
+        vectors[trainable] = np.random.uniform(-init_weight, init_weight,
+                                               size=(np.count_nonzero(trainable), self._embedding_type.dim))
+        return vectors, trainable
 
-                        vec_h5.create_dataset("{key}/vec".format(key=word), data=vec)
-                        vec_h5.create_dataset("{key}/trainable".format(key=word), data=1 if is_oov else 0)
 
-                        if is_oov:
-                            oov.append(word)
-                        else:
-                            iov.append(word)
+class LocalFileFactory(EmbeddingFactory, metaclass=ABCMeta):
+    """
+    Builds the vectors from a local embedding file (the `url` in the config) streamed once, in which only the rows
+    of the vocabulary words are kept, so the memory is proportional to the vocabulary rather than the file.
+    Words missing in the file are trainable and initialized randomly.
+    """
+
+    def __init__(self, embedding_type: EmbeddingType):
+        super(LocalFileFactory, self).__init__(embedding_type)
+
+        self._embed_file = os.path.expanduser(self._embedding_type.url)
+        if not os.path.exists(self._embed_file):
+            raise ValueError("Embedding file of '{}' not found: {}".format(self._embedding_type.name,
+                                                                           self._embed_file))
+
+    @abstractmethod
+    def _iter_vectors(self, words: dict):
+        """Yields (word, vector) for the words in `words` in the order of the file"""
+        pass
+
+    def source_files(self) -> List[str]:
+        """The files the vectors are read from"""
+        return [self._embed_file]
+
+    def _check_dim(self, dim: int):
+        if dim != self._embedding_type.dim:
+            raise ValueError("Dimension mismatch in {}: {} (expected {})".format(
+                self._embed_file, dim, self._embedding_type.dim))
+
+    def build(self, vocab_list: List[str], **kwargs) -> (np.ndarray, np.ndarray):
+        init_weight = kwargs.get('init_weight', 0.1)
+
+        rows = {w: i for i, w in enumerate(vocab_list)}
+        vectors = np.zeros((len(vocab_list), self._embedding_type.dim), dtype=np.float32)
+        trainable = np.ones(len(vocab_list), dtype=bool)
+
+        logger.info('  Streaming embedding file ("{}")...'.format(self._embed_file))
+        n_found = 0
+        for word, vector in self._iter_vectors(rows):
+            i = rows[word]
+            if trainable[i]:
+                vectors[i] = vector
+                trainable[i] = False
+                n_found += 1
+                if n_found == len(rows):
+                    break
+
+        vectors[trainable] = np.random.uniform(-init_weight, init_weight,
+                                               size=(np.count_nonzero(trainable), self._embedding_type.dim))
+        return vectors, trainable
 
-        return oov, iov
+
+class Word2VecBinaryFactory(LocalFileFactory):
+    """word2vec binary format: a `<#words> <dim>` header line, then each word followed by a space and dim float32s"""
+
+    def __init__(self, embedding_type: EmbeddingType):
+        super(Word2VecBinaryFactory, self).__init__(embedding_type)
+
+    def _iter_vectors(self, words: dict, block_size: int=1 << 22):
+        with open(self._embed_file, 'rb') as embed_file:
+            _, dim = (int(v) for v in embed_file.readline().split())
+            self._check_dim(dim)
+            vec_size = 4 * dim
+
+            buffer, pos = b'', 0
+            while True:
+                sep = buffer.find(b' ', pos)
+                if sep < 0 or len(buffer) < sep + 1 + vec_size:
+                    block = embed_file.read(block_size)
+                    if not block:
+                        return
+                    buffer, pos = buffer[pos:] + block, 0
+                    continue
+
+                word = buffer[pos:sep].strip().decode('utf-8', errors='replace')
+                if word in words:
+                    yield word, np.frombuffer(buffer, dtype='<f4', count=dim, offset=sep + 1)
+                pos = sep + 1 + vec_size
+
+
+class TextFactory(LocalFileFactory):
+    """
+    Text format of GloVe and fastText: a word followed by its space-separated components per line
+    (fastText files start with a `<#words> <dim>` header line)
+    """
+
+    def __init__(self, embedding_type: EmbeddingType):
+        super(TextFactory, self).__init__(embedding_type)
+
+    def _iter_vectors(self, words: dict):
+        dim = self._embedding_type.dim
+        with open(self._embed_file, mode='r', encoding='utf-8', errors='replace') as embed_file:
+            for lno, line in enumerate(embed_file):
+                if lno == 0:
+                    parts = line.split()
+                    if len(parts) == 2:
+                        self._check_dim(int(parts[1]))
+                        continue
+                    # GloVe files have no header, hence the width of the first vector is checked instead
+                    self._check_dim(len(parts) - 1)
+
+                word = line[:line.find(' ')]
+                if word in words:
+                    parts = line.rstrip().rsplit(' ', dim)
+                    if len(parts) != dim + 1:
+                        self._check_dim(len(parts) - 1)
+                    # a few GloVe entries contain spaces (e.g., ". . ."), in which case the word is what precedes
+                    # the components
+                    if parts[0] in words:
+                        yield parts[0], np.array(parts[1:], dtype=np.float32)
+
+
+class NpyFactory(LocalFileFactory):
+    """A `.npy` matrix memory-mapped along with its vocab file (`<name>.vocab`, a word per line in the row order)"""
+
+    def __init__(self, embedding_type: EmbeddingType):
+        super(NpyFactory, self).__init__(embedding_type)
+
+    def _iter_vectors(self, words: dict):
+        matrix = np.load(self._embed_file, mmap_mode='r')
+        self._check_dim(matrix.shape[1])
+
+        with codecs.getreader("utf-8")(open(fs.replace_ext(self._embed_file, 'vocab'), mode="rb")) as vocab_file:
+            for i, line in enumerate(vocab_file):
+                word = line.rstrip('\n')
+                if word in words:
+                    yield word, matrix[i]
+
+    def source_files(self) -> List[str]:
+        return [self._embed_file, fs.replace_ext(self._embed_file, 'vocab')]
+
+
+class EmbeddingCache:
+    """
+    Project-level cache of built embedding files shared by model directories. An entry is keyed by the embedding type,
+    its dimension and a hash of the ordered vocabulary, and is linked into model directories (hardlinked if possible).
+    Concurrent builds of the same entry are serialized by lock files, and the least recently used entries are removed
+    once the cache exceeds `max_size` bytes.
+    """
+
+    def __init__(self, cache_dir: str=None, max_size: int=20 << 30, poll_interval: float=5.0,
+                 lock_timeout: float=6 * 3600):
+        self.cache_dir = cache_dir or str(Path(fs.get_project_root_dir()) / ".embeddings")
+        self.max_size = max_size
+        self.poll_interval = poll_interval
+        self.lock_timeout = lock_timeout
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(embedding_type: EmbeddingType, vocab_list: List[str], source_files: List[str]=()) -> str:
+        """
+        The source type and url of the embedding are part of the key, so that an entry is not reused once the url
+        of the embedding type changes in the config
+        :param source_files: local files the vectors are read from, whose path, size and modification time are
+            part of the key, so that an entry is not reused once its source file is replaced
+        """
+        key_hash = hashlib.sha1('\n'.join(vocab_list).encode('utf-8'))
+        key_hash.update('\n{}\t{}'.format(embedding_type.src_type, embedding_type.url).encode('utf-8'))
+        for source_file in source_files:
+            source_stat = os.stat(source_file)
+            key_hash.update('\n{}\t{}\t{}'.format(os.path.abspath(source_file), source_stat.st_size,
+                                                   source_stat.st_mtime_ns).encode('utf-8'))
+        return "{}_{}_{}".format(embedding_type.name, embedding_type.dim, key_hash.hexdigest()[:20])
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + '.h5')
+
+    def _is_stale(self, lock_path: str) -> bool:
+        try:
+            with open(lock_path, 'r') as lock_file:
+                host, pid = lock_file.read().split()
+            if host == socket.gethostname():
+                os.kill(int(pid), 0)
+                return False
+        except ProcessLookupError:
+            return True
+        except (OSError, ValueError):
+            pass
+
+        # the lock of a process on another host (or an unreadable lock) is considered stale after `lock_timeout`
+
+        try:
+            return time.time() - os.path.getmtime(lock_path) > self.lock_timeout
+        except OSError:
+            return False
+
+    def _try_lock(self, lock_path: str) -> bool:
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if self._is_stale(lock_path):
+                logger.warning("Removing stale lock {}".format(lock_path))
+                fs.rm_if_exists(lock_path)
+            return False
+
+        with os.fdopen(fd, 'w') as lock_file:
+            lock_file.write("{} {}".format(socket.gethostname(), os.getpid()))
+        return True
+
+    def get_or_build(self, key: str, build_fn: Callable[[str], None]) -> str:
+        """
+        :param build_fn: writes the entry into the given path (atomically, e.g., via `EmbeddingUtil.write_vectors`)
+        :return: the path of the cached entry
+        """
+        entry_path = self._entry_path(key)
+        lock_path = entry_path + '.lock'
+
+        while not os.path.exists(entry_path):
+            if self._try_lock(lock_path):
+                try:
+                    if not os.path.exists(entry_path):
+                        build_fn(entry_path)
+                finally:
+                    fs.rm_if_exists(lock_path)
+            elif os.path.exists(lock_path):
+                logger.info("Waiting for another process to build {}".format(entry_path))
+                time.sleep(self.poll_interval)
+
+        os.utime(entry_path)
+        self._cleanup(keep=entry_path)
+        return entry_path
+
+    def _cleanup(self, keep: str):
+        entries = []
+        for f in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, f)
+            if f.endswith('.h5') and path != keep and not os.path.exists(path + '.lock'):
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        total_size = sum(size for _, size, _ in entries) + os.path.getsize(keep)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            logger.info("Evicting {} from the embedding cache".format(path))
+            fs.rm_if_exists(path)
+            total_size -= size
+
+    @staticmethod
+    def link(entry_path: str, target_path: str):
+        tmp_path = target_path + '.tmp'
+        fs.rm_if_exists(tmp_path)
+        try:
+            os.link(entry_path, tmp_path)
+        except OSError:
+            shutil.copyfile(entry_path, tmp_path)
+        replace(tmp_path, target_path)
 
 
 class EmbeddingUtil:
-    def __init__(self, config_path: str='conf/word_embeddings.yml'):
+    def __init__(self, config_path: str='conf/word_embeddings.yml', cache_dir: str=None, cache_size: float=20):
+        """
+        :param cache_dir: directory of the shared embedding cache (defaults to `.embeddings` in the project root)
+        :param cache_size: size limit of the shared embedding cache in GB (0 disables the cache)
+        """
         with open(config_path, 'r') as file:
             self._args = yaml.load(file)
 
+        self._cache = EmbeddingCache(cache_dir, int(cache_size * (1 << 30))) if cache_size else None
+
     @classmethod
     def from_type(cls: Type[T], embedding_type: EmbeddingType) -> EmbeddingFactory:
         if embedding_type.src_type == "tfhub":
@@ -145,59 +386,216 @@ class EmbeddingUtil:
             return MagnitudeFactory(embedding_type)
         elif embedding_type.src_type == "random":
             return RandomFactory(embedding_type)
+        elif embedding_type.src_type == "word2vec_bin":
+            return Word2VecBinaryFactory(embedding_type)
+        elif embedding_type.src_type == "text":
+            return TextFactory(embedding_type)
+        elif embedding_type.src_type == "npy":
+            return NpyFactory(embedding_type)
         else:
             raise ValueError(
                 "Unknown source type '{}' defined in the embedding config file".format(embedding_type.src_type))
 
     @classmethod
-    def load_vectors(cls: Type[T], vocab_h5: str, vocab_file: str) -> (np.ndarray, np.ndarray, np.ndarray):
+    def write_vectors(cls: Type[T], vocab_h5: str, vocab_list: List[str], vectors: np.ndarray, trainable: np.ndarray):
+        """
+        Writes the embedding matrix in the order of vocab_list as contiguous datasets: `vectors` (float32[V, D]),
+        `trainable` and `reserved` (bool[V]) and `vocab` (the words), so that the matrix is read at once
+        (or memory-mapped, see `load_matrix`)
+        """
+        tmp_h5 = vocab_h5 + '.tmp'
+        with h5py.File(tmp_h5, mode='w') as vec_h5:
+            vec_h5.create_dataset("vectors", data=np.asarray(vectors, dtype=np.float32))
+            vec_h5.create_dataset("trainable", data=np.asarray(trainable, dtype=bool))
+            vec_h5.create_dataset("reserved",
+                                  data=np.array([w in vocab.RESERVED_WORDS for w in vocab_list], dtype=bool))
+            vec_h5.create_dataset("vocab", data=np.array(vocab_list, dtype=object), dtype=h5py.special_dtype(vlen=str))
+        replace(tmp_h5, vocab_h5)
+
+    @classmethod
+    def _migrate(cls: Type[T], vocab_h5: str, vocab_list: List[str]):
+        """Rewrites an h5 file of the former layout (i.e., `{word}/vec` and `{word}/trainable` datasets per word)"""
+        logger.info("Migrating {} to the contiguous layout".format(vocab_h5))
+        with h5py.File(vocab_h5, mode='r') as vec_h5:
+            vectors = np.asarray([vec_h5["{key}/vec".format(key=w)][...] for w in vocab_list], dtype=np.float32)
+            trainable = np.asarray([bool(vec_h5["{key}/trainable".format(key=w)][...]) for w in vocab_list],
+                                   dtype=bool)
+
+        cls.write_vectors(vocab_h5, vocab_list, vectors, trainable)
+
+    @staticmethod
+    def _read_vocab(vec_h5) -> List[str]:
+        return [w.decode('utf-8') if isinstance(w, bytes) else w for w in vec_h5["vocab"][...]]
+
+    @classmethod
+    def load_matrix(cls: Type[T], vocab_h5: str, vocab_file: str, mmap: bool=False) -> \
+            (np.ndarray, np.ndarray, np.ndarray):
+        """
+        :return: the embedding matrix along with the trainable and reserved masks in the order of the vocab file.
+            With `mmap`, the matrix is memory-mapped (read-only) from the h5 file if its rows are in that order.
+        """
         vocab_list, _ = vocab.load_vocab(vocab_file)
 
-        reserved_words, trainables, frozens = [], [], []
         with h5py.File(vocab_h5, mode='r') as vec_h5:
-            for w in vocab_list:
-                vec = vec_h5["{key}/vec".format(key=w)][...]
-                is_trainable = vec_h5["{key}/trainable".format(key=w)][...]
-                if w in vocab.RESERVED_WORDS:
-                    reserved_words.append(vec)
-                if is_trainable:
-                    trainables.append(vec)
+            is_migrated = "vectors" in vec_h5
+        if not is_migrated:
+            cls._migrate(vocab_h5, vocab_list)
+
+        with h5py.File(vocab_h5, mode='r') as vec_h5:
+            h5_vocab = cls._read_vocab(vec_h5)
+            trainable = vec_h5["trainable"][...]
+            dataset = vec_h5["vectors"]
+
+            if h5_vocab == vocab_list:
+                offset = dataset.id.get_offset()
+                if mmap and offset is not None:
+                    vectors = np.memmap(vocab_h5, dtype=np.float32, mode='r', offset=offset, shape=dataset.shape)
                 else:
-                    frozens.append(vec)
+                    vectors = dataset[...]
+            else:
+                rows = {w: i for i, w in enumerate(h5_vocab)}
+                indices = [rows[w] for w in vocab_list]
+                vectors, trainable = dataset[...][indices], trainable[indices]
 
-        return np.asarray(reserved_words), np.asarray(trainables), np.asarray(frozens)
+        reserved = np.array([w in vocab.RESERVED_WORDS for w in vocab_list], dtype=bool)
+        return vectors, trainable, reserved
 
-    def build_if_not_exists(self, embedding_type: str, vocab_h5: str, vocab_file: str, overwrite: bool=False):
-        if Path(vocab_h5).exists() and not overwrite:
-            return
+    @classmethod
+    def load_vectors(cls: Type[T], vocab_h5: str, vocab_file: str) -> (np.ndarray, np.ndarray, np.ndarray):
+        """
+        Loads the reserved, trainable and frozen vectors once per process (i.e., the train, eval and infer graphs
+        share them) as long as the files are unchanged. The returned arrays are read-only.
+        """
+        key = tuple((path, os.stat(path).st_mtime_ns) for path in (os.path.abspath(vocab_h5),
+                                                                   os.path.abspath(vocab_file)))
+        if key not in _loaded_vectors:
+            vectors, trainable, reserved = cls.load_matrix(vocab_h5, vocab_file)
+            loaded = vectors[reserved], vectors[trainable], vectors[~trainable]
+            for array in loaded:
+                array.flags.writeable = False
 
-        sw = Stopwatch()
+            _loaded_vectors.clear()
+            _loaded_vectors[key] = loaded
+
+        return _loaded_vectors[key]
 
+    def embedding_type(self, embedding_type: str) -> EmbeddingType:
         if embedding_type.lower().startswith("random"):
             try:
                 dim = int(embedding_type[len("random"):])
             except ValueError:
                 dim = 300
                 logger.warning("Unrecognizable dimension for random embedding. Set to default: {}".format(dim))
-            _embed_type = EmbeddingType(embedding_type, "", dim, "random")
+            return EmbeddingType(embedding_type, "", dim, "random")
         else:
             e = self._args[embedding_type]
-            _embed_type = EmbeddingType(embedding_type, e["url"], e["dim"], e["src_type"])
+            return EmbeddingType(embedding_type, e["url"], e["dim"], e["src_type"])
+
+    @classmethod
+    def _build(cls: Type[T], embedding_type: EmbeddingType, vocab_list: List[str], vocab_h5: str):
+        vectors, trainable = cls.from_type(embedding_type).build(vocab_list)
+
+        # the vocabulary is reordered as the reserved words, the trainable (OOV) words and the frozen (IV) words
+        rows = {w: i for i, w in enumerate(vocab_list)}
+        oov = [w for w, is_trainable in zip(vocab_list, trainable) if is_trainable and w not in vocab.RESERVED_WORDS]
+        iov = [w for w, is_trainable in zip(vocab_list, trainable)
+               if not is_trainable and w not in vocab.RESERVED_WORDS]
+        ordered_vocab = vocab.RESERVED_WORDS + oov + iov
+        indices = [rows[w] for w in ordered_vocab]
+
+        cls.write_vectors(vocab_h5, ordered_vocab, vectors[indices], trainable[indices])
+
+    def build_if_not_exists(self, embedding_type: str, vocab_h5: str, vocab_file: str, overwrite: bool=False):
+        if Path(vocab_h5).exists() and not overwrite:
+            return
+
+        sw = Stopwatch()
 
+        _embed_type = self.embedding_type(embedding_type)
         vocab_list, _ = vocab.load_vocab(vocab_file)
-        oov, iov = EmbeddingUtil.from_type(_embed_type).build(vocab_list, vocab_h5)
+
+        # random vectors are cheap to build, hence not worth caching
+        if self._cache is None or _embed_type.src_type == "random":
+            self._build(_embed_type, vocab_list, vocab_h5)
+        else:
+            # besides the url, the local files are part of the key
+            source_files = []
+            if _embed_type.src_type in ("word2vec_bin", "text", "npy"):
+                source_files = self.from_type(_embed_type).source_files()
+            entry_path = self._cache.get_or_build(self._cache.key(_embed_type, vocab_list, source_files),
+                                                  lambda path: self._build(_embed_type, vocab_list, path))
+            EmbeddingCache.link(entry_path, vocab_h5)
+
+        with h5py.File(vocab_h5, mode='r') as vec_h5:
+            ordered_vocab = self._read_vocab(vec_h5)
 
         rename(vocab_file, fs.replace_ext(vocab_file, 'tf'))
         with codecs.getwriter("utf-8")(open(vocab_file, "wb")) as writer:
-            for rw in vocab.RESERVED_WORDS:
-                writer.write("{}\n".format(rw))
+            for w in ordered_vocab:
+                writer.write("{}\n".format(w))
+
+        logger.info("Embedding vectors built from {} in {:.1f}s".format(embedding_type, sw.elapsed()))
 
-            for w in oov:
-                if w not in vocab.RESERVED_WORDS:
-                    writer.write("{}\n".format(w))
 
-            for w in iov:
-                if w not in vocab.RESERVED_WORDS:
-                    writer.write("{}\n".format(w))
+def benchmark(embedding_types: List[str], vocab_file: str, config_path: str='conf/word_embeddings.yml',
+              init_weight: float=0.1, page_size: int=15000):
+    """Compares the batched factory builds against the former per-word builds for each embedding type"""
+    embedding_util = EmbeddingUtil(config_path)
+    vocab_list, _ = vocab.load_vocab(vocab_file)
 
-        logger.info("Embedding vectors built from {} in {:.1f}s".format(embedding_type, sw.elapsed()))
+    for name in embedding_types:
+        _embed_type = embedding_util.embedding_type(name)
+        factory = EmbeddingUtil.from_type(_embed_type)
+
+        sw = Stopwatch()
+        expected_vectors = np.zeros((len(vocab_list), _embed_type.dim), dtype=np.float32)
+        expected_trainable = np.zeros(len(vocab_list), dtype=bool)
+        if _embed_type.src_type == "magnitude":
+            for i, w in enumerate(vocab_list):
+                expected_trainable[i] = w not in factory._magnitude_vecs
+                expected_vectors[i] = factory._magnitude_vecs.query(w)
+        elif _embed_type.src_type == "tfhub":
+            environ["TFHUB_CACHE_DIR"] = ".tfhub_modules"
+            embedder = hub.Module(_embed_type.url)
+            with tf.Session() as sess:
+                sess.run([tf.global_variables_initializer(), tf.tables_initializer()])
+                for lb in range(0, len(vocab_list), page_size):
+                    page = vocab_list[lb:lb + page_size]
+                    embedding_vectors = sess.run(embedder(page))
+                    for j, word in enumerate(page):
+                        is_oov = sum(embedding_vectors[j]) == 0
+                        if is_oov:
+                            expected_vectors[lb + j] = np.random.uniform(-init_weight, init_weight, _embed_type.dim)
+                        else:
+                            expected_vectors[lb + j] = embedding_vectors[j]
+                        expected_trainable[lb + j] = is_oov
+        else:
+            for i, w in enumerate(vocab_list):
+                expected_vectors[i] = np.random.uniform(-init_weight, init_weight, size=_embed_type.dim)
+            expected_trainable[:] = True
+        per_word_time = sw.elapsed()
+
+        sw.start()
+        vectors, trainable = factory.build(vocab_list, init_weight=init_weight, page_size=page_size)
+        batched_time = sw.elapsed()
+
+        if not np.array_equal(trainable, expected_trainable) or \
+                not np.allclose(vectors[~trainable], expected_vectors[~expected_trainable], atol=1e-6):
+            raise AssertionError('Batched build of {} differs from the per-word build'.format(name))
+
+        print('{}: {} words ({} OOV) - per word {:.1f}s | batched {:.1f}s | speedup {:.1f}x'.format(
+            name, len(vocab_list), np.count_nonzero(trainable), per_word_time, batched_time,
+            per_word_time / max(batched_time, 1e-9)))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='benchmarks the embedding builds')
+    parser.add_argument('-v', '--vocab', type=str, required=True, help='vocab file')
+    parser.add_argument('-e', '--embedding_types', type=str, nargs='+', default=['random300'],
+                        help='embedding types (e.g., glove840B, hub_word2vec or random300)')
+    parser.add_argument('--config', type=str, default='conf/word_embeddings.yml', help='embedding config file')
+    args = parser.parse_args()
+
+    benchmark(args.embedding_types, args.vocab, args.config)
@@ -88,10 +88,46 @@ def rm_by_extension(working_dir, ext):
 
 def count_lines(file_path):
     # https://gist.github.com/zed/0ac760859e614cd03652
-    with open(file_path, 'rbU') as f:
+    with open(file_path, 'rb') as f:
         return sum(1 for _ in f)
 
 
+def split_lines(file_path, n_chunks):
+    """
+    Splits a file into at most `n_chunks` byte ranges of (almost) equal size such that
+    every range starts at the beginning of a line and ends right after a newline (or at EOF).
+    """
+    size = os.path.getsize(file_path)
+    boundaries = [0]
+
+    with open(file_path, 'rb') as f:
+        for i in range(1, n_chunks):
+            pos = size * i // n_chunks
+            if pos <= boundaries[-1]:
+                continue
+
+            f.seek(pos - 1)
+            f.readline()
+            boundary = f.tell()
+            if boundaries[-1] < boundary < size:
+                boundaries.append(boundary)
+
+    boundaries.append(size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def read_lines(file_path, start=0, end=None):
+    """Iterates over the lines (as bytes) whose first byte lies in [start, end)"""
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        pos = start
+        for line in f:
+            if end is not None and pos >= end:
+                break
+            pos += len(line)
+            yield line
+
+
 def save_obj(obj, name):
     with open(name, 'wb') as f:
         pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL)
@@ -0,0 +1,124 @@
+""" Persistent index of line offsets in a text file, stored as a sidecar `<file>.idx` file.
+    The index is built once in a streaming pass and rebuilt whenever the size or the modification time
+    of the file changes. It enables O(1) line counts, random access to lines and uniform line sampling
+    without reading the whole file.
+"""
+import mmap
+import os
+import random
+
+import numpy as np
+
+# the header holds the size and the modification time (ns) of the indexed file
+_HEADER_SIZE = 2
+_BLOCK_SIZE = 1 << 24
+
+
+def index_path(file_path):
+    return file_path + '.idx'
+
+
+def _file_signature(file_path):
+    stat = os.stat(file_path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _is_valid_index(file_path):
+    path = index_path(file_path)
+    if not os.path.exists(path) or os.path.getsize(path) < (_HEADER_SIZE + 1) * 8:
+        return False
+
+    header = np.fromfile(path, dtype=np.uint64, count=_HEADER_SIZE)
+    return tuple(int(v) for v in header) == _file_signature(file_path)
+
+
+def is_indexable(file_path):
+    """Whether a file is local and either its index is valid or it can be written next to the file"""
+    if '://' in file_path:
+        return False
+    return _is_valid_index(file_path) or os.access(os.path.dirname(os.path.abspath(file_path)), os.W_OK)
+
+
+def build_index(file_path):
+    """Writes the offsets of the beginnings of lines (plus the size of the file) next to the file"""
+    size, mtime_ns = _file_signature(file_path)
+
+    tmp_path = index_path(file_path) + '.tmp'
+    with open(file_path, 'rb') as f, open(tmp_path, 'wb') as idx_file:
+        np.array([size, mtime_ns], dtype=np.uint64).tofile(idx_file)
+
+        pos = 0
+        last_char = b'\n'
+        while True:
+            block = f.read(_BLOCK_SIZE)
+            if not block:
+                break
+
+            if last_char == b'\n':
+                np.array([pos], dtype=np.uint64).tofile(idx_file)
+            newlines = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == ord('\n'))
+            line_starts = newlines[newlines < len(block) - 1] + pos + 1
+            line_starts.astype(np.uint64).tofile(idx_file)
+
+            pos += len(block)
+            last_char = block[-1:]
+
+        np.array([pos], dtype=np.uint64).tofile(idx_file)
+
+    os.replace(tmp_path, index_path(file_path))
+
+
+class LineIndex:
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+
+        if not _is_valid_index(file_path):
+            build_index(file_path)
+
+        self._offsets = np.memmap(index_path(file_path), dtype=np.uint64, mode='r', offset=_HEADER_SIZE * 8)
+        self._file = None
+        self._mmap = None
+
+    def _data(self):
+        if self._mmap is None:
+            self._file = open(self.file_path, 'rb')
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def raw_line(self, i):
+        """The bytes of the i-th line including its line break"""
+        if not 0 <= i < len(self):
+            raise IndexError('line index out of range: {}'.format(i))
+        return self._data()[int(self._offsets[i]):int(self._offsets[i + 1])]
+
+    def __getitem__(self, i):
+        """The i-th line decoded and stripped (the same as the lines of `_load_data` in the models)"""
+        return self.raw_line(int(i)).decode('utf-8').strip()
+
+    def sample(self, k=1, rnd=random):
+        """Line numbers of `k` distinct lines drawn uniformly at random"""
+        return rnd.sample(range(len(self)), min(k, len(self)))
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._file.close()
+            self._mmap, self._file = None, None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class LoadedLines(list):
+    """In-memory counterpart of `LineIndex` over the (stripped) lines of a file that cannot be indexed"""
+
+    def sample(self, k=1, rnd=random):
+        """Line numbers of `k` distinct lines drawn uniformly at random"""
+        return rnd.sample(range(len(self)), min(k, len(self)))
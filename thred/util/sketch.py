@@ -0,0 +1,257 @@
+""" Probabilistic sketches to summarize large streams of tokens in bounded memory.
+    All the sketches here are mergeable, meaning that the sketches built over disjoint shards of a corpus
+    (e.g., in different processes) can be combined into a sketch of the whole corpus.
+"""
+import heapq
+import math
+
+import numpy as np
+import xxhash
+
+_MASK64 = 0xFFFFFFFFFFFFFFFF
+_GOLDEN_GAMMA = 0x9E3779B97F4A7C15
+
+
+def hash_token(token):
+    """64-bit hash of a token which is stable across processes (unlike the builtin `hash`)"""
+    if isinstance(token, str):
+        token = token.encode('utf-8')
+    return xxhash.xxh64_intdigest(token)
+
+
+def _finalize(h):
+    # SplitMix64 finalizer to spread the combined hash over all the 64 bits
+    h = ((h ^ (h >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+    h = ((h ^ (h >> 27)) * 0x94D049BB133111EB) & _MASK64
+    return h ^ (h >> 31)
+
+
+def finalize_hashes(keys):
+    """Vectorized version of the finalizer to turn arbitrary 64-bit keys (e.g., packed token ids) into hashes"""
+    h = np.asarray(keys, dtype=np.uint64)
+    h = (h ^ (h >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    h = (h ^ (h >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return h ^ (h >> np.uint64(31))
+
+
+def ngram_hashes(token_hashes, n):
+    """
+    Yields the hashes of the n-grams in a sequence of token hashes, so that n-grams
+    can be hashed without building the joined n-gram string.
+    The combination is order-sensitive, i.e., "a b" and "b a" are hashed differently.
+    """
+    for i in range(len(token_hashes) - n + 1):
+        h = token_hashes[i]
+        for j in range(i + 1, i + n):
+            h = ((h * _GOLDEN_GAMMA) + token_hashes[j]) & _MASK64
+        yield _finalize(h)
+
+
+def _bit_length(values):
+    """Vectorized `int.bit_length` for an array of uint64"""
+    values = values.copy()
+    lengths = np.zeros(values.shape, dtype=np.int64)
+    for shift in (32, 16, 8, 4, 2, 1):
+        mask = values >= np.uint64(1 << shift)
+        lengths[mask] += shift
+        values[mask] >>= np.uint64(shift)
+    lengths += (values > 0)
+    return lengths
+
+
+class HyperLogLog:
+    """ HyperLogLog cardinality estimator (Flajolet et al., 2007) with 64-bit hashes and the linear counting
+        correction for small cardinalities (Heule et al., 2013).
+        The relative standard error is 1.04 / sqrt(2 ** precision), e.g., 0.81% for the default precision
+        which is the same as Redis' PFCOUNT.
+    """
+
+    def __init__(self, precision=14):
+        if not 4 <= precision <= 18:
+            raise ValueError('precision must be in [4, 18]: {}'.format(precision))
+
+        self.precision = precision
+        self._num_registers = 1 << precision
+        self._index_shift = 64 - precision
+        self._suffix_mask = (1 << self._index_shift) - 1
+        self._registers = bytearray(self._num_registers)
+
+    def add(self, token):
+        self.add_hash(_finalize(hash_token(token)))
+
+    def add_hash(self, h):
+        index = h >> self._index_shift
+        rank = self._index_shift - (h & self._suffix_mask).bit_length() + 1
+        if rank > self._registers[index]:
+            self._registers[index] = rank
+
+    def add_hashes(self, hashes):
+        """Adds an array of 64-bit hashes at once"""
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        if hashes.size == 0:
+            return
+
+        indices = (hashes >> np.uint64(self._index_shift)).astype(np.intp)
+        ranks = self._index_shift - _bit_length(hashes & np.uint64(self._suffix_mask)) + 1
+        np.maximum.at(self._as_array(), indices, ranks.astype(np.uint8))
+
+    def merge(self, other):
+        if self.precision != other.precision:
+            raise ValueError('cannot merge sketches with different precisions: {} vs. {}'.format(
+                self.precision, other.precision))
+
+        np.maximum(self._as_array(), other._as_array(), out=self._as_array())
+        return self
+
+    def count(self):
+        registers = self._as_array()
+        m = self._num_registers
+
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / np.sum(np.ldexp(1.0, -registers.astype(np.int64)))
+
+        zeros = m - np.count_nonzero(registers)
+        if estimate <= 2.5 * m and zeros > 0:
+            estimate = m * math.log(m / zeros)
+
+        return int(round(estimate))
+
+    def _as_array(self):
+        return np.frombuffer(self._registers, dtype=np.uint8)
+
+    def __len__(self):
+        return self.count()
+
+
+class CountMinSketch:
+    """ Count-Min sketch (Cormode and Muthukrishnan, 2005) over 64-bit hashes.
+        Estimates never underestimate and, with probability 1 - exp(-depth),
+        overestimate by at most e / width * total_count.
+    """
+
+    def __init__(self, width=1 << 20, depth=4):
+        self.width = width
+        self.depth = depth
+        self.total_count = 0
+        self._table = np.zeros((depth, width), dtype=np.int64)
+
+    def _indices(self, hashes):
+        h1 = hashes & np.uint64(0xFFFFFFFF)
+        h2 = hashes >> np.uint64(32)
+        return [((h1 + np.uint64(d) * h2) % np.uint64(self.width)).astype(np.intp) for d in range(self.depth)]
+
+    def add_hashes(self, hashes, counts=1):
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        if hashes.size == 0:
+            return
+
+        counts = np.broadcast_to(np.asarray(counts, dtype=np.int64), hashes.shape)
+        for d, indices in enumerate(self._indices(hashes)):
+            np.add.at(self._table[d], indices, counts)
+        self.total_count += int(counts.sum())
+
+    def estimate_hashes(self, hashes):
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        estimates = None
+        for d, indices in enumerate(self._indices(hashes)):
+            row = self._table[d][indices]
+            estimates = row if estimates is None else np.minimum(estimates, row)
+        return estimates
+
+    def error_bound(self):
+        return int(math.ceil(math.e / self.width * self.total_count))
+
+    def merge(self, other):
+        if self._table.shape != other._table.shape:
+            raise ValueError('cannot merge sketches with different shapes: {} vs. {}'.format(
+                self._table.shape, other._table.shape))
+
+        self._table += other._table
+        self.total_count += other.total_count
+        return self
+
+
+class SpaceSaving:
+    """ Space-Saving heavy hitters (Metwally et al., 2005) with at most `capacity` counters.
+        Any item whose frequency exceeds total_count / capacity is guaranteed to be monitored and the
+        count of a monitored item overestimates its true frequency by at most its error.
+        Merging follows the mergeable summaries of Agarwal et al. (2012).
+    """
+
+    def __init__(self, capacity):
+        if capacity <= 0:
+            raise ValueError('capacity must be positive: {}'.format(capacity))
+
+        self.capacity = capacity
+        self.total_count = 0
+        self._counts = {}
+        self._errors = {}
+        # lazy min-heap: an entry may hold an outdated (i.e., smaller) count of its item
+        self._heap = []
+
+    def add(self, item, count=1):
+        """Adds an item and returns the item evicted to make room for it, if any"""
+        self.total_count += count
+
+        if item in self._counts:
+            self._counts[item] += count
+            return None
+
+        if len(self._counts) < self.capacity:
+            self._counts[item] = count
+            self._errors[item] = 0
+            heapq.heappush(self._heap, (count, item))
+            return None
+
+        evicted, min_count = self._pop_min()
+        del self._counts[evicted]
+        del self._errors[evicted]
+
+        self._counts[item] = min_count + count
+        self._errors[item] = min_count
+        heapq.heappush(self._heap, (min_count + count, item))
+        return evicted
+
+    def _pop_min(self):
+        while True:
+            count, item = self._heap[0]
+            current_count = self._counts[item]
+            if current_count == count:
+                heapq.heappop(self._heap)
+                return item, count
+            heapq.heapreplace(self._heap, (current_count, item))
+
+    def min_count(self):
+        if len(self._counts) < self.capacity:
+            return 0
+        return min(self._counts.values())
+
+    def merge(self, other):
+        min_self, min_other = self.min_count(), other.min_count()
+
+        merged = []
+        for item in set(self._counts).union(other._counts):
+            count = self._counts.get(item, min_self) + other._counts.get(item, min_other)
+            error = self._errors.get(item, min_self) + other._errors.get(item, min_other)
+            merged.append((count, error, item))
+
+        merged = heapq.nlargest(self.capacity, merged, key=lambda x: x[0])
+        self._counts = {item: count for count, _, item in merged}
+        self._errors = {item: error for _, error, item in merged}
+        self._heap = [(count, item) for count, _, item in merged]
+        heapq.heapify(self._heap)
+        self.total_count += other.total_count
+        return self
+
+    def top(self, k=None):
+        """Returns (item, count, error) tuples in the descending order of counts"""
+        items = sorted(self._counts, key=self._counts.get, reverse=True)
+        if k is not None:
+            items = items[:k]
+        return [(item, self._counts[item], self._errors[item]) for item in items]
+
+    def __contains__(self, item):
+        return item in self._counts
+
+    def __len__(self):
+        return len(self._counts)
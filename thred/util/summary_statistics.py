@@ -1,5 +1,7 @@
 import math
 
+import numpy as np
+
 
 class SummaryStat:
     def __init__(self) -> None:
@@ -21,6 +23,46 @@ class SummaryStat:
         self.__avg += diff / self.__count
         self.__variance += diff * (value - self.__avg)
 
+    def accept_many(self, values, counts=None):
+        """Accepts an array of values, each of which occurs `counts` times (if given)"""
+        values = np.asarray(values)
+        if counts is not None:
+            counts = np.asarray(counts)
+            values, counts = values[counts > 0], counts[counts > 0]
+        if values.size == 0:
+            return
+
+        if counts is None:
+            avg = float(values.mean())
+            self.__combine(values.size, values.sum().item(), avg, float(((values - avg) ** 2).sum()),
+                           values.min().item(), values.max().item())
+        else:
+            count = counts.sum().item()
+            total = (values * counts).sum().item()
+            avg = total / count
+            self.__combine(count, total, avg, float((counts * (values - avg) ** 2).sum()),
+                           values.min().item(), values.max().item())
+
+    def merge(self, other):
+        """Merges the stat of another (e.g., computed in another process) into this one"""
+        if other.__count > 0:
+            self.__combine(other.__count, other.__sum, other.__avg, other.__variance, other.__min, other.__max)
+        return self
+
+    def __combine(self, count, sum, avg, variance, min_value, max_value):
+        # parallel algorithm of Chan et al. (1979) for combining the moments of two partitions
+        total_count = self.__count + count
+        diff = avg - self.__avg
+        self.__variance += variance + diff * diff * self.__count * count / total_count
+        self.__avg += diff * count / total_count
+        self.__count = total_count
+        self.__sum += sum
+        self.__min = min(self.__min, min_value)
+        self.__max = max(self.__max, max_value)
+
+    def get_count(self):
+        return self.__count
+
     def get_average(self):
         return self.__avg
 
@@ -40,24 +82,160 @@ class SummaryStat:
         return self.__max
 
 
-class SampledSummaryStat(SummaryStat):
+class HistogramSummaryStat(SummaryStat):
+    """
+    Exact summary of small non-negative integers (e.g., token lengths) kept as a histogram of counts,
+    so its memory only depends on the largest value observed.
+    """
 
     def __init__(self) -> None:
-        super(SampledSummaryStat, self).__init__()
-        self.__samples = []
+        super(HistogramSummaryStat, self).__init__()
+        self.__counts = np.zeros(64, dtype=np.int64)
+
+    def __ensure_capacity(self, max_value):
+        if max_value >= len(self.__counts):
+            counts = np.zeros(max(max_value + 1, 2 * len(self.__counts)), dtype=np.int64)
+            counts[:len(self.__counts)] = self.__counts
+            self.__counts = counts
 
     def accept(self, value):
-        super(SampledSummaryStat, self).accept(value)
-        self.__samples.append(value)
+        if value < 0 or int(value) != value:
+            raise ValueError('only non-negative integers are accepted: {}'.format(value))
+
+        super(HistogramSummaryStat, self).accept(value)
+        self.__ensure_capacity(int(value))
+        self.__counts[int(value)] += 1
+
+    def accept_many(self, values, counts=None):
+        values = np.asarray(values)
+        if values.size == 0:
+            return
+        if values.dtype.kind not in 'iu' or values.min() < 0:
+            raise ValueError('only non-negative integers are accepted')
+        # np.bincount does not accept uint64 (e.g., memmapped lengths)
+        values = values.astype(np.int64, copy=False)
+
+        super(HistogramSummaryStat, self).accept_many(values, counts)
+        if counts is None:
+            histogram = np.bincount(values.ravel())
+        else:
+            histogram = np.zeros(values.max() + 1, dtype=np.int64)
+            np.add.at(histogram, values.ravel(), np.asarray(counts, dtype=np.int64).ravel())
+        self.__ensure_capacity(len(histogram) - 1)
+        self.__counts[:len(histogram)] += histogram
+
+    def merge(self, other):
+        super(HistogramSummaryStat, self).merge(other)
+        self.__ensure_capacity(len(other.__counts) - 1)
+        self.__counts[:len(other.__counts)] += other.__counts
+        return self
+
+    def get_count_below(self, value):
+        """The number of values less than `value`"""
+        return int(self.__counts[:max(0, int(value))].sum())
+
+    def __value_at(self, rank):
+        return int(np.searchsorted(np.cumsum(self.__counts), rank, side='right'))
 
     def get_median(self):
-        if not self.__samples:
+        count = self.get_count()
+        if not count:
             return 0.0
 
-        sorted_samples = sorted(self.__samples)
-        mid_index = len(sorted_samples) // 2
-
-        if len(sorted_samples) % 2 == 0:
-            return (sorted_samples[mid_index - 1] + sorted_samples[mid_index]) / 2
+        mid_index = count // 2
+        if count % 2 == 0:
+            return (self.__value_at(mid_index - 1) + self.__value_at(mid_index)) / 2
         else:
-            return sorted_samples[mid_index]
+            return self.__value_at(mid_index)
+
+    def get_percentile(self, percentile):
+        """Nearest-rank percentile, e.g., get_percentile(90) for p90"""
+        count = self.get_count()
+        if not count:
+            return 0.0
+        return self.__value_at(int(percentile / 100 * (count - 1)))
+
+
+class QuantileSketchSummaryStat(SummaryStat):
+    """
+    Summary of arbitrary floats whose quantiles are estimated with a relative error of at most
+    `relative_accuracy`, following DDSketch (Masson et al., 2019): values are counted in logarithmically
+    sized buckets, so its memory only depends on the range of the values and it is mergeable.
+    """
+
+    def __init__(self, relative_accuracy=0.01) -> None:
+        super(QuantileSketchSummaryStat, self).__init__()
+        if not 0 < relative_accuracy < 1:
+            raise ValueError('relative_accuracy must be in (0, 1): {}'.format(relative_accuracy))
+
+        self.relative_accuracy = relative_accuracy
+        self.__gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.__log_gamma = math.log(self.__gamma)
+        self.__positive_buckets = {}
+        self.__negative_buckets = {}
+        self.__zero_count = 0
+
+    def __add_to_buckets(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+
+        self.__zero_count += int(np.count_nonzero(values == 0))
+        for buckets, magnitudes in ((self.__positive_buckets, values[values > 0]),
+                                    (self.__negative_buckets, -values[values < 0])):
+            if magnitudes.size == 0:
+                continue
+
+            indices, counts = np.unique(np.ceil(np.log(magnitudes) / self.__log_gamma).astype(np.int64),
+                                        return_counts=True)
+            for index, count in zip(indices.tolist(), counts.tolist()):
+                buckets[index] = buckets.get(index, 0) + count
+
+    def accept(self, value):
+        super(QuantileSketchSummaryStat, self).accept(value)
+        self.__add_to_buckets([value])
+
+    def accept_many(self, values):
+        super(QuantileSketchSummaryStat, self).accept_many(values)
+        self.__add_to_buckets(values)
+
+    def merge(self, other):
+        if self.relative_accuracy != other.relative_accuracy:
+            raise ValueError('cannot merge sketches with different accuracies: {} vs. {}'.format(
+                self.relative_accuracy, other.relative_accuracy))
+
+        super(QuantileSketchSummaryStat, self).merge(other)
+        for buckets, other_buckets in ((self.__positive_buckets, other.__positive_buckets),
+                                       (self.__negative_buckets, other.__negative_buckets)):
+            for index, count in other_buckets.items():
+                buckets[index] = buckets.get(index, 0) + count
+        self.__zero_count += other.__zero_count
+        return self
+
+    def __bucket_value(self, index):
+        return 2 * self.__gamma ** index / (self.__gamma + 1)
+
+    def get_percentile(self, percentile):
+        count = self.get_count()
+        if not count:
+            return 0.0
+
+        rank = int(percentile / 100 * (count - 1))
+
+        cumulative = 0
+        for index in sorted(self.__negative_buckets, reverse=True):
+            cumulative += self.__negative_buckets[index]
+            if cumulative > rank:
+                return max(-self.__bucket_value(index), self.get_min())
+
+        cumulative += self.__zero_count
+        if cumulative > rank:
+            return 0.0
+
+        for index in sorted(self.__positive_buckets):
+            cumulative += self.__positive_buckets[index]
+            if cumulative > rank:
+                return min(self.__bucket_value(index), self.get_max())
+
+        return self.get_max()
+
+    def get_median(self):
+        return self.get_percentile(50)
@@ -0,0 +1,489 @@
+""" Parallel, bounded-memory term counting over the lines of a text file.
+    The file is split into newline-aligned byte ranges (see `fs.split_lines`) and the terms of each range are
+    counted in a process pool into `SpillingCounter`s, which write their counts to sorted runs on disk whenever
+    they hold too many terms. The runs of all the ranges are then merged by term, at most `MAX_MERGE_FAN_IN` runs
+    at a time (i.e., open files per counter). Along with its count, every
+    term keeps the rank of its first occurrence in the file, so that terms can be ordered the same as counting
+    the whole file in a single loop (e.g., to break ties in frequencies by the first occurrence).
+
+    The term frequencies of dialogue files are cached next to the file in `<file>.tf.npz` (see `TermFrequencies`)
+    and the cache is rebuilt whenever the size or the modification time of the file changes.
+"""
+import array
+import bisect
+import functools
+import heapq
+import multiprocessing
+import os
+import pickle
+import tempfile
+from collections import Counter
+
+import numpy as np
+
+from . import fs
+
+
+# number of distinct terms a counter keeps in memory (per process) before spilling them to disk
+MAX_TERMS_IN_MEMORY = 1000000
+
+# number of runs merged at once (i.e., open files per counter)
+MAX_MERGE_FAN_IN = 64
+
+# ranks of first occurrences are offset by the index of the range shifted by this many bits
+_RANGE_RANK_SHIFT = 40
+_RUN_BATCH_SIZE = 10000
+_ABSENT = np.iinfo(np.int64).max
+_CACHE_VERSION = 2
+
+
+class SpillingCounter:
+    """
+    Counts (orderable) keys along with the rank of their first occurrence while keeping at most `max_keys` keys in
+    memory: once full, the counts are written to a run sorted by key in `spill_dir` and counting starts over.
+    """
+
+    def __init__(self, max_keys=None, spill_dir=None, rank_offset=0):
+        self.max_keys = max_keys
+        self.spill_dir = spill_dir
+        self._counts = Counter()
+        # the rank of a key in memory is its insertion position (i.e., the order of `Counter`) plus this offset
+        self._rank_offset = rank_offset
+        self._runs = []
+
+    def add(self, key, count=1):
+        self._counts[key] += count
+        if self.max_keys is not None and len(self._counts) >= self.max_keys:
+            self._spill()
+
+    def update(self, keys):
+        self._counts.update(keys)
+        if self.max_keys is not None and len(self._counts) >= self.max_keys:
+            self._spill()
+
+    def _sorted_items(self):
+        items = [(key, count, self._rank_offset + rank) for rank, (key, count) in enumerate(self._counts.items())]
+        items.sort(key=lambda item: item[0])
+        return items
+
+    def flush(self):
+        """Spills the counts in memory (if any) to disk"""
+        if self._counts:
+            self._spill()
+
+    def _spill(self):
+        self._runs.append(_write_run(self._sorted_items(), self.spill_dir))
+        self._rank_offset += len(self._counts)
+        self._counts = Counter()
+
+    def items(self):
+        """Yields (key, count, rank of the first occurrence) in the order of keys"""
+        return merge_counters([self])
+
+
+def merge_counters(counters, fan_in=MAX_MERGE_FAN_IN):
+    """
+    Yields (key, count, rank of the first occurrence) of the keys of several counters (e.g., of the ranges of a file)
+    in the order of keys. Their runs are first merged into fewer runs, `fan_in` runs at a time, until at most
+    `fan_in` runs are left, so the counters must not be used afterwards.
+    """
+    run_paths = [run_path for counter in counters for run_path in counter._runs]
+    spill_dir = counters[0].spill_dir if counters else None
+
+    while len(run_paths) > fan_in:
+        merged_paths = []
+        for i in range(0, len(run_paths), fan_in):
+            group = run_paths[i:i + fan_in]
+            if len(group) > 1:
+                merged_paths.append(_write_run(merge_counts([_read_run(run_path) for run_path in group]), spill_dir))
+                for run_path in group:
+                    os.remove(run_path)
+            else:
+                merged_paths.extend(group)
+        run_paths = merged_paths
+
+    for counter in counters:
+        counter._runs = []
+
+    return merge_counts([_read_run(run_path) for run_path in run_paths] +
+                        [counter._sorted_items() for counter in counters if counter._counts])
+
+
+def _write_run(sorted_items, spill_dir):
+    """Writes (key, count, rank) sorted by key to a new run file in batches"""
+    fd, run_path = tempfile.mkstemp(suffix='.run', dir=spill_dir)
+    with os.fdopen(fd, 'wb') as run_file:
+        batch = []
+        for item in sorted_items:
+            batch.append(item)
+            if len(batch) == _RUN_BATCH_SIZE:
+                pickle.dump(batch, run_file, pickle.HIGHEST_PROTOCOL)
+                batch = []
+        if batch:
+            pickle.dump(batch, run_file, pickle.HIGHEST_PROTOCOL)
+
+    return run_path
+
+
+def _read_run(run_path):
+    with open(run_path, 'rb') as run_file:
+        while True:
+            try:
+                batch = pickle.load(run_file)
+            except EOFError:
+                break
+            yield from batch
+
+
+def merge_counts(sorted_items):
+    """Merges iterables of (key, count, rank) sorted by key by summing the counts and keeping the lowest rank"""
+    merged = None
+    for key, count, rank in heapq.merge(*sorted_items, key=lambda item: item[0]):
+        if merged is not None and merged[0] == key:
+            merged[1] += count
+            merged[2] = min(merged[2], rank)
+        else:
+            if merged is not None:
+                yield tuple(merged)
+            merged = [key, count, rank]
+
+    if merged is not None:
+        yield tuple(merged)
+
+
+def count_terms(data_path, count_line, n_counters=1, n_workers=None, max_terms=MAX_TERMS_IN_MEMORY, spill_dir=None,
+                steps_per_log=100000):
+    """
+    :param count_line: a picklable callable (e.g., a module-level function) which takes a decoded line along
+     with `n_counters` counters (see `SpillingCounter`) and adds the terms of the line to them
+    :param max_terms: number of terms each counter keeps in memory in each process (unbounded if None)
+    :param spill_dir: directory of the runs, which must exist until the returned iterators are consumed
+    :return: for each counter, an iterator over (term, count, rank of the first occurrence) in the order of terms
+    """
+    if n_workers is None:
+        n_workers = multiprocessing.cpu_count()
+
+    chunks = [(data_path, count_line, n_counters, max_terms, spill_dir, chunk_idx << _RANGE_RANK_SHIFT,
+               start, end, steps_per_log)
+              for chunk_idx, (start, end) in enumerate(fs.split_lines(data_path, n_workers))]
+
+    if len(chunks) > 1:
+        with multiprocessing.Pool(len(chunks)) as pool:
+            partial_results = pool.map(_count_range, chunks)
+    else:
+        partial_results = [_count_range(chunk) for chunk in chunks]
+
+    print("  %d lines counted" % sum(n_lines for _, n_lines in partial_results))
+    return [merge_counters([counters[i] for counters, _ in partial_results]) for i in range(n_counters)]
+
+
+def count_terms_in_lines(lines, count_line, n_counters=1, max_terms=MAX_TERMS_IN_MEMORY, spill_dir=None,
+                         steps_per_log=100000):
+    """
+    Serial counterpart of `count_terms` over an iterable of lines (as bytes), e.g., of a file that can only
+    be streamed
+    """
+    counters = [SpillingCounter(max_terms, spill_dir) for _ in range(n_counters)]
+    lno = _count_lines(lines, count_line, counters, steps_per_log)
+
+    print("  %d lines counted" % lno)
+    return [counter.items() for counter in counters]
+
+
+def _count_lines(lines, count_line, counters, steps_per_log, description='lines'):
+    lno = 0
+    for line in lines:
+        lno += 1
+        if lno % steps_per_log == 0:
+            print("  processing line %d of %s" % (lno, description))
+
+        count_line(line.decode('utf-8'), *counters)
+
+    return lno
+
+
+def _count_range(args):
+    data_path, count_line, n_counters, max_terms, spill_dir, rank_offset, start, end, steps_per_log = args
+
+    counters = [SpillingCounter(max_terms, spill_dir, rank_offset) for _ in range(n_counters)]
+    lno = _count_lines(fs.read_lines(data_path, start, end), count_line, counters, steps_per_log,
+                       'range [%d, %d)' % (start, end))
+
+    if max_terms is not None:
+        # only the paths of the runs are sent back to the parent process
+        for counter in counters:
+            counter.flush()
+
+    return counters, lno
+
+
+def top_k(counts, ranks, k):
+    """
+    Indices of the `k` largest positive counts in the descending order of counts, where ties are broken by ranks
+    (i.e., the same as a stable sort in the order of ranks). The candidates are selected in linear time.
+    """
+    candidates = np.flatnonzero(counts > 0)
+    if k <= 0:
+        return candidates[:0]
+    elif k < len(candidates):
+        kth_count = np.partition(counts[candidates], len(candidates) - k)[len(candidates) - k]
+        above = candidates[counts[candidates] > kth_count]
+        ties = candidates[counts[candidates] == kth_count]
+        ties = ties[np.argsort(ranks[ties], kind='stable')[:k - len(above)]]
+        candidates = np.concatenate((above, ties))
+
+    return candidates[np.lexsort((ranks[candidates], -counts[candidates]))]
+
+
+def cache_path(data_path):
+    return data_path + '.tf.npz'
+
+
+def _file_signature(file_path):
+    stat = os.stat(file_path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _count_dialogue_line(separator, line, terms, dialogue_terms, last_field_terms, lengths):
+    fields = line.rstrip('\r\n').split(separator)
+    for turn, field in enumerate(fields):
+        tokens = field.split()
+        lengths.add((turn, len(tokens)))
+
+        terms.update(tokens)
+        if turn < len(fields) - 1:
+            dialogue_terms.update(tokens)
+        else:
+            last_field_terms.update(tokens)
+
+
+class TermFrequencies:
+    """
+    Raw (i.e., not normalized) term frequencies of a dialogue file in which fields are separated by `separator`,
+    counted separately for the last field (i.e., the topic words/id in topical files) and the other fields,
+    along with the histogram of the number of tokens per field (i.e., utterance lengths) for each turn.
+    Terms are kept sorted in a single UTF-8 blob and their counts and ranks of first occurrence in NumPy arrays.
+    The ranks of first occurrence are given for the whole lines, the non-last fields and the last field.
+    """
+
+    def __init__(self, term_blob, term_offsets, dialogue_counts, last_field_counts,
+                 ranks, dialogue_ranks, last_field_ranks, length_counts):
+        self._term_blob = term_blob
+        self._term_offsets = term_offsets
+        self.dialogue_counts = dialogue_counts
+        self.last_field_counts = last_field_counts
+        self.ranks = ranks
+        self.dialogue_ranks = dialogue_ranks
+        self.last_field_ranks = last_field_ranks
+        # number of fields of `i` tokens in turn `t`, at [t, i]
+        self.length_counts = length_counts
+
+    def __len__(self):
+        return len(self._term_offsets) - 1
+
+    @property
+    def num_lines(self):
+        return int(self.length_counts[0].sum()) if len(self.length_counts) else 0
+
+    @property
+    def num_utterances(self):
+        return int(self.length_counts.sum())
+
+    def term(self, i):
+        return self._term_blob[self._term_offsets[i]:self._term_offsets[i + 1]].tobytes().decode('utf-8')
+
+    def iter_terms(self):
+        for i in range(len(self)):
+            yield self.term(i)
+
+    def index(self, term):
+        """Binary search of a term, -1 if not found"""
+        i = bisect.bisect_left(_TermSequence(self), term)
+        return i if i < len(self) and self.term(i) == term else -1
+
+    def _field(self, field):
+        if field is None:
+            return self.dialogue_counts + self.last_field_counts, self.ranks
+        elif field == 'dialogue':
+            return self.dialogue_counts, self.dialogue_ranks
+        elif field == 'last_field':
+            return self.last_field_counts, self.last_field_ranks
+        raise ValueError('Unknown field: {}'.format(field))
+
+    def count_of(self, term, field=None):
+        i = self.index(term)
+        return int(self._field(field)[0][i]) if i >= 0 else 0
+
+    def most_common(self, k, field=None, exclude=()):
+        """
+        The `k` most frequent (term, count) pairs in all the fields (or either 'dialogue' or 'last_field')
+        with ties broken by the first occurrence, skipping the `exclude`d terms
+        """
+        counts, ranks = self._field(field)
+
+        excluded = [i for i in (self.index(term) for term in exclude) if i >= 0]
+        if excluded:
+            counts = counts.copy()
+            counts[excluded] = 0
+
+        return [(self.term(i), int(counts[i])) for i in top_k(counts, ranks, k)]
+
+    def in_order(self, field=None):
+        """(term, count) pairs of the terms in all the fields (or either 'dialogue' or 'last_field') in the order of
+        their first occurrence"""
+        counts, ranks = self._field(field)
+        present = np.flatnonzero(counts > 0)
+        return [(self.term(i), int(counts[i])) for i in present[np.argsort(ranks[present], kind='stable')]]
+
+    def normalized(self, normalize):
+        """
+        Term frequencies of the normalized terms, where `normalize` maps a term to its normalized form or to None
+        to drop it. Its memory is proportional to the number of normalized terms.
+        """
+        new_ids = {}
+        id_map = np.full(len(self), -1, dtype=np.int64)
+        for i, term in enumerate(self.iter_terms()):
+            normalized_term = normalize(term)
+            if normalized_term is not None:
+                id_map[i] = new_ids.setdefault(normalized_term, len(new_ids))
+
+        new_terms = sorted(new_ids)
+        new_positions = np.zeros(len(new_ids), dtype=np.int64)
+        new_positions[[new_ids[term] for term in new_terms]] = np.arange(len(new_terms))
+
+        kept = np.flatnonzero(id_map >= 0)
+        targets = new_positions[id_map[kept]]
+
+        def reduce_counts(counts):
+            new_counts = np.zeros(len(new_terms), dtype=np.int64)
+            np.add.at(new_counts, targets, counts[kept])
+            return new_counts
+
+        def reduce_ranks(ranks):
+            new_ranks = np.full(len(new_terms), _ABSENT, dtype=np.int64)
+            np.minimum.at(new_ranks, targets, ranks[kept])
+            return new_ranks
+
+        term_blob, term_offsets = _pack_terms(new_terms)
+        return TermFrequencies(term_blob, term_offsets,
+                               reduce_counts(self.dialogue_counts), reduce_counts(self.last_field_counts),
+                               reduce_ranks(self.ranks), reduce_ranks(self.dialogue_ranks),
+                               reduce_ranks(self.last_field_ranks), self.length_counts)
+
+    @staticmethod
+    def build(data_path, separator='\t', n_workers=None, max_terms=MAX_TERMS_IN_MEMORY, lines=None):
+        """
+        Counts the terms of a local file in parallel, or of the given `lines` (as bytes) serially (e.g., for files
+        on remote file systems, in which case `data_path` is only used for display)
+        """
+        count_line = functools.partial(_count_dialogue_line, separator)
+        spill_parent = None if lines is not None else os.path.dirname(os.path.abspath(data_path))
+        with tempfile.TemporaryDirectory(dir=spill_parent) as spill_dir:
+            if lines is None:
+                counts = count_terms(data_path, count_line, n_counters=4, n_workers=n_workers,
+                                     max_terms=max_terms, spill_dir=spill_dir)
+            else:
+                counts = count_terms_in_lines(lines, count_line, n_counters=4, max_terms=max_terms,
+                                              spill_dir=spill_dir)
+            terms, dialogue_terms, last_field_terms, lengths = counts
+
+            term_blob, term_offsets = bytearray(), array.array('q', [0])
+            columns = [array.array('q') for _ in range(5)]
+            ranks, dialogue_counts, dialogue_ranks, last_field_counts, last_field_ranks = columns
+
+            # all the streams are sorted by term and the dialogue and last-field terms are subsets of all the terms
+            next_dialogue, next_last_field = next(dialogue_terms, None), next(last_field_terms, None)
+            for term, _, rank in terms:
+                term_blob += term.encode('utf-8')
+                term_offsets.append(len(term_blob))
+                ranks.append(rank)
+
+                if next_dialogue is not None and next_dialogue[0] == term:
+                    dialogue_counts.append(next_dialogue[1])
+                    dialogue_ranks.append(next_dialogue[2])
+                    next_dialogue = next(dialogue_terms, None)
+                else:
+                    dialogue_counts.append(0)
+                    dialogue_ranks.append(_ABSENT)
+
+                if next_last_field is not None and next_last_field[0] == term:
+                    last_field_counts.append(next_last_field[1])
+                    last_field_ranks.append(next_last_field[2])
+                    next_last_field = next(last_field_terms, None)
+                else:
+                    last_field_counts.append(0)
+                    last_field_ranks.append(_ABSENT)
+
+            lengths = {key: count for key, count, _ in lengths}
+
+        n_turns = max((t for t, _ in lengths), default=-1) + 1
+        max_length = max((n for _, n in lengths), default=-1) + 1
+        length_counts = np.zeros((n_turns, max_length), dtype=np.int64)
+        for (t, n), count in lengths.items():
+            length_counts[t, n] = count
+
+        ranks, dialogue_counts, dialogue_ranks, last_field_counts, last_field_ranks = \
+            [np.frombuffer(column, dtype=np.int64) if len(column) else np.zeros(0, dtype=np.int64)
+             for column in columns]
+        return TermFrequencies(np.frombuffer(bytes(term_blob), dtype=np.uint8),
+                               np.frombuffer(term_offsets, dtype=np.int64),
+                               dialogue_counts, last_field_counts,
+                               ranks, dialogue_ranks, last_field_ranks, length_counts)
+
+    def save(self, path, signature, separator):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f,
+                     version=np.array([_CACHE_VERSION], dtype=np.int64),
+                     signature=np.array(signature, dtype=np.uint64),
+                     separator=np.frombuffer(separator.encode('utf-8'), dtype=np.uint8),
+                     term_blob=self._term_blob,
+                     term_offsets=self._term_offsets,
+                     dialogue_counts=self.dialogue_counts,
+                     last_field_counts=self.last_field_counts,
+                     ranks=self.ranks,
+                     dialogue_ranks=self.dialogue_ranks,
+                     last_field_ranks=self.last_field_ranks,
+                     length_counts=self.length_counts)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load(data_path, separator='\t', n_workers=None, max_terms=MAX_TERMS_IN_MEMORY):
+        """Reads the cached term frequencies of a file if they are valid, or else counts and caches them"""
+        path = cache_path(data_path)
+        signature = _file_signature(data_path)
+
+        if os.path.exists(path):
+            with np.load(path) as cache:
+                if 'version' in cache.files and int(cache['version'][0]) == _CACHE_VERSION and \
+                        tuple(int(v) for v in cache['signature']) == signature and \
+                        cache['separator'].tobytes().decode('utf-8') == separator:
+                    return TermFrequencies(cache['term_blob'], cache['term_offsets'],
+                                           cache['dialogue_counts'], cache['last_field_counts'],
+                                           cache['ranks'], cache['dialogue_ranks'], cache['last_field_ranks'],
+                                           cache['length_counts'])
+
+        print("Counting the terms of %s" % data_path)
+        term_frequencies = TermFrequencies.build(data_path, separator, n_workers, max_terms)
+        term_frequencies.save(path, signature, separator)
+        return term_frequencies
+
+
+class _TermSequence:
+    """Read-only sequence view of the (sorted) terms for binary search"""
+
+    def __init__(self, term_frequencies):
+        self._term_frequencies = term_frequencies
+
+    def __len__(self):
+        return len(self._term_frequencies)
+
+    def __getitem__(self, i):
+        return self._term_frequencies.term(i)
+
+
+def _pack_terms(terms):
+    encoded = [term.encode('utf-8') for term in terms]
+    term_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(term) for term in encoded], out=term_offsets[1:])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), term_offsets
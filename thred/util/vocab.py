@@ -1,10 +1,13 @@
 import codecs
+import functools
 import re
 from collections import defaultdict
 
 import tensorflow as tf
 from tensorflow.python.ops import lookup_ops
 
+from . import term_counter
+
 UNK, UNK_ID = "<UNK>", 0
 SOS, SOS_ID = "<S>", 1
 EOS, EOS_ID = "</S>", 2
@@ -59,11 +62,24 @@ def save_vocab_dict(vocab_file, vocab_dict):
             vocab_file.write(w + "\n")
 
 
+def load_term_frequencies(data_path, n_workers=None):
+    """
+    Term frequencies of a data file (see term_counter.TermFrequencies). Local files are counted in parallel
+    and cached next to the file, while files on other file systems (e.g., gs:// or hdfs://) are streamed once
+    through tf.gfile without a cache.
+    """
+    if '://' not in data_path:
+        return term_counter.TermFrequencies.load(data_path, n_workers=n_workers)
+
+    with tf.gfile.GFile(data_path, "rb") as f:
+        return term_counter.TermFrequencies.build(data_path, lines=f)
+
+
 # _WORD_SPLIT = re.compile(b"([.,!?\"':;)(])")
 _DIGIT_RE = re.compile(r"\d")
 
 
-def create_vocabulary(vocabulary_path, data_path, max_vocabulary_size, normalize_digits=False):
+def create_vocabulary(vocabulary_path, data_path, max_vocabulary_size, normalize_digits=False, n_workers=None):
     """Create vocabulary file (if it does not exist yet) from data file.
     Data file is assumed to contain one sentence per line. Each sentence is
     tokenized and digits are normalized (if normalize_digits is set).
@@ -75,32 +91,21 @@ def create_vocabulary(vocabulary_path, data_path, max_vocabulary_size, normalize
       data_path: data file that will be used to create vocabulary.
       max_vocabulary_size: limit on the size of the created vocabulary.
       normalize_digits: Boolean; if true, all digits are replaced by 0s.
+      n_workers: number of processes counting the tokens (defaults to the number of CPUs).
     """
 
     if not tf.gfile.Exists(vocabulary_path):
         print("Creating vocabulary %s from data %s" % (vocabulary_path, data_path))
-        vocab = {}
-        with codecs.getreader("utf-8")(tf.gfile.GFile(data_path, "rb")) as f:
-            counter = 0
-            for line in f:
-                counter += 1
-                if counter % 100000 == 0:
-                    print("  processing line %d" % counter)
-                tokens = line.replace(u"\u00A0", " ").split()
-                for w in tokens:
-                    word = _DIGIT_RE.sub("0", w) if normalize_digits else w
-                    if word in vocab:
-                        vocab[word] += 1
-                    else:
-                        vocab[word] = 1
-
-            for reserved_word in RESERVED_WORDS:
-                if reserved_word in vocab:
-                    vocab.pop(reserved_word)
-            vocab_list = RESERVED_WORDS + sorted(vocab, key=vocab.get, reverse=True)
-            if len(vocab_list) > max_vocabulary_size:
-                vocab_list = vocab_list[:max_vocabulary_size]
-            with codecs.getwriter("utf-8")(tf.gfile.GFile(vocabulary_path, mode="wb")) as vocab_file:
-                vocab_size = len(vocab_list)
-                for i, w in enumerate(vocab_list):
-                    vocab_file.write(w + ("\n" if i < vocab_size - 1 else ""))
+        # term frequencies are cached next to the data file, so that they are counted once for any vocab size
+        term_frequencies = load_term_frequencies(data_path, n_workers=n_workers)
+        if normalize_digits:
+            term_frequencies = term_frequencies.normalized(functools.partial(_DIGIT_RE.sub, "0"))
+
+        most_common = term_frequencies.most_common(max_vocabulary_size - len(RESERVED_WORDS), exclude=RESERVED_WORDS)
+        vocab_list = RESERVED_WORDS + [w for w, _ in most_common]
+        if len(vocab_list) > max_vocabulary_size:
+            vocab_list = vocab_list[:max_vocabulary_size]
+        with codecs.getwriter("utf-8")(tf.gfile.GFile(vocabulary_path, mode="wb")) as vocab_file:
+            vocab_size = len(vocab_list)
+            for i, w in enumerate(vocab_list):
+                vocab_file.write(w + ("\n" if i < vocab_size - 1 else ""))